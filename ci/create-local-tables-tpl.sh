@@ -10,8 +10,9 @@ aws dynamodb create-table \
   --endpoint-url http://0.0.0.0:8000 \
   --region us-west-2 \
   --table-name Music-ZZ-REG-ID \
-  --attribute-definitions '[{ "AttributeName": "music_id", "AttributeType": "S" }]' \
+  --attribute-definitions '[{ "AttributeName": "music_id", "AttributeType": "S" }, { "AttributeName": "Artist", "AttributeType": "S" }, { "AttributeName": "SongTitle", "AttributeType": "S" }]' \
   --key-schema '[{ "AttributeName": "music_id", "KeyType": "HASH" }]' \
+  --global-secondary-indexes '[{ "IndexName": "Artist-index", "KeySchema": [{ "AttributeName": "Artist", "KeyType": "HASH" }, { "AttributeName": "SongTitle", "KeyType": "RANGE" }], "Projection": { "ProjectionType": "ALL" }, "ProvisionedThroughput": {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5} }]' \
   --provisioned-throughput '{"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}'
 aws dynamodb create-table \
   --endpoint-url http://0.0.0.0:8000 \
@@ -28,3 +29,10 @@ aws dynamodb create-table \
   --key-schema '[{ "AttributeName": "playlist_id", "KeyType": "HASH" }]' \
   --provisioned-throughput '{"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}'
 
+aws dynamodb create-table \
+  --endpoint-url http://0.0.0.0:8000 \
+  --region us-west-2 \
+  --table-name Songindex-ZZ-REG-ID \
+  --attribute-definitions '[{ "AttributeName": "songindex_id", "AttributeType": "S" }]' \
+  --key-schema '[{ "AttributeName": "songindex_id", "KeyType": "HASH" }]' \
+  --provisioned-throughput '{"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}'
@@ -51,12 +51,25 @@ else
 fi
 set -o errexit
 
+echo
+echo "Checking the copies of shared modules ..."
+../tools/check-copies.sh
+
 set -o xtrace
 # Turn off errexit so we continue even if CI test returns failure
 set +o errexit
-${COMP} -f ${ver}/compose.yaml up --build --abort-on-container-exit --exit-code-from test
-# Return code from 'up' is the test result
-trc=$?
-# Shutdown and delete all the containers before returning
-${COMP} -f ${ver}/compose.yaml down
+# Run the tests against both versions of the db service:
+# threaded (Dockerfile) and asyncio (Dockerfile-asgi)
+trc=0
+for DB_DOCKERFILE in Dockerfile Dockerfile-asgi; do
+  export DB_DOCKERFILE
+  ${COMP} -f ${ver}/compose.yaml up --build --abort-on-container-exit --exit-code-from test
+  # Return code from 'up' is the test result
+  rc=$?
+  # Shutdown and delete all the containers before the next run
+  ${COMP} -f ${ver}/compose.yaml down
+  if [[ ${rc} -ne 0 ]]; then
+    trc=${rc}
+  fi
+done
 exit ${trc}
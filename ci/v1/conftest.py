@@ -3,6 +3,8 @@ Configure for pytest.
 
 Parses the command-line arguments, reads the environment variables,
 and then creates the two DynamoDB tables before executing the tests.
+Also puts the modules of the db and s1 services on the path of the
+unit tests.
 
 The tests all assume that these tables have already been created.
 
@@ -14,13 +16,23 @@ succeed or making a successful test fail.
 
 # Standard libraries
 import os
+import sys
 
 # Installed packages
+import boto3
+
 import pytest
 
 # Local modules
 import create_tables
 
+# The unit tests import modules of the services, which the test
+# image keeps in the directories they have in the repository
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', '..')
+for service in ('db', 's1'):
+    sys.path.append(os.path.join(REPO_DIR, service))
+
 
 def pytest_addoption(parser):
     """
@@ -57,6 +69,17 @@ def pytest_addoption(parser):
         type=int,
         help="Port number of playlist service."
         )
+    parser.addoption(
+        '--chunked_playlist_address',
+        help="DNS name or IP address of a playlist service that chunks "
+             "playlists (PLAYLIST_SEGMENT_SIZE 2).  Optional: the "
+             "chunked playlist tests are skipped without it."
+        )
+    parser.addoption(
+        '--chunked_playlist_port',
+        type=int,
+        help="Port number of the chunking playlist service."
+        )
     parser.addoption(
         '--table_suffix',
         help="Suffix to add to table names (not including leading "
@@ -118,6 +141,29 @@ def playlist_url(request, playlist_address, playlist_port):
         playlist_address, playlist_port)
 
 
+@pytest.fixture
+def chunked_playlist_url(request):
+    address = request.config.getoption('--chunked_playlist_address')
+    if address is None:
+        pytest.skip("no --chunked_playlist_address")
+    return "http://{}:{}/api/v1/playlist/".format(
+        address, request.config.getoption('--chunked_playlist_port'))
+
+
+@pytest.fixture
+def playlist_table(request):
+    """Return the DynamoDB playlist table, for tests that store
+    items in a form the services would not write themselves."""
+    args = request.config.option
+    dynamodb = boto3.resource(
+        'dynamodb',
+        endpoint_url=args.dynamodb_url,
+        region_name=args.dynamodb_region,
+        aws_access_key_id=args.access_key_id,
+        aws_secret_access_key=args.secret_access_key)
+    return dynamodb.Table('Playlist-' + args.table_suffix)
+
+
 @pytest.fixture
 def auth(request):
     """Return a dummy authorization header.
@@ -186,7 +232,8 @@ def setup(args):
         args.secret_access_key,
         'Music-' + args.table_suffix,
         'User-' + args.table_suffix,
-        'Playlist-' + args.table_suffix
+        'Playlist-' + args.table_suffix,
+        'Songindex-' + args.table_suffix
     )
 
 
@@ -19,7 +19,7 @@ import boto3
 
 # Function definitions
 def create_tables(url, region, access_key_id, secret_access_key,
-                  music, user, playlist):
+                  music, user, playlist, songindex=None):
     """ Create the music and user tables in DynamoDB.
 
     Parameters
@@ -41,9 +41,15 @@ def create_tables(url, region, access_key_id, secret_access_key,
         DynamodDB copies will accept any value, while the actual AWS
         service requires the secret key associated with the key ID.
     music: string
-        Name of the music table.
+        Name of the music table.  It has the global secondary index
+        "Artist-index" (Artist, SongTitle) used by the datastore's
+        `/query`.
     user: string
         Name of the user table.
+    playlist: string
+        Name of the playlist table.
+    songindex: string (optional)
+        Name of the table mapping music ids to playlists.
     """
     dynamodb = boto3.resource(
         'dynamodb',
@@ -59,9 +65,19 @@ def create_tables(url, region, access_key_id, secret_access_key,
     """
     mt = dynamodb.create_table(
         TableName=music,
-        AttributeDefinitions=[{
-            "AttributeName": "music_id", "AttributeType": "S"}],
+        AttributeDefinitions=[
+            {"AttributeName": "music_id", "AttributeType": "S"},
+            {"AttributeName": "Artist", "AttributeType": "S"},
+            {"AttributeName": "SongTitle", "AttributeType": "S"}],
         KeySchema=[{"AttributeName": "music_id", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "Artist-index",
+            "KeySchema": [
+                {"AttributeName": "Artist", "KeyType": "HASH"},
+                {"AttributeName": "SongTitle", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "ALL"},
+            "ProvisionedThroughput": {
+                "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}}],
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
@@ -81,6 +97,15 @@ def create_tables(url, region, access_key_id, secret_access_key,
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
+    if songindex is not None:
+        st = dynamodb.create_table(
+            TableName=songindex,
+            AttributeDefinitions=[{
+                "AttributeName": "songindex_id", "AttributeType": "S"}],
+            KeySchema=[{"AttributeName": "songindex_id", "KeyType": "HASH"}],
+            ProvisionedThroughput={
+                "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+        )
     """
     The order in which we wait for the tables is irrelevant.  We can only
     proceed after both exist.
@@ -88,3 +113,5 @@ def create_tables(url, region, access_key_id, secret_access_key,
     mt.wait_until_exists()
     ut.wait_until_exists()
     pt.wait_until_exists()
+    if songindex is not None:
+        st.wait_until_exists()
@@ -3,6 +3,7 @@ Python  API for the music service.
 """
 
 # Standard library modules
+import json
 
 # Installed packages
 import requests
@@ -81,6 +82,112 @@ class Music():
         item = r.json()['Items'][0]
         return r.status_code, item['Artist'], item['SongTitle']
 
+    def read_etag(self, m_id, etag=None):
+        """Read a song conditionally.
+
+        Parameters
+        ----------
+        m_id: string
+            The UUID of this song in the music database.
+        etag: string (optional)
+            An ETag returned by an earlier read.  If it still
+            matches, Music responds 304 without the song.
+
+        Returns
+        -------
+        status, etag
+
+        status: number
+            The HTTP status code returned by Music.
+        etag: The song's current ETag, or None if there is none.
+        """
+        headers = {'Authorization': self._auth}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        r = requests.get(self._url + m_id, headers=headers)
+        return r.status_code, r.headers.get('ETag')
+
+    def list_all(self):
+        """List every song.
+
+        Returns
+        -------
+        status, songs
+
+        status: number
+            The HTTP status code returned by Music.
+        songs: If status is 200, a list of (music_id, artist, title)
+          tuples, one per song. If status is not 200, None.
+        """
+        r = requests.get(
+            self._url,
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None
+
+        items = [json.loads(line) for line in r.iter_lines() if line]
+        return r.status_code, [
+            (i['music_id'], i['Artist'], i['SongTitle']) for i in items]
+
+    def list_artist(self, artist):
+        """List the songs by one artist.
+
+        Parameters
+        ----------
+        artist: string
+            The artist's name, exactly as stored.
+
+        Returns
+        -------
+        status, songs
+
+        status: number
+            The HTTP status code returned by Music.
+        songs: If status is 200, a list of (music_id, artist, title)
+          tuples in title order. If status is not 200, None.
+        """
+        r = requests.get(
+            self._url,
+            params={'artist': artist},
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None
+
+        items = [json.loads(line) for line in r.iter_lines() if line]
+        return r.status_code, [
+            (i['music_id'], i['Artist'], i['SongTitle']) for i in items]
+
+    def search(self, query):
+        """Search the songs by artist and title.
+
+        Parameters
+        ----------
+        query: string
+            Words of the artist or title.  The last may be
+            incomplete.
+
+        Returns
+        -------
+        status, songs
+
+        status: number
+            The HTTP status code returned by Music.
+        songs: If status is 200, a list of (music_id, artist, title)
+          tuples, best match first. If status is not 200, None.
+        """
+        r = requests.get(
+            self._url + 'search',
+            params={'q': query},
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None
+        return r.status_code, [
+            (i['music_id'], i['Artist'], i['SongTitle'])
+            for i in r.json()['Items']]
+
     def delete(self, m_id):
         """Delete an artist, song pair.
 
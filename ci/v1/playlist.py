@@ -98,6 +98,35 @@ class PlayList():
         )
         return r.status_code
 
+    def edit_songs(self, playlist_id, m_ids, add=True):
+        """Add several songs to, or delete them from, the playlist.
+
+        Parameters
+        ----------
+        playlist_id: string
+            The UUID of this playist in the music database.
+        m_ids: list of string
+            The UUIDs of the songs in the music database.
+        add: boolean
+            True to add the songs, False to delete them.
+
+        Returns
+        -------
+        status, results
+
+        results: If status is 200, a list of (music_id, result)
+          tuples in request order.
+        """
+        r = requests.post(
+            f"{self._url}{playlist_id}/{'add' if add else 'delete'}",
+            json={'music_ids': m_ids},
+            headers={'Authorization': self._auth}
+        )
+        if r.status_code != 200:
+            return r.status_code, None
+        return r.status_code, [(e['music_id'], e['result'])
+                               for e in r.json()['Results']]
+
     def read(self, playlist_id):
         """Read a playlist.
 
@@ -120,6 +149,102 @@ class PlayList():
         item = r.json()['Items'][0]
         return r.status_code, item['Name'], item['Playlist']
 
+    def read_page(self, playlist_id, offset, limit):
+        """Read part of a playlist.
+
+        Parameters
+        ----------
+        playlist_id: string
+            The UUID of this playist in the music database.
+        offset: integer
+            The position of the first song to read.
+        limit: integer
+            The most songs to read.
+
+        Returns
+        -------
+        status, songs in that part, length of the whole playlist
+        """
+        r = requests.get(
+            self._url + playlist_id,
+            params={'offset': offset, 'limit': limit},
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None, None
+
+        item = r.json()['Items'][0]
+        return r.status_code, item['Playlist'], item['Length']
+
+    def read_etag(self, playlist_id, etag=None):
+        """Read a playlist conditionally.
+
+        Parameters
+        ----------
+        playlist_id: string
+            The UUID of this playist in the music database.
+        etag: string (optional)
+            An ETag returned by an earlier read.  If it still
+            matches, the service responds 304 without the playlist.
+
+        Returns
+        -------
+        status, etag
+        """
+        headers = {'Authorization': self._auth}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        r = requests.get(self._url + playlist_id, headers=headers)
+        return r.status_code, r.headers.get('ETag')
+
+    def read_expanded(self, playlist_id):
+        """Read a playlist with the details of its songs.
+
+        Parameters
+        ----------
+        playlist_id: string
+            The UUID of this playist in the music database.
+
+        Returns
+        -------
+        status, playlist_name, songs in that playlist
+
+        songs: If status is 200, a list of (music_id, artist, title)
+          tuples in playlist order.
+        """
+        r = requests.get(
+            self._url + playlist_id,
+            params={'expand': 'music'},
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None, None
+
+        item = r.json()['Items'][0]
+        return r.status_code, item['Name'], [
+            (s['music_id'], s.get('Artist'), s.get('SongTitle'))
+            for s in item['Songs']]
+
+    def playlists_with_song(self, m_id):
+        """List the playlists holding a song.
+
+        Parameters
+        ----------
+        m_id: string
+            The UUID of the song in the music database.
+
+        Returns
+        -------
+        status, playlist ids
+        """
+        r = requests.get(
+            f"{self._url}music/{m_id}",
+            headers={'Authorization': self._auth}
+            )
+        if r.status_code != 200:
+            return r.status_code, None
+        return r.status_code, r.json()['Playlists']
+
     def delete(self, playlist_id):
         """Delete a playlist.
 
@@ -0,0 +1,177 @@
+"""
+Test the collapsing of concurrent reads by SingleFlight and
+AsyncSingleFlight of the db service (db/cache.py).
+
+These are unit tests: they need no running services.
+"""
+
+# Standard libraries
+import asyncio
+import threading
+import time
+
+# Installed packages
+import pytest
+
+# Local modules
+from cache import AsyncSingleFlight
+from cache import SingleFlight
+
+CALLERS = 8
+
+
+class Tally():
+    """Stands in for a prometheus_client Counter."""
+    def __init__(self):
+        self.value = 0
+
+    def inc(self):
+        self.value += 1
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def collapse(flights, collapsed, fetch):
+    """Call flights.do('k', fetch) from CALLERS threads, letting the
+    fetch finish once every caller has joined.  Return the callers'
+    results, or the exceptions they raised."""
+    release = threading.Event()
+    results = [None] * CALLERS
+
+    def gated():
+        release.wait(5)
+        return fetch()
+
+    def call(i):
+        try:
+            results[i] = flights.do('k', gated)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,))
+               for i in range(CALLERS)]
+    for t in threads:
+        t.start()
+    wait_until(lambda: collapsed.value == CALLERS - 1)
+    release.set()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_single_flight_collapses():
+    collapsed = Tally()
+    flights = SingleFlight(collapsed=collapsed)
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return {'value': 1}
+
+    results = collapse(flights, collapsed, fetch)
+    assert len(fetches) == 1
+    assert results == [{'value': 1}] * CALLERS
+    # Nothing is kept once the fetch completes
+    assert flights.do('k', fetch) == {'value': 1} and len(fetches) == 2
+
+
+def test_single_flight_shares_exception():
+    collapsed = Tally()
+    flights = SingleFlight(collapsed=collapsed)
+
+    def fetch():
+        raise RuntimeError('datastore down')
+
+    results = collapse(flights, collapsed, fetch)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_single_flight_forget():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'before'
+
+    leader = threading.Thread(target=flights.do, args=('k', slow))
+    leader.start()
+    started.wait(5)
+    # A caller arriving after a write does not join the earlier fetch
+    flights.forget('k')
+    assert flights.do('k', lambda: 'after') == 'after'
+    release.set()
+    leader.join(5)
+
+
+def test_async_single_flight_collapses():
+    collapsed = Tally()
+    flights = AsyncSingleFlight(collapsed=collapsed)
+    fetches = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def fetch():
+            fetches.append(1)
+            await release.wait()
+            return {'value': 1}
+
+        callers = [asyncio.ensure_future(flights.do('k', fetch))
+                   for i in range(CALLERS)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*callers)
+
+    results = asyncio.run(main())
+    assert len(fetches) == 1 and collapsed.value == CALLERS - 1
+    assert results == [{'value': 1}] * CALLERS
+
+
+def test_async_single_flight_shares_exception():
+    flights = AsyncSingleFlight()
+
+    async def main():
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('datastore down')
+
+        return await asyncio.gather(
+            *[flights.do('k', fetch) for i in range(CALLERS)],
+            return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_async_single_flight_cancelled_caller():
+    flights = AsyncSingleFlight()
+    fetches = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def fetch():
+            fetches.append(1)
+            await release.wait()
+            return 'value'
+
+        first = asyncio.ensure_future(flights.do('k', fetch))
+        second = asyncio.ensure_future(flights.do('k', fetch))
+        await asyncio.sleep(0)
+        # As when the client of the first caller disconnects
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == 'value' and len(fetches) == 1
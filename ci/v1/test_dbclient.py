@@ -0,0 +1,144 @@
+"""
+Test the batching and deduplication of datastore reads by the
+ReadLoader of the services (s1/dbclient.py).
+
+These are unit tests: the loader reads from a stand-in for the
+datastore rather than a running db service.
+"""
+
+# Standard libraries
+import threading
+import time
+
+# Installed packages
+from prometheus_client import CollectorRegistry
+
+import pytest
+
+import requests
+
+import simplejson as json
+
+# Local modules
+import dbclient
+
+ITEMS = {k: {'music_id': k, 'Artist': 'Artist ' + k} for k in 'abcd'}
+
+
+class FakeResponse():
+    def __init__(self, body):
+        self.status_code = 200
+        self.content = json.dumps(body).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession():
+    """Answers `/read` and `/batch_read` of the music table from ITEMS,
+    recording each call as (route, keys).  While `gate` is clear,
+    calls wait for it.  Keys in `unprocessed` are left unprocessed by
+    `/batch_read`, and a `/read` of a key in `failing` raises."""
+    def __init__(self):
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.unprocessed = set()
+        self.failing = set()
+
+    def get(self, url, params, headers):
+        self.calls.append(('read', [params['objkey']]))
+        self.gate.wait(5)
+        if params['objkey'] in self.failing:
+            raise requests.ConnectionError('datastore down')
+        item = ITEMS.get(params['objkey'])
+        items = [] if item is None else [item]
+        return FakeResponse({'Items': items, 'Count': len(items)})
+
+    def post(self, url, json, headers):
+        keys = json['objkeys']
+        self.calls.append(('batch_read', keys))
+        self.gate.wait(5)
+        return FakeResponse({
+            'Items': [ITEMS[k] for k in keys
+                      if k in ITEMS and k not in self.unprocessed],
+            'UnprocessedKeys': [k for k in keys if k in self.unprocessed]})
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def session():
+    return FakeSession()
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def loader(session, registry):
+    return dbclient.ReadLoader(session, 'http://db', registry, window_ms=20)
+
+
+def hold_in_flight(session, loader):
+    """Start a read of 'a' that waits for the gate, so that the loader
+    queues the reads asked for meanwhile.  Returns its thread."""
+    session.gate.clear()
+    thread = threading.Thread(target=loader.load, args=('music', 'a'))
+    thread.start()
+    wait_until(lambda: session.calls)
+    return thread
+
+
+def test_lone_read_is_sent_at_once(session, loader):
+    result = loader.load('music', 'a').result(5)
+    assert session.calls == [('read', ['a'])]
+    assert result.status_code == 200 and result.json()['Items'] == [ITEMS['a']]
+
+
+def test_concurrent_reads_of_one_key(session, loader, registry):
+    thread = hold_in_flight(session, loader)
+    futures = [loader.load('music', 'b') for i in range(10)]
+    assert all(f is futures[0] for f in futures)
+    session.gate.set()
+    assert futures[0].result(5).json()['Items'] == [ITEMS['b']]
+    thread.join(5)
+    assert session.calls == [('read', ['a']), ('read', ['b'])]
+    assert registry.get_sample_value(
+        'db_client_loads_total', {'objtype': 'music'}) == 11
+    assert registry.get_sample_value(
+        'db_client_loads_deduplicated_total', {'objtype': 'music'}) == 9
+
+
+def test_queued_reads_are_batched(session, loader):
+    thread = hold_in_flight(session, loader)
+    futures = {k: loader.load('music', k) for k in 'bcx'}
+    session.gate.set()
+    for k, future in futures.items():
+        items = future.result(5).json()['Items']
+        assert items == ([] if k == 'x' else [ITEMS[k]])
+    thread.join(5)
+    assert session.calls == [('read', ['a']), ('batch_read', ['b', 'c', 'x'])]
+
+
+def test_failed_batch_resolves_every_future(session, loader):
+    # 'c' is left unprocessed and its retry fails: every caller
+    # of the batch gets the error rather than waiting for ever
+    session.unprocessed.add('c')
+    session.failing.add('c')
+    thread = hold_in_flight(session, loader)
+    futures = [loader.load('music', k) for k in 'bcd']
+    session.gate.set()
+    for future in futures:
+        with pytest.raises(requests.ConnectionError):
+            future.result(5)
+    thread.join(5)
+    # The loader is usable afterwards
+    assert loader.load('music', 'b').result(5).json()['Items'] == [ITEMS['b']]
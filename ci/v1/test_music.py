@@ -7,6 +7,7 @@ defined in `conftest.py`.
 """
 
 # Standard libraries
+import concurrent.futures
 
 # Installed packages
 import pytest
@@ -33,3 +34,54 @@ def test_simple_run(mserv, song):
     assert trc == 200 and artist == song[0] and title == song[1]
     mserv.delete(m_id)
     # No status to check
+
+
+def test_list_all(mserv, song):
+    trc, m_id = mserv.create(song[0], song[1])
+    assert trc == 200
+    trc, songs = mserv.list_all()
+    assert trc == 200 and (m_id, song[0], song[1]) in songs
+    mserv.delete(m_id)
+
+
+def test_conditional_read(mserv, song):
+    trc, m_id = mserv.create(song[0], song[1])
+    trc, etag = mserv.read_etag(m_id)
+    assert trc == 200 and etag is not None
+    trc, etag2 = mserv.read_etag(m_id, etag)
+    assert trc == 304 and etag2 == etag
+    trc, etag2 = mserv.read_etag(m_id, '"stale"')
+    assert trc == 200 and etag2 == etag
+    mserv.delete(m_id)
+
+
+def test_search(mserv, song):
+    trc, m_id = mserv.create(song[0], song[1])
+    trc, songs = mserv.search('presley hou')
+    assert trc == 200 and (m_id, song[0], song[1]) in songs
+    mserv.delete(m_id)
+    trc, songs = mserv.search('presley hou')
+    assert trc == 200 and m_id not in [s[0] for s in songs]
+
+
+def test_list_artist(mserv, song):
+    trc, m_id1 = mserv.create(song[0], song[1])
+    trc, m_id2 = mserv.create(song[0], 'All Shook Up')
+    trc, m_id3 = mserv.create('Big Mama Thornton', song[1])
+    trc, songs = mserv.list_artist(song[0])
+    assert trc == 200 and songs == [(m_id2, song[0], 'All Shook Up'),
+                                    (m_id1, song[0], song[1])]
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+    mserv.delete(m_id3)
+
+
+def test_concurrent_reads(mserv, song):
+    # Concurrent reads may be batched together by the service
+    titles = ['Hound Dog', 'All Shook Up', 'Jailhouse Rock']
+    m_ids = [mserv.create(song[0], title)[1] for title in titles]
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(mserv.read, 3 * m_ids))
+    assert results == [(200, song[0], title) for title in 3 * titles]
+    for m_id in m_ids:
+        mserv.delete(m_id)
@@ -7,6 +7,7 @@ defined in `conftest.py`.
 """
 
 # Standard libraries
+import uuid
 
 # Installed packages
 import pytest
@@ -68,3 +69,136 @@ def test_update_playlist(plserv, mserv, song1, song2, playlist1):
     plserv.delete(p_id)
     mserv.delete(m_id1)
     mserv.delete(m_id2)
+
+
+def test_read_expanded_playlist(plserv, mserv, song1, song2, playlist1):
+    trc, m_id1 = mserv.create(song1[0], song1[1])
+    trc, m_id2 = mserv.create(song2[0], song2[1])
+    trc, p_id = plserv.create(playlist1, [m_id1])
+    trc, plname, songs = plserv.read_expanded(p_id)
+    assert trc == 200 and plname == playlist1
+    assert songs == [(m_id1, song1[0], song1[1])]
+    # The cached expansion must reflect the added song
+    trc = plserv.write_song(p_id, m_id2)
+    trc, plname, songs = plserv.read_expanded(p_id)
+    assert trc == 200 and songs == [(m_id1, song1[0], song1[1]),
+                                    (m_id2, song2[0], song2[1])]
+    plserv.delete(p_id)
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+
+
+def test_playlists_with_song(plserv, mserv, song1, song2, playlist1):
+    trc, m_id1 = mserv.create(song1[0], song1[1])
+    trc, m_id2 = mserv.create(song2[0], song2[1])
+    trc, p_id = plserv.create(playlist1, [m_id1])
+    trc, p_ids = plserv.playlists_with_song(m_id1)
+    assert trc == 200 and p_ids == [p_id]
+    trc = plserv.write_song(p_id, m_id2)
+    trc = plserv.delete_song(p_id, m_id1)
+    trc, p_ids = plserv.playlists_with_song(m_id1)
+    assert trc == 200 and p_ids == []
+    trc, p_ids = plserv.playlists_with_song(m_id2)
+    assert trc == 200 and p_ids == [p_id]
+    plserv.delete(p_id)
+    trc, p_ids = plserv.playlists_with_song(m_id2)
+    assert trc == 200 and p_ids == []
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+
+
+def test_edit_several_songs(plserv, mserv, song1, song2, playlist1):
+    trc, m_id1 = mserv.create(song1[0], song1[1])
+    trc, m_id2 = mserv.create(song2[0], song2[1])
+    trc, p_id = plserv.create(playlist1, [m_id1])
+    unknown = '00000000-0000-4000-8000-000000000000'
+    trc, results = plserv.edit_songs(p_id, [m_id1, m_id2, unknown, m_id2])
+    assert trc == 200 and results == [(m_id1, 'duplicate'),
+                                      (m_id2, 'added'),
+                                      (unknown, 'unknown'),
+                                      (m_id2, 'duplicate')]
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plist == [m_id1, m_id2]
+    plserv.delete_song(p_id, m_id2)
+    trc, results = plserv.edit_songs(p_id, [m_id1, m_id2], add=False)
+    assert trc == 200 and results == [(m_id1, 'removed'),
+                                      (m_id2, 'absent')]
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plist == []
+    plserv.delete(p_id)
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+
+
+def test_conditional_read(plserv, mserv, song1, song2, playlist1):
+    trc, m_id1 = mserv.create(song1[0], song1[1])
+    trc, m_id2 = mserv.create(song2[0], song2[1])
+    trc, p_id = plserv.create(playlist1, [m_id1])
+    trc, etag = plserv.read_etag(p_id)
+    assert trc == 200 and etag is not None
+    trc, _ = plserv.read_etag(p_id, etag)
+    assert trc == 304
+    # Any edit changes the ETag
+    plserv.write_song(p_id, m_id2)
+    trc, etag2 = plserv.read_etag(p_id, etag)
+    assert trc == 200 and etag2 not in (None, etag)
+    plserv.delete(p_id)
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+
+
+def test_mixed_encodings(plserv, mserv, playlist_table, song1, song2,
+                         playlist1):
+    # A playlist left packed by a partial `migrate_playlists.py` run
+    # can still be edited whatever PLAYLIST_ENCODING says
+    trc, m_id1 = mserv.create(song1[0], song1[1])
+    trc, m_id2 = mserv.create(song2[0], song2[1])
+    trc, p_id = plserv.create(playlist1, [m_id1])
+    playlist_table.update_item(
+        Key={'playlist_id': p_id},
+        UpdateExpression='SET Playlist = :packed',
+        ExpressionAttributeValues={':packed': uuid.UUID(m_id1).bytes})
+    trc = plserv.write_song(p_id, m_id2)
+    assert trc == 200
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plist == [m_id1, m_id2]
+    trc = plserv.delete_song(p_id, m_id1)
+    assert trc == 200
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plist == [m_id2]
+    plserv.delete(p_id)
+    mserv.delete(m_id1)
+    mserv.delete(m_id2)
+
+
+def test_chunked_playlist(chunked_playlist_url, auth, mserv, playlist_table,
+                          song1, playlist1):
+    # The service holds at most two songs per segment
+    plserv = playlist.PlayList(chunked_playlist_url, auth)
+    m_ids = [mserv.create(song1[0], song1[1])[1] for i in range(5)]
+    trc, p_id = plserv.create(playlist1, m_ids[:3])
+    assert trc == 200
+    keys = playlist_table.get_item(Key={'playlist_id': p_id})['Item'][
+        'Segments']
+    assert len(keys) == 2
+    # Past the boundary of the last segment, which holds one song
+    trc, results = plserv.edit_songs(p_id, m_ids[3:])
+    assert trc == 200 and results == [(m_ids[3], 'added'),
+                                      (m_ids[4], 'added')]
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plname == playlist1 and plist == m_ids
+    keys = playlist_table.get_item(Key={'playlist_id': p_id})['Item'][
+        'Segments']
+    assert len(keys) == 3
+    # From the middle segment
+    trc = plserv.delete_song(p_id, m_ids[2])
+    assert trc == 200
+    trc, plname, plist = plserv.read(p_id)
+    assert trc == 200 and plist == m_ids[:2] + m_ids[3:]
+    trc, page, length = plserv.read_page(p_id, 1, 2)
+    assert trc == 200 and page == [m_ids[1], m_ids[3]] and length == 4
+    plserv.delete(p_id)
+    for key in keys:
+        assert 'Item' not in playlist_table.get_item(Key={'playlist_id': key})
+    for m_id in m_ids:
+        mserv.delete(m_id)
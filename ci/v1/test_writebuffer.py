@@ -0,0 +1,260 @@
+"""
+Test the coalescing of writes by WriteBuffer and AsyncWriteBuffer of
+the db service (db/writebuffer.py), and the response of the db
+service's `/write` when its write buffer is full.
+
+These are unit tests: the buffers write to tables of the memory
+driver rather than a running db service.
+"""
+
+# Standard libraries
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+
+# Installed packages
+import pytest
+
+# Local modules
+import aiostorage
+import storage
+import writebuffer
+
+
+class Tally():
+    """Stands in for a prometheus_client Counter."""
+    def __init__(self):
+        self.value = 0
+
+    def inc(self):
+        self.value += 1
+
+
+class RecordingTable():
+    """Passes batch_put() on to the memory driver table `table`,
+    recording the size of each batch.  While `gate` is clear, a batch
+    waits for it.  Items whose key is in `failing` are left unwritten,
+    and if `error` is set every batch raises it."""
+    def __init__(self, table):
+        self.table = table
+        self.name = table.name
+        self.key = table.key
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failing = set()
+        self.error = None
+
+    def batch_put(self, items):
+        self.batches.append(len(items))
+        self.gate.wait(5)
+        rest, failed = self.split(items)
+        failed.update(self.table.batch_put(rest))
+        return failed
+
+    def split(self, items):
+        """Return the items to write and the reasons for the others."""
+        if self.error is not None:
+            raise self.error
+        return ([i for i in items if i[self.key] not in self.failing],
+                {i[self.key]: 'throttled' for i in items
+                 if i[self.key] in self.failing})
+
+
+class AsyncRecordingTable(RecordingTable):
+    """RecordingTable of an aiostorage table."""
+    async def batch_put(self, items):
+        self.batches.append(len(items))
+        while not self.gate.is_set():
+            await asyncio.sleep(0.001)
+        rest, failed = self.split(items)
+        failed.update(await self.table.batch_put(rest))
+        return failed
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def item(key):
+    return {'music_id': key, 'Artist': 'Artist ' + key}
+
+
+@pytest.fixture
+def table():
+    return RecordingTable(storage.MemoryDriver().table('Music', 'music_id'))
+
+
+@pytest.fixture
+def async_table():
+    return AsyncRecordingTable(
+        aiostorage.MemoryDriver().table('Music', 'music_id'))
+
+
+def put_all(buffer, table, keys):
+    """put() the item of each of `keys` from a thread of its own and
+    return a dict mapping each key to None or the exception raised."""
+    results = {}
+
+    def put(key):
+        try:
+            results[key] = buffer.put(table, item(key))
+        except Exception as e:
+            results[key] = e
+
+    threads = [threading.Thread(target=put, args=(k,)) for k in keys]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_writes_are_coalesced(table):
+    # A full batch is written without waiting for the window
+    buffer = writebuffer.WriteBuffer(5, max_items=5)
+    results = put_all(buffer, table, [str(i) for i in range(10)])
+    assert results == {str(i): None for i in range(10)}
+    assert table.batches == [5, 5]
+    assert table.table.get('7')['Artist'] == 'Artist 7'
+
+
+def test_failed_item_resolves_every_caller(table):
+    buffer = writebuffer.WriteBuffer(5, max_items=4)
+    table.failing.add('2')
+    results = put_all(buffer, table, ['0', '1', '2', '3'])
+    assert table.batches == [4]
+    assert isinstance(results.pop('2'), writebuffer.WriteFailed)
+    assert results == {'0': None, '1': None, '3': None}
+    assert table.table.get('2') is None
+
+
+def test_failed_batch_resolves_every_caller(table):
+    buffer = writebuffer.WriteBuffer(5, max_items=4)
+    table.error = RuntimeError('datastore down')
+    results = put_all(buffer, table, ['0', '1', '2', '3'])
+    assert all(isinstance(r, RuntimeError) for r in results.values())
+
+
+def test_full_queue(table):
+    rejected = Tally()
+    buffer = writebuffer.WriteBuffer(0.001, max_queue=1, queue_timeout=0.05,
+                                     rejected=rejected)
+    table.gate.clear()
+    first = threading.Thread(target=buffer.put, args=(table, item('0')))
+    first.start()
+    wait_until(lambda: table.batches)
+    with pytest.raises(writebuffer.QueueFull):
+        buffer.put(table, item('1'))
+    assert rejected.value == 1 and buffer.depth() == 1
+    table.gate.set()
+    first.join(5)
+    assert buffer.depth() == 0
+
+
+def test_async_writes_are_coalesced(async_table):
+    async def main():
+        buffer = writebuffer.AsyncWriteBuffer(0.01)
+        return await asyncio.gather(
+            *[buffer.put(async_table, item(str(i))) for i in range(30)])
+
+    assert asyncio.run(main()) == [None] * 30
+    assert async_table.batches == [25, 5]
+
+
+def test_async_failed_item_resolves_every_caller(async_table):
+    async def main():
+        buffer = writebuffer.AsyncWriteBuffer(0.01)
+        return await asyncio.gather(
+            *[buffer.put(async_table, item(k)) for k in '0123'],
+            return_exceptions=True)
+
+    async_table.failing.add('2')
+    results = asyncio.run(main())
+    assert async_table.batches == [4]
+    assert isinstance(results.pop(2), writebuffer.WriteFailed)
+    assert results == [None, None, None]
+
+
+def test_async_failed_batch_resolves_every_caller(async_table):
+    async def main():
+        buffer = writebuffer.AsyncWriteBuffer(0.01)
+        return await asyncio.gather(
+            *[buffer.put(async_table, item(k)) for k in '0123'],
+            return_exceptions=True)
+
+    async_table.error = RuntimeError('datastore down')
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_async_full_queue(async_table):
+    rejected = Tally()
+
+    async def main():
+        buffer = writebuffer.AsyncWriteBuffer(0.001, max_queue=1,
+                                              queue_timeout=0.05,
+                                              rejected=rejected)
+        async_table.gate.clear()
+        first = asyncio.ensure_future(buffer.put(async_table, item('0')))
+        while not async_table.batches:
+            await asyncio.sleep(0.001)
+        with pytest.raises(writebuffer.QueueFull):
+            await buffer.put(async_table, item('1'))
+        depth = buffer.depth()
+        async_table.gate.set()
+        await first
+        return depth, buffer.depth()
+
+    assert asyncio.run(main()) == (1, 0)
+    assert rejected.value == 1
+
+
+@pytest.fixture(scope='module')
+def db_app():
+    """Return the db service's app module, with the memory driver and
+    a write buffer with room for one item, for which a write waits
+    at most 50 ms."""
+    env = {'DB_DRIVER': 'memory',
+           'DB_WRITE_BATCH_WINDOW_MS': '1',
+           'DB_WRITE_QUEUE_MAX': '1',
+           'DB_WRITE_QUEUE_TIMEOUT_SEC': '0.05'}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            'db_app', os.path.join(os.path.dirname(writebuffer.__file__),
+                                   'app-tpl.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+    return module
+
+
+def test_write_with_full_buffer(db_app, monkeypatch):
+    music = RecordingTable(db_app.tables['music'])
+    music.gate.clear()
+    monkeypatch.setitem(db_app.tables, 'music', music)
+    url = '/api/v1/datastore/write'
+    body = {'objtype': 'music', 'Artist': 'A', 'SongTitle': 'B'}
+    responses = []
+    first = threading.Thread(target=lambda: responses.append(
+        db_app.app.test_client().post(url, json=body)))
+    first.start()
+    wait_until(lambda: music.batches)
+    response = db_app.app.test_client().post(url, json=body)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    music.gate.set()
+    first.join(5)
+    assert responses[0].status_code == 200
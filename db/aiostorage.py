@@ -0,0 +1,459 @@
+"""
+Asynchronous storage drivers for the asyncio database service.
+
+These mirror storage.py: a driver hands out Table objects whose
+methods have the same arguments, results and exceptions as those of
+storage.Table, but are coroutines.
+
+* DynamoDBDriver: Amazon DynamoDB through an aiobotocore client.  The
+  client's connection pool (AioConfig.max_pool_connections) bounds the
+  calls in flight; further calls wait for a free connection.
+* MemoryDriver: storage.MemoryDriver's tables, which never wait on
+  I/O and so are called directly from the event loop.
+
+The aiobotocore client speaks DynamoDB's typed wire format
+({"S": ...}, {"N": ...}), so items are converted with boto3's
+TypeSerializer and TypeDeserializer: tables accept and return the
+same Python values as the boto3 resource used by storage.py.
+"""
+
+# Standard library modules
+import asyncio
+import functools
+import random
+
+# Installed packages
+from boto3.dynamodb.types import TypeDeserializer
+from boto3.dynamodb.types import TypeSerializer
+
+from botocore.exceptions import ClientError
+
+# Local modules
+import storage
+from storage import ConditionFailed
+from storage import ItemNotFound
+from storage import VERSION_ATTR
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def serialize(item):
+    '''Return the dict `item` in DynamoDB's typed wire format'''
+    return {a: _serializer.serialize(v) for a, v in item.items()}
+
+
+def deserialize(item):
+    '''Return the dict of typed wire values `item` as Python values'''
+    return {a: _deserializer.deserialize(v) for a, v in item.items()}
+
+
+async def backoff(attempt):
+    '''Sleep before retry number `attempt`; see storage.backoff()'''
+    delay = min(storage.BATCH_BACKOFF_MAX_SEC,
+                storage.BATCH_BACKOFF_BASE_SEC * (2 ** attempt))
+    await asyncio.sleep(random.uniform(0, delay))
+
+
+def condition_failed(e):
+    '''Return True if the ClientError `e` reports a failed condition'''
+    return e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class Table():
+    """Interface to one table of a storage backend.
+
+    Every method is a coroutine with the arguments, result and
+    exceptions of the storage.Table method of the same name.
+    """
+    def __init__(self, name, key, indexes=None):
+        self.name = name
+        self.key = key
+        self.indexes = dict(indexes or {})
+
+    async def get(self, key, fields=None, consistent=False):
+        raise NotImplementedError
+
+    async def put(self, item):
+        raise NotImplementedError
+
+    async def update(self, key, values):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def list_append(self, key, attr, values):
+        raise NotImplementedError
+
+    async def list_remove(self, key, attr, values):
+        raise NotImplementedError
+
+    async def replace(self, key, attr, expected, value, others=None):
+        raise NotImplementedError
+
+    async def set_add(self, key, attr, values):
+        raise NotImplementedError
+
+    async def set_remove(self, key, attr, values):
+        raise NotImplementedError
+
+    async def batch_get(self, keys):
+        raise NotImplementedError
+
+    async def batch_put(self, items):
+        raise NotImplementedError
+
+    async def scan(self, limit=None, start_key=None, segment=0,
+                   total_segments=1):
+        raise NotImplementedError
+
+    async def query(self, index, value, prefix=None, limit=None,
+                    start_key=None):
+        raise NotImplementedError
+
+
+class DynamoDBTable(Table):
+    """Table stored in DynamoDB.
+
+    Parameters
+    ----------
+    client: aiobotocore DynamoDB client
+    name, key, indexes: see storage.Table.
+    """
+    def __init__(self, client, name, key, indexes=None):
+        super().__init__(name, key, indexes)
+        self._client = client
+        self._update_expression = functools.lru_cache(maxsize=256)(
+            storage.update_expression)
+        self._projection_expression = functools.lru_cache(maxsize=256)(
+            storage.projection_expression)
+
+    def _key(self, key):
+        return {self.key: _serializer.serialize(key)}
+
+    async def _update(self, key, **kwargs):
+        if 'ExpressionAttributeValues' in kwargs:
+            kwargs['ExpressionAttributeValues'] = serialize(
+                kwargs['ExpressionAttributeValues'])
+        return await self._client.update_item(
+            TableName=self.name, Key=self._key(key), **kwargs)
+
+    async def get(self, key, fields=None, consistent=False):
+        kwargs = {'TableName': self.name, 'Key': self._key(key),
+                  'ConsistentRead': consistent}
+        if fields is not None:
+            if self.key not in fields:
+                fields = (self.key,) + tuple(fields)
+            expression, names = self._projection_expression(fields)
+            kwargs['ProjectionExpression'] = expression
+            kwargs['ExpressionAttributeNames'] = names
+        item = (await self._client.get_item(**kwargs)).get('Item')
+        return None if item is None else deserialize(item)
+
+    async def put(self, item):
+        await self._client.put_item(TableName=self.name,
+                                    Item=serialize(storage.versioned(item)))
+
+    async def update(self, key, values):
+        values = storage.versioned(values)
+        attrs = tuple(sorted(values))
+        expression, names = self._update_expression(attrs)
+        attrvals = {':v{}'.format(i): values[a] for i, a in enumerate(attrs)}
+        return await self._update(key,
+                                  UpdateExpression=expression,
+                                  ExpressionAttributeNames=names,
+                                  ExpressionAttributeValues=attrvals)
+
+    async def delete(self, key):
+        return await self._client.delete_item(TableName=self.name,
+                                              Key=self._key(key))
+
+    async def list_append(self, key, attr, values):
+        names = {'#a': attr, '#ver': VERSION_ATTR}
+        attrvals = {':new': list(values), ':ver': storage.new_version()}
+        conditions = ['attribute_exists(#a)']
+        for i, v in enumerate(values):
+            attrvals[':v{}'.format(i)] = v
+            conditions.append('NOT contains(#a, :v{})'.format(i))
+        try:
+            return await self._update(
+                key,
+                UpdateExpression=(
+                    'SET #a = list_append(#a, :new), #ver = :ver'),
+                ConditionExpression=' AND '.join(conditions),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=attrvals)
+        except ClientError as e:
+            # An attribute of another type fails validation
+            error = e
+            if not condition_failed(e) and e.response['Error']['Code'] != (
+                    'ValidationException'):
+                raise
+        item = await self.get(key, fields=(attr,), consistent=True)
+        if item is None or attr not in item:
+            raise ItemNotFound(key)
+        storage.check_list(item, attr)
+        if not condition_failed(error):
+            raise error
+        present = set(item[attr])
+        raise ConditionFailed([v for v in values if v in present])
+
+    async def list_remove(self, key, attr, values):
+        # As storage.DynamoDBTable.list_remove(): remove by index,
+        # conditional on the indexes still holding the values
+        for attempt in range(storage.LIST_RETRIES):
+            item = await self.get(key, fields=(attr,), consistent=True)
+            if item is None or attr not in item:
+                raise ItemNotFound(key)
+            storage.check_list(item, attr)
+            positions = {}
+            for i, v in enumerate(item[attr]):
+                positions.setdefault(v, i)
+            missing = [v for v in values if v not in positions]
+            if missing:
+                raise ConditionFailed(missing)
+            indexes = [positions[v] for v in values]
+            attrvals = {':v{}'.format(n): v for n, v in enumerate(values)}
+            attrvals[':ver'] = storage.new_version()
+            try:
+                return await self._update(
+                    key,
+                    UpdateExpression='REMOVE ' + ', '.join(
+                        '#a[{}]'.format(i) for i in indexes) + (
+                        ' SET #ver = :ver'),
+                    ConditionExpression=' AND '.join(
+                        '#a[{}] = :v{}'.format(i, n)
+                        for n, i in enumerate(indexes)),
+                    ExpressionAttributeNames={'#a': attr,
+                                              '#ver': VERSION_ATTR},
+                    ExpressionAttributeValues=attrvals)
+            except ClientError as e:
+                if not condition_failed(e):
+                    raise
+            await backoff(attempt)
+        raise ConditionFailed([])
+
+    async def replace(self, key, attr, expected, value, others=None):
+        names = {'#k': self.key, '#a': attr}
+        attrvals = {':new': value}
+        update = 'SET #a = :new'
+        others = storage.versioned(others or {})
+        for i, (a, v) in enumerate(sorted(others.items())):
+            names['#o{}'.format(i)] = a
+            attrvals[':o{}'.format(i)] = v
+            update += ', #o{0} = :o{0}'.format(i)
+        if expected is None:
+            condition = 'attribute_exists(#k) AND attribute_not_exists(#a)'
+        else:
+            condition = 'attribute_exists(#k) AND #a = :old'
+            attrvals[':old'] = expected
+        try:
+            return await self._update(key,
+                                      UpdateExpression=update,
+                                      ConditionExpression=condition,
+                                      ExpressionAttributeNames=names,
+                                      ExpressionAttributeValues=attrvals)
+        except ClientError as e:
+            if not condition_failed(e):
+                raise
+        if await self.get(key, fields=(self.key,), consistent=True) is None:
+            raise ItemNotFound(key)
+        raise ConditionFailed([])
+
+    async def set_add(self, key, attr, values):
+        return await self._update(
+            key,
+            UpdateExpression='ADD #a :v SET #ver = :ver',
+            ExpressionAttributeNames={'#a': attr, '#ver': VERSION_ATTR},
+            ExpressionAttributeValues={':v': set(values),
+                                       ':ver': storage.new_version()})
+
+    async def set_remove(self, key, attr, values):
+        try:
+            return await self._update(
+                key,
+                UpdateExpression='DELETE #a :v SET #ver = :ver',
+                ConditionExpression='attribute_exists(#k)',
+                ExpressionAttributeNames={'#k': self.key, '#a': attr,
+                                          '#ver': VERSION_ATTR},
+                ExpressionAttributeValues={':v': set(values),
+                                           ':ver': storage.new_version()})
+        except ClientError as e:
+            if not condition_failed(e):
+                raise
+        return storage.OK_RESPONSE
+
+    async def batch_get(self, keys):
+        items = []
+        unprocessed = []
+        for i in range(0, len(keys), storage.BATCH_GET_SIZE):
+            pending = [self._key(k)
+                       for k in keys[i:i+storage.BATCH_GET_SIZE]]
+            attempt = 0
+            while pending:
+                response = await self._client.batch_get_item(
+                    RequestItems={self.name: {'Keys': pending}})
+                items.extend(deserialize(item) for item in
+                             response['Responses'].get(self.name, []))
+                pending = (response.get('UnprocessedKeys', {})
+                           .get(self.name, {})
+                           .get('Keys', []))
+                if not pending:
+                    break
+                if attempt >= storage.BATCH_RETRIES:
+                    unprocessed.extend(deserialize(k)[self.key]
+                                       for k in pending)
+                    break
+                await backoff(attempt)
+                attempt += 1
+        return items, unprocessed
+
+    async def batch_put(self, items):
+        failed = {}
+        for chunk in storage.dedup_chunks(items, self.key,
+                                          storage.BATCH_WRITE_SIZE):
+            pending = [{'PutRequest': {'Item': serialize(
+                storage.versioned(item))}} for item in chunk]
+            try:
+                attempt = 0
+                while pending:
+                    response = await self._client.batch_write_item(
+                        RequestItems={self.name: pending})
+                    pending = (response.get('UnprocessedItems', {})
+                               .get(self.name, []))
+                    if not pending or attempt >= storage.BATCH_RETRIES:
+                        break
+                    await backoff(attempt)
+                    attempt += 1
+            except ClientError as e:
+                reason = e.response['Error']['Message']
+                failed.update((item[self.key], reason) for item in chunk)
+                continue
+            for put in pending:
+                key = _deserializer.deserialize(
+                    put['PutRequest']['Item'][self.key])
+                failed[key] = 'Unprocessed after retries'
+        return failed
+
+    async def scan(self, limit=None, start_key=None, segment=0,
+                   total_segments=1):
+        kwargs = {'TableName': self.name}
+        if limit is not None:
+            kwargs['Limit'] = limit
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = self._key(start_key)
+        if total_segments > 1:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = total_segments
+        response = await self._client.scan(**kwargs)
+        last = response.get('LastEvaluatedKey')
+        return ([deserialize(item) for item in response['Items']],
+                None if last is None else deserialize(last)[self.key])
+
+    async def query(self, index, value, prefix=None, limit=None,
+                    start_key=None):
+        partition, sort = self.indexes[index]
+        names = {'#p': partition}
+        attrvals = {':p': value}
+        condition = '#p = :p'
+        if prefix is not None:
+            names['#s'] = sort
+            attrvals[':s'] = prefix
+            condition += ' AND begins_with(#s, :s)'
+        kwargs = {'TableName': self.name, 'IndexName': index,
+                  'KeyConditionExpression': condition,
+                  'ExpressionAttributeNames': names,
+                  'ExpressionAttributeValues': serialize(attrvals)}
+        if limit is not None:
+            kwargs['Limit'] = limit
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = serialize(start_key)
+        response = await self._client.query(**kwargs)
+        last = response.get('LastEvaluatedKey')
+        return ([deserialize(item) for item in response['Items']],
+                None if last is None else deserialize(last))
+
+
+class DynamoDBDriver():
+    """Driver for DynamoDB.
+
+    Parameters
+    ----------
+    client: aiobotocore DynamoDB client
+        Open for as long as the driver's tables are used.
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name, key, indexes=None):
+        """Return the Table `name` with key attribute `key` and
+        secondary `indexes`, which must exist in DynamoDB."""
+        return DynamoDBTable(self._client, name, key, indexes)
+
+
+class SyncTable(Table):
+    """Table that calls a storage.Table that never blocks, such as
+    a storage.MemoryTable, from the event loop.
+
+    Parameters
+    ----------
+    table: storage.Table
+    """
+    def __init__(self, table):
+        super().__init__(table.name, table.key, table.indexes)
+        self.table = table
+
+    async def get(self, key, fields=None, consistent=False):
+        return self.table.get(key, fields=fields, consistent=consistent)
+
+    async def put(self, item):
+        return self.table.put(item)
+
+    async def update(self, key, values):
+        return self.table.update(key, values)
+
+    async def delete(self, key):
+        return self.table.delete(key)
+
+    async def list_append(self, key, attr, values):
+        return self.table.list_append(key, attr, values)
+
+    async def list_remove(self, key, attr, values):
+        return self.table.list_remove(key, attr, values)
+
+    async def replace(self, key, attr, expected, value, others=None):
+        return self.table.replace(key, attr, expected, value, others)
+
+    async def set_add(self, key, attr, values):
+        return self.table.set_add(key, attr, values)
+
+    async def set_remove(self, key, attr, values):
+        return self.table.set_remove(key, attr, values)
+
+    async def batch_get(self, keys):
+        return self.table.batch_get(keys)
+
+    async def batch_put(self, items):
+        return self.table.batch_put(items)
+
+    async def scan(self, limit=None, start_key=None, segment=0,
+                   total_segments=1):
+        return self.table.scan(limit=limit, start_key=start_key,
+                               segment=segment,
+                               total_segments=total_segments)
+
+    async def query(self, index, value, prefix=None, limit=None,
+                    start_key=None):
+        return self.table.query(index, value, prefix=prefix, limit=limit,
+                                start_key=start_key)
+
+
+class MemoryDriver():
+    """Driver for tables held in this process (see storage.MemoryDriver)."""
+    def __init__(self):
+        self._driver = storage.MemoryDriver()
+
+    def table(self, name, key, indexes=None):
+        """Return the Table `name`, creating an empty table on first use."""
+        return SyncTable(self._driver.table(name, key, indexes))
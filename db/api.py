@@ -0,0 +1,451 @@
+"""
+The datastore API, apart from the web framework that serves it.
+
+app.py (Flask) and asgi.py (Quart) serve the same routes.  What the
+two share is here: the settings of the API, the parsing and checking
+of each request and the bodies of the responses.  A route of either
+version parses its request with this module, calls its storage table
+(awaiting the call in asgi.py) and answers with a body built here, so
+the versions differ only in those calls and in how they wrap a body
+in a response.
+
+Parsers raise BadRequest, which a route answers with the 400 body of
+error_body().  Functions taking `tables` look the objtype up in that
+dict of objtype -> storage table.
+"""
+
+# Standard library modules
+import base64
+import os
+import time
+import urllib.parse
+import uuid
+
+# Installed packages
+import simplejson as json
+
+# Local modules
+import storage
+
+# Must be presented to authorize call to `/load`
+loader_token = os.getenv('SVC_LOADER_TOKEN')
+
+# Upper bound on the number of keys accepted by one `/batch_read`
+batch_read_max_keys = int(os.getenv('BATCH_READ_MAX_KEYS', '1000'))
+
+# Upper bound on the number of records accepted by one `/batch_load`
+batch_load_max_records = int(os.getenv('BATCH_LOAD_MAX_RECORDS', '5000'))
+
+# Page size of `/scan` when the caller does not give one, and its maximum
+scan_default_limit = int(os.getenv('SCAN_DEFAULT_LIMIT', '100'))
+scan_max_limit = int(os.getenv('SCAN_MAX_LIMIT', '1000'))
+
+# Directory holding the files written by `/export` and read by `/import`
+snapshot_dir = os.getenv('DB_SNAPSHOT_DIR', '/tmp/snapshots')
+SNAPSHOT_MAX_SEGMENTS = 64
+
+# The object types stored by this service.  Each is held in the
+# table "<Objtype>-<registry id>" with key attribute "<objtype>_id".
+# A songindex item is keyed by a music_id and lists the playlists
+# holding that song; the playlist service maintains it.
+OBJTYPES = ('user', 'music', 'playlist', 'songindex')
+
+# Every write sets an item's storage.VERSION_ATTR to a new token,
+# overriding any value in the request; services derive ETags from it
+VERSION_MAINTAINED = 'The {} attribute is maintained by the datastore'.format(
+    storage.VERSION_ATTR)
+
+# Secondary indexes served by `/query`: objtype -> {index name:
+# (partition key, sort key)}.  For DynamoDB they must also be declared
+# on the tables (see ci/v1/create_tables.py and
+# cluster/cloudformationdynamodb-tpl.json).
+INDEXES = {
+    'music': {'Artist-index': ('Artist', 'SongTitle')},
+}
+
+
+class BadRequest(Exception):
+    """The request is malformed.  str() gives the reason."""
+
+
+def error_body(status, reason):
+    '''Return the body of an error response in the format of the
+    `/load` errors'''
+    return {"http_status_code": status, "reason": reason}
+
+
+def not_found_body(objtype, objkey):
+    '''Return the 404 body for an update of an absent item'''
+    return error_body(404, "No {} {}".format(objtype, objkey))
+
+
+def conflict_body(values):
+    '''Return the 409 body for a conditional update whose condition
+    failed on `values`'''
+    body = error_body(409, "Condition failed")
+    body['values'] = values
+    return body
+
+
+def unauthorized_body(route):
+    '''Return the 401 body for a call to `route` that load_auth()
+    rejects'''
+    return error_body(401, "Invalid authorization for /{}".format(route))
+
+
+def objtable(tables, objtype):
+    '''Return the table holding objects of `objtype`'''
+    table = tables.get(objtype)
+    if table is None:
+        raise BadRequest('Unknown objtype {}'.format(objtype))
+    return table
+
+
+def item_ref(args):
+    '''Return the (objtype, objkey) named in the query `args`'''
+    return (urllib.parse.unquote_plus(args.get('objtype', '')),
+            urllib.parse.unquote_plus(args.get('objkey', '')))
+
+
+def from_wire(content):
+    '''Return the attributes of a request body with their binary
+    values decoded'''
+    try:
+        return storage.from_wire(content)
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+
+def list_update(table, content):
+    '''Return the (attr, values) of a `/append` or `/remove` body'''
+    try:
+        attr = content['attr']
+        values = list(dict.fromkeys(content['values']))
+    except (KeyError, TypeError):
+        raise BadRequest('Missing attr or values')
+    if not values:
+        raise BadRequest('values must be a non-empty list')
+    if len(values) > storage.LIST_MAX_VALUES:
+        raise BadRequest(
+            'At most {} values per call'.format(storage.LIST_MAX_VALUES))
+    if attr == table.key:
+        raise BadRequest('The key attribute is not a list')
+    if attr == storage.VERSION_ATTR:
+        raise BadRequest(VERSION_MAINTAINED)
+    return attr, values
+
+
+def set_update(table, content):
+    '''Return the (objkeys, attr, values) of a `/set_add` or
+    `/set_remove` body'''
+    try:
+        objkeys = list(dict.fromkeys(k for k in content['objkeys'] if k))
+        attr = content['attr']
+        values = list(dict.fromkeys(content['values']))
+    except (KeyError, TypeError):
+        raise BadRequest('Missing objkeys, attr or values')
+    if len(objkeys) > batch_read_max_keys:
+        raise BadRequest(
+            'At most {} objkeys per call'.format(batch_read_max_keys))
+    if not values or not all(isinstance(v, str) for v in values):
+        raise BadRequest('values must be a non-empty list of strings')
+    if attr == table.key:
+        raise BadRequest('The key attribute is not a set')
+    if attr == storage.VERSION_ATTR:
+        raise BadRequest(VERSION_MAINTAINED)
+    return objkeys, attr, values
+
+
+def replacement(table, content):
+    '''Return the (attr, expected, value, others) of a `/replace` body'''
+    try:
+        attr = content['attr']
+        values = storage.from_wire({'expected': content['expected'],
+                                    'value': content['value']})
+        others = storage.from_wire(content.get('others', {}))
+    except (KeyError, TypeError, AttributeError):
+        raise BadRequest('Missing attr, expected or value')
+    except ValueError as e:
+        raise BadRequest(str(e))
+    if attr == table.key or table.key in others:
+        raise BadRequest('The key attribute cannot be replaced')
+    if attr in others:
+        raise BadRequest('others must not include attr')
+    if attr == storage.VERSION_ATTR:
+        raise BadRequest(VERSION_MAINTAINED)
+    return attr, values['expected'], values['value'], others
+
+
+def read_options(args):
+    '''Return the (fields, consistent) of a `/read` query.  `fields`
+    is a tuple of attribute names, or None for all of them.'''
+    fields = args.get('fields')
+    if fields is not None:
+        fields = tuple(dict.fromkeys(
+            f.strip() for f in fields.split(',') if f.strip()))
+    return fields, args.get('consistent', '').lower() == 'true'
+
+
+def read_body(table, item, fields=None):
+    '''Return `item` (or None), with only the key and `fields` if
+    they are given, in the format of a DynamoDB query response'''
+    if item is None:
+        items = []
+    elif fields is None:
+        items = [storage.to_wire(item)]
+    else:
+        items = [storage.to_wire(
+            storage.project(item, (table.key,) + tuple(fields)))]
+    return {"Items": items, "Count": len(items), "ScannedCount": len(items)}
+
+
+def batch_read_request(content):
+    '''Return the (objtype, objkeys, fields) of a `/batch_read` body'''
+    try:
+        objtype = content['objtype']
+        objkeys = content['objkeys']
+    except (KeyError, TypeError):
+        raise BadRequest('Missing objtype or objkeys')
+    if not isinstance(objkeys, list):
+        raise BadRequest('objkeys must be a list')
+    if len(objkeys) > batch_read_max_keys:
+        raise BadRequest(
+            'At most {} objkeys per call'.format(batch_read_max_keys))
+    fields = content.get('fields')
+    if fields is not None and not isinstance(fields, list):
+        raise BadRequest('fields must be a list')
+    return objtype, objkeys, fields
+
+
+def cached_items(cache, table, objkeys):
+    '''
+    Look the distinct `objkeys` of a `/batch_read` up in `cache`
+
+    Returns (items, tokens): the cached items, and a dict mapping
+    each key to fetch to its cache token.
+    '''
+    items = []
+    tokens = {}
+    # Keys cannot be empty, so an empty objkey matches nothing
+    for k in dict.fromkeys(k for k in objkeys if k != ''):
+        found, item, token = cache.lookup((table.name, k))
+        if not found:
+            tokens[k] = token
+        elif item is not None:
+            items.append(item)
+    return items, tokens
+
+
+def fill_fetched(cache, table, items, tokens, fetched, unprocessed):
+    '''Add the items `fetched` for the keys of `tokens` (see
+    cached_items()) to `items` and to `cache`, and cache the absence
+    of the keys that have none'''
+    for item in fetched:
+        items.append(item)
+        k = item[table.key]
+        cache.fill((table.name, k), item, tokens.pop(k))
+    # Remaining tokens are keys with no item (or still unprocessed)
+    for k in set(tokens) - set(unprocessed):
+        cache.fill((table.name, k), None, tokens[k])
+
+
+def batch_read_body(table, items, unprocessed, fields):
+    '''Return the `/batch_read` body of `items`, with only the key
+    and the list `fields` if it is not None'''
+    if fields is not None:
+        fields = (table.key,) + tuple(fields)
+        items = [storage.project(item, fields) for item in items]
+    return {"Items": [storage.to_wire(item) for item in items],
+            "Count": len(items),
+            "UnprocessedKeys": unprocessed}
+
+
+def encode_cursor(key):
+    '''Return the opaque `/scan` or `/query` cursor that continues
+    after `key`'''
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Return the key encoded in a `/scan` or `/query` cursor'''
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+
+def page_request(args):
+    '''Return the (limit, start_key) of a `/scan` or `/query` query'''
+    try:
+        limit = int(args.get('limit', scan_default_limit))
+        cursor = args.get('cursor')
+        start_key = None if cursor is None else decode_cursor(cursor)
+    except ValueError:
+        raise BadRequest('Invalid limit or cursor')
+    if limit < 1 or limit > scan_max_limit:
+        raise BadRequest(
+            'limit must be between 1 and {}'.format(scan_max_limit))
+    return limit, start_key
+
+
+def query_request(table, args):
+    '''Return the (index, key, prefix, limit, start_key) of a `/query`
+    query'''
+    index = args.get('index', '')
+    if index not in table.indexes:
+        raise BadRequest('Unknown index {} of {}'.format(
+            index, args.get('objtype', '')))
+    if 'key' not in args:
+        raise BadRequest('Missing key')
+    limit, start_key = page_request(args)
+    if start_key is not None and not isinstance(start_key, dict):
+        raise BadRequest('Invalid limit or cursor')
+    return index, args['key'], args.get('prefix'), limit, start_key
+
+
+def page_body(table, items, last_key, args):
+    '''Return a `/scan` or `/query` page, keeping only the `fields`
+    named in the query `args`'''
+    fields = args.get('fields')
+    if fields is not None:
+        fields = (table.key,) + tuple(
+            f.strip() for f in fields.split(',') if f.strip())
+        items = [storage.project(item, fields) for item in items]
+    return {"Items": [storage.to_wire(item) for item in items],
+            "Count": len(items),
+            "Cursor": encode_cursor(last_key)}
+
+
+def write_payload(table, content):
+    '''Return the item of a `/write` body, under a new key.  Removes
+    "objtype" from `content`.'''
+    payload = {table.key: str(uuid.uuid4())}
+    del content['objtype']
+    for k in content.keys():
+        payload[k] = content[k]
+    return from_wire(payload)
+
+
+def written_body(table, item):
+    '''Return the body answering the write of `item`'''
+    return json.dumps({table.key: item[table.key]})
+
+
+def decode_auth_token(token):
+    '''Given an auth token in Base64 encoding, return the original string'''
+    return base64.standard_b64decode(token).decode()
+
+
+def load_auth(headers):
+    '''Return True if caller authorized to do a `/load` '''
+    if 'Authorization' not in headers:
+        return False
+    # Auth string is 'Basic ' concatenated with base64 encoding of uname:passwd
+    auth_string = headers['Authorization'].split()[1]
+    name, pwd = decode_auth_token(auth_string).split(':')
+    if name != 'svc-loader' or pwd != loader_token:
+        return False
+    return True
+
+
+def load_payload(tables, content):
+    '''
+    Convert a `/load` record into (table, item)
+
+    The record's "objtype" selects the table and its "uuid" becomes
+    the key; every other field is copied into the item, decoding
+    binary values.  Raises BadRequest if the objtype is unknown or a
+    binary value is malformed.
+    '''
+    table = objtable(tables, content['objtype'])
+    payload = {table.key: content['uuid']}
+    for k in content.keys():
+        if k not in ('objtype', 'uuid'):
+            payload[k] = content[k]
+    return table, from_wire(payload)
+
+
+def load_batches(tables, records):
+    '''
+    Sort the records of a `/batch_load` body by table
+
+    Returns (results, batches).  `results` holds one entry per
+    record, the error body of each rejected record and None for the
+    others.  `batches` maps each table name to (table, [(index,
+    item), ...]) for the accepted records.
+    '''
+    if not isinstance(records, list):
+        raise BadRequest('Body must be a list of records')
+    if len(records) > batch_load_max_records:
+        raise BadRequest(
+            'At most {} records per call'.format(batch_load_max_records))
+    results = [None] * len(records)
+    batches = {}
+    for index, content in enumerate(records):
+        if (not isinstance(content, dict) or 'uuid' not in content or
+                'objtype' not in content):
+            results[index] = error_body(400, 'Missing uuid or objtype')
+            continue
+        try:
+            table, payload = load_payload(tables, content)
+        except BadRequest as e:
+            results[index] = error_body(400, str(e))
+            continue
+        batches.setdefault(table.name, (table, []))[1].append(
+            (index, payload))
+    return results, batches
+
+
+def record_loaded(results, table, batch, failed):
+    '''Enter in `results` the outcome of writing `batch`, one of the
+    batches of load_batches(), whose batch_put() left `failed`'''
+    for index, item in batch:
+        key = item[table.key]
+        if key in failed:
+            results[index] = error_body(500, failed[key])
+        else:
+            results[index] = {table.key: key}
+
+
+def batch_load_body(results):
+    '''Return the `/batch_load` body listing `results`'''
+    failed = sum(1 for r in results if 'http_status_code' in r)
+    return {"Results": results,
+            "Succeeded": len(results) - failed,
+            "Failed": failed}
+
+
+def snapshot_path(content, objtype):
+    '''Return the path of the snapshot file named in a request
+    (or a fresh name for `objtype`), confined to snapshot_dir'''
+    name = content.get('file')
+    if name is None:
+        name = '{}-{}.ndjson.gz'.format(
+            objtype, time.strftime('%Y%m%dT%H%M%S', time.gmtime()))
+    return os.path.join(snapshot_dir, os.path.basename(name))
+
+
+def export_request(tables, content):
+    '''Return the (objtype, segments, path) of an `/export` body and
+    create snapshot_dir'''
+    objtype = content.get('objtype')
+    objtable(tables, objtype)
+    segments = content.get('segments', 4)
+    if not isinstance(segments, int) or not (
+            1 <= segments <= SNAPSHOT_MAX_SEGMENTS):
+        raise BadRequest('segments must be between 1 and {}'.format(
+            SNAPSHOT_MAX_SEGMENTS))
+    path = snapshot_path(content, objtype)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    return objtype, segments, path
+
+
+def import_request(tables, content):
+    '''Return the (objtype, path) of an `/import` body'''
+    objtype = content.get('objtype')
+    objtable(tables, objtype)
+    if 'file' not in content:
+        raise BadRequest('Missing file')
+    path = snapshot_path(content, objtype)
+    if not os.path.isfile(path):
+        raise BadRequest('No snapshot {}'.format(content['file']))
+    return objtype, path
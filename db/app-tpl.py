@@ -4,32 +4,40 @@ Sample application---database service.
 """
 
 # Standard library modules
-import base64
+import concurrent.futures
 import logging
 import os
 import sys
-import urllib.parse
-import uuid
 
 # Installed packages
 
 import boto3
-from boto3.dynamodb.conditions import Key
 
 from flask import Blueprint
 from flask import Flask
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
 
 import simplejson as json
 
+# Local modules
+import api
+from cache import ItemCache
+from cache import SingleFlight
+import serving
+import snapshot
+import storage
+import writebuffer
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = serving.flask_metrics(app)
 metrics.info('app_info', 'Database process')
 
 bp = Blueprint('app', __name__)
@@ -42,67 +50,401 @@ region = os.getenv('AWS_REGION', 'us-east-1')
 access_key = os.getenv('AWS_ACCESS_KEY_ID')
 secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
 
-# Must be presented to authorize call to `/load`
-loader_token = os.getenv('SVC_LOADER_TOKEN')
+snapshot_items = Counter(
+    'db_snapshot_items', 'Items exported to or imported from snapshots',
+    ['objtype', 'direction'], registry=metrics.registry)
+snapshot_rate = Gauge(
+    'db_snapshot_items_per_second',
+    'Throughput of the most recent snapshot export or import',
+    ['objtype', 'direction'], registry=metrics.registry)
+
+# Read-through item cache; a size of 0 disables it.  Under gunicorn
+# each worker would hold its own cache, which writes through other
+# workers do not invalidate, so it is off unless sized explicitly.
+cache_size = int(os.getenv('DB_CACHE_SIZE',
+                           '0' if serving.MULTIPROCESS else '10000'))
+cache_ttl = float(os.getenv('DB_CACHE_TTL_SEC', '30'))
+
+cache = ItemCache(
+    cache_size,
+    cache_ttl,
+    hits=Counter('db_cache_hits', 'Item cache hits',
+                 registry=metrics.registry),
+    misses=Counter('db_cache_misses', 'Item cache misses',
+                   registry=metrics.registry),
+    evictions=Counter('db_cache_evictions', 'Item cache evictions',
+                      ['reason'], registry=metrics.registry))
+
+# Concurrent `/read`s of one item that miss the cache share one fetch
+flights = SingleFlight(
+    collapsed=Counter('db_reads_collapsed',
+                      'Reads that shared the fetch of a concurrent read',
+                      registry=metrics.registry))
+
+# Opt-in coalescing of `/write` and `/load` into batch writes (see
+# writebuffer.py); a window of 0 writes every item on its own
+write_buffer = writebuffer.WriteBuffer(
+    float(os.getenv('DB_WRITE_BATCH_WINDOW_MS', '0')) / 1000,
+    max_queue=int(os.getenv('DB_WRITE_QUEUE_MAX', '1000')),
+    queue_timeout=float(os.getenv('DB_WRITE_QUEUE_TIMEOUT_SEC', '1')),
+    threads=int(os.getenv('DB_WRITE_BATCH_THREADS', '4')),
+    batch_items=Histogram('db_write_batch_items',
+                          'Items per coalesced batch write',
+                          buckets=(1, 2, 4, 8, 16, 25),
+                          registry=metrics.registry),
+    rejected=Counter('db_write_buffer_rejected',
+                     'Writes refused because the write buffer was full',
+                     registry=metrics.registry))
+serving.callback_gauge('db_write_buffer_depth',
+                       'Writes waiting in the write buffer',
+                       write_buffer.depth, metrics.registry)
+
+# Storage backend: 'dynamodb' or 'memory' (see storage.py)
+storage_driver = os.getenv('DB_DRIVER', 'dynamodb')
 
 # In some testing contexts, we pass in the DynamoDB URL
 dynamodb_url = os.getenv('DYNAMODB_URL', '')
 
-if dynamodb_url == '':
-    dynamodb = boto3.resource(
+if storage_driver == 'memory':
+    # Each gunicorn worker would hold a separate copy of the data
+    if serving.MULTIPROCESS and serving.workers > 1:
+        sys.exit('The memory driver requires WEB_WORKERS=1')
+    driver = storage.MemoryDriver()
+elif dynamodb_url == '':
+    driver = storage.DynamoDBDriver(boto3.resource(
         'dynamodb',
         region_name=region,
         aws_access_key_id=access_key,
-        aws_secret_access_key=secret_access_key)
+        aws_secret_access_key=secret_access_key))
 else:
     # See
     # https://stackoverflow.com/questions/31948742/localhost-endpoint-to-dynamodb-local-with-boto3
-    dynamodb = boto3.resource(
+    driver = storage.DynamoDBDriver(boto3.resource(
         'dynamodb',
         endpoint_url=dynamodb_url,
         region_name=region,
         aws_access_key_id=access_key,
-        aws_secret_access_key=secret_access_key)
+        aws_secret_access_key=secret_access_key))
+
+# Concurrent item updates made by one `/set_add` or `/set_remove`
+SET_UPDATE_THREADS = 8
+
+# objtype -> storage Table, resolved once at startup (see api.OBJTYPES)
+tables = {objtype: driver.table(objtype.capitalize()+"-ZZ-REG-ID",
+                                objtype + "_id",
+                                api.INDEXES.get(objtype))
+          for objtype in api.OBJTYPES}
+
+
+def invalidate(key):
+    '''Drop the (table, key) `key` from the item cache after a write,
+    and let later reads of it start a new fetch'''
+    cache.invalidate(key)
+    flights.forget(key)
+
+
+def error_response(body, headers=None):
+    '''Return a response holding the api error body `body`'''
+    return Response(json.dumps(body),
+                    status=body['http_status_code'],
+                    headers=headers,
+                    mimetype='application/json')
+
+
+def bad_request(reason):
+    '''Return a 400 response in the same format as the `/load` errors'''
+    return error_response(api.error_body(400, reason))
 
 
-# Change the implementation of this: you should probably have a separate
-# driver class for interfacing with a db like dynamodb in a different file.
 @bp.route('/update', methods=['PUT'])
 def update():
     headers = request.headers  # noqa: F841
     # check header here
     content = request.get_json()
-    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
-    objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
-    expression = 'SET '
-    x = 1
-    attrvals = {}
-    for k in content.keys():
-        expression += k + ' = :val' + str(x) + ', '
-        attrvals[':val' + str(x)] = content[k]
-        x += 1
-    expression = expression[:-2]
-    response = table.update_item(Key={table_id: objkey},
-                                 UpdateExpression=expression,
-                                 ExpressionAttributeValues=attrvals)
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        content = api.from_wire(content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    response = table.update(objkey, content)
+    invalidate((table.name, objkey))
+    return response
+
+
+def update_list(operation):
+    '''
+    Apply a storage list operation to the item named in the request
+
+    The query has `objtype` and `objkey` as for `/update` and the body
+    is {"attr": attribute, "values": [value, ...]}.  `operation` is
+    the name of a storage.Table list method.
+
+    Responds with 404 if the item does not exist, with 400 if the
+    attribute is not a list and with 409 if the operation's
+    precondition fails; the 409 body lists the offending values in
+    "values".
+    '''
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        attr, values = api.list_update(table, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    return apply_conditional(
+        table, objtype, objkey,
+        lambda: getattr(table, operation)(objkey, attr, values))
+
+
+def apply_conditional(table, objtype, objkey, operation):
+    '''
+    Call `operation`, a conditional update of item `objkey`, and
+    return its response, or a 404, 409 or 400 response if it raises
+    ItemNotFound, ConditionFailed or NotAList.
+    '''
+    try:
+        response = operation()
+    except storage.ItemNotFound:
+        return error_response(api.not_found_body(objtype, objkey))
+    except storage.ConditionFailed as e:
+        return error_response(api.conflict_body(e.values))
+    except storage.NotAList as e:
+        return bad_request(str(e))
+    finally:
+        invalidate((table.name, objkey))
     return response
 
 
+@bp.route('/append', methods=['PUT'])
+def append():
+    '''
+    Append values to a list attribute in one conditional update
+
+    See update_list() for the arguments.  The update fails, appending
+    nothing, if the list already holds any of the values.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return update_list('list_append')
+
+
+@bp.route('/remove', methods=['PUT'])
+def remove():
+    '''
+    Remove values from a list attribute in one conditional update
+
+    See update_list() for the arguments.  The update fails, removing
+    nothing, if the list does not hold every one of the values.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return update_list('list_remove')
+
+
+def update_sets(operation):
+    '''
+    Apply a storage set operation to many items of one objtype
+
+    The query has `objtype` and the body is {"objkeys": [key, ...],
+    "attr": attribute, "values": [string, ...]}.  The same values
+    are added to (or removed from) the set `attr` of every item.
+    DynamoDB has no batch update, so the items are updated
+    concurrently, SET_UPDATE_THREADS at a time.
+
+    Responds with "Count", the number of items updated.
+    '''
+    objtype = api.item_ref(request.args)[0]
+    try:
+        table = api.objtable(tables, objtype)
+        objkeys, attr, values = api.set_update(table, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+
+    def apply(objkey):
+        try:
+            getattr(table, operation)(objkey, attr, values)
+        finally:
+            invalidate((table.name, objkey))
+
+    if objkeys:
+        with concurrent.futures.ThreadPoolExecutor(
+                min(SET_UPDATE_THREADS, len(objkeys))) as pool:
+            list(pool.map(apply, objkeys))
+    return {"Count": len(objkeys)}
+
+
+@bp.route('/set_add', methods=['PUT'])
+def set_add():
+    '''
+    Add strings to a set attribute of many items
+
+    See update_sets() for the arguments.  Items that do not
+    exist are created.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return update_sets('set_add')
+
+
+@bp.route('/set_remove', methods=['PUT'])
+def set_remove():
+    '''
+    Remove strings from a set attribute of many items
+
+    See update_sets() for the arguments.  Absent values are ignored.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return update_sets('set_remove')
+
+
+@bp.route('/replace', methods=['PUT'])
+def replace():
+    '''
+    Set an attribute if it still holds the value the caller last read
+
+    The query has `objtype` and `objkey` as for `/update` and the body
+    is {"attr": attribute, "expected": value, "value": value}.  An
+    "expected" of null requires the attribute to be absent.  Either
+    value may be binary ({"B": base64}).  An optional "others" dict
+    gives further attributes to set in the same update.
+
+    Responds with 404 if the item does not exist and with 409 if the
+    attribute does not hold "expected"; the caller should read the
+    item again and retry.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        attr, expected, value, others = api.replacement(
+            table, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    return apply_conditional(
+        table, objtype, objkey,
+        lambda: table.replace(objkey, attr, expected, value, others))
+
+
 @bp.route('/read', methods=['GET'])
 def read():
+    '''
+    Read the item with key `objkey` from the `objtype` table
+
+    Optional query parameters:
+    fields: comma-separated attribute names.  Only these attributes
+        (and the key) are returned.
+    consistent: "true" requests a strongly consistent read.  This
+        bypasses the item cache and costs twice as much capacity.
+
+    Other reads that miss the cache while a read of the same item is
+    fetching it wait for that fetch and return its item.
+    '''
     headers = request.headers  # noqa: F841
     # check header here
-    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
-    objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
-    response = table.query(Select='ALL_ATTRIBUTES',
-                           KeyConditionExpression=Key(table_id).eq(objkey))
-    return response
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    fields, consistent = api.read_options(request.args)
+    if consistent:
+        return api.read_body(
+            table, table.get(objkey, fields=fields, consistent=True))
+    # Cache and fetch whole items and project them here; the
+    # capacity consumed by a read does not depend on the projection
+    found, item, token = cache.lookup((table.name, objkey))
+    if not found:
+        item = flights.do((table.name, objkey), lambda: table.get(objkey))
+        cache.fill((table.name, objkey), item, token)
+    return api.read_body(table, item, fields)
+
+
+@bp.route('/batch_read', methods=['POST'])
+def batch_read():
+    '''
+    Read many items of a single objtype in one call
+
+    The body is {"objtype": objtype, "objkeys": [key, ...]}, optionally
+    with "fields", a list of the attributes to return (the key is
+    always included).  The keys are deduplicated and fetched with the
+    storage driver's batch_get, which for DynamoDB issues BatchGetItem
+    calls of at most 100 keys and retries unprocessed keys with
+    backoff.  Keys still unprocessed after the retries are listed in
+    "UnprocessedKeys".
+
+    The response has the same "Items"/"Count" fields as `/read`.
+    Items are returned in no particular order and keys with no
+    matching item are simply absent from "Items".
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        objtype, objkeys, fields = api.batch_read_request(request.get_json())
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, tokens = api.cached_items(cache, table, objkeys)
+    fetched, unprocessed = table.batch_get(list(tokens))
+    api.fill_fetched(cache, table, items, tokens, fetched, unprocessed)
+    return api.batch_read_body(table, items, unprocessed, fields)
+
+
+@bp.route('/scan', methods=['GET'])
+def scan():
+    '''
+    Read one page of the `objtype` table
+
+    Optional query parameters:
+    limit: maximum number of items in the page (default
+        api.scan_default_limit, at most api.scan_max_limit).
+    cursor: the "Cursor" of the previous page.  Omit for the first page.
+    fields: comma-separated attribute names.  Only these attributes
+        (and the key) are returned.
+
+    The response has the "Items"/"Count" fields of `/read` plus
+    "Cursor", which is null on the last page.  A page may hold fewer
+    than `limit` items (even none) when more pages follow.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        table = api.objtable(tables, request.args.get('objtype', ''))
+        limit, start_key = api.page_request(request.args)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, last_key = table.scan(limit=limit, start_key=start_key)
+    return api.page_body(table, items, last_key, request.args)
+
+
+@bp.route('/query', methods=['GET'])
+def query():
+    '''
+    Read one page of the items of the `objtype` table with a given
+    partition key in the secondary index `index` (see api.INDEXES)
+
+    Query parameters:
+    index: the name of the index.
+    key: the partition key value to match.
+    prefix (optional): match only items whose sort key starts with it.
+    limit, cursor, fields (optional): as for `/scan`.
+
+    Items are returned in sort key order, in the format of `/scan`.
+    Unlike a filtered scan, the cost is proportional to the number
+    of matching items.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        table = api.objtable(tables, request.args.get('objtype', ''))
+        index, key, prefix, limit, start_key = api.query_request(
+            table, request.args)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, last_key = table.query(index, key, prefix=prefix,
+                                  limit=limit, start_key=start_key)
+    return api.page_body(table, items, last_key, request.args)
 
 
 @bp.route('/write', methods=['POST'])
@@ -110,38 +452,38 @@ def write():
     headers = request.headers  # noqa: F841
     # check header here
     content = request.get_json()
-    table_name = content['objtype'].capitalize()+"-ZZ-REG-ID"
-    objtype = content['objtype']
-    table_id = objtype + "_id"
-    payload = {table_id: str(uuid.uuid4())}
-    del content['objtype']
-    for k in content.keys():
-        payload[k] = content[k]
-    table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
-    returnval = ''
-    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        returnval = {"message": "fail"}
-    return json.dumps(
-        ({table_id: payload[table_id]}, returnval)['returnval' in globals()])
-
-
-def decode_auth_token(token):
-    '''Given an auth token in Base64 encoding, return the original string'''
-    return base64.standard_b64decode(token).decode()
-
-
-def load_auth(headers):
-    '''Return True if caller authorized to do a `/load` '''
-    global loader_token
-    if 'Authorization' not in headers:
-        return False
-    # Auth string is 'Basic ' concatenated with base64 encoding of uname:passwd
-    auth_string = headers['Authorization'].split()[1]
-    name, pwd = decode_auth_token(auth_string).split(':')
-    if name != 'svc-loader' or pwd != loader_token:
-        return False
-    return True
+    try:
+        table = api.objtable(tables, content['objtype'])
+        payload = api.write_payload(table, content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    error = put_item(table, payload)
+    if error is not None:
+        return error
+    return api.written_body(table, payload)
+
+
+def put_item(table, item):
+    '''
+    Create or replace `item` in `table`, through the write buffer if
+    it is enabled, and drop it from the item cache
+
+    Returns None once the item is written, or the error response if
+    the write buffer was full or left the item unwritten.
+    '''
+    try:
+        if write_buffer.enabled:
+            write_buffer.put(table, item)
+        else:
+            table.put(item)
+    except writebuffer.QueueFull:
+        return error_response(api.error_body(503, 'Write buffer full'),
+                              headers={'Retry-After': '1'})
+    except writebuffer.WriteFailed as e:
+        return error_response(api.error_body(500, e.reason))
+    finally:
+        invalidate((table.name, item[table.key]))
+    return None
 
 
 @bp.route('/load', methods=['POST'])
@@ -153,51 +495,125 @@ def load():
     1. The caller must specify the UUID in `content`. http_status_code
        400 is returned if this condition is not met.
     2. The caller must include an "Authorization" header accepted
-       by load_auth(). A 401 status is returned for authorization failure.
-    3. If the database returns a non-200 status code, this routine
-       responds with an {http_status_code: status} object.
-
-    This routine potentially could share a common subroutine with
-    write() but the HTTP error processing in write() seems wrong
-    so this routine has its own code.
+       by api.load_auth(). A 401 status is returned for authorization
+       failure.
+    3. The record may be written alongside others through
+       `/batch_load`; api.load_payload() is shared by both routes.
     '''
     headers = request.headers
-    if not load_auth(headers):
-        return Response(
-            json.dumps({"http_status_code": 401,
-                        "reason": "Invalid authorization for /load"}),
-            status=401,
-            mimetype='application/json')
+    if not api.load_auth(headers):
+        return error_response(api.unauthorized_body('load'))
 
     content = request.get_json()
     if 'uuid' not in content:
-        return json.dumps({"http_status_code": 400, "reason": 'Missing uuid'})
-    table_name = content['objtype'].capitalize()+"-ZZ-REG-ID"
-    objtype = content['objtype']
-    table_id = objtype + "_id"
-    payload = {table_id: content['uuid']}
-    del content['objtype']
-    del content['uuid']
-    for k in content.keys():
-        payload[k] = content[k]
-    table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
-    status = response['ResponseMetadata']['HTTPStatusCode']
-    if status != 200:
-        return json.dumps({"http_status_code": status})
-    return json.dumps({table_id: payload[table_id]})
+        return json.dumps(api.error_body(400, 'Missing uuid'))
+    try:
+        table, payload = api.load_payload(tables, content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    error = put_item(table, payload)
+    if error is not None:
+        return error
+    return api.written_body(table, payload)
+
+
+@bp.route('/batch_load', methods=['POST'])
+def batch_load():
+    '''
+    Load many values into the database in one call
+
+    The body is a list of records, each in the format accepted by
+    load(), and the same "Authorization" header is required.  The
+    records for each table are written with the storage driver's
+    batch_put, which for DynamoDB issues BatchWriteItem calls of at
+    most 25 items and retries unprocessed items with backoff.
+
+    The response lists one result per record, in order: either
+    {table_id: uuid} for a successful write or an
+    {http_status_code: status, reason: reason} object.
+    '''
+    headers = request.headers
+    if not api.load_auth(headers):
+        return error_response(api.unauthorized_body('batch_load'))
+
+    try:
+        results, batches = api.load_batches(tables, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    for table, batch in batches.values():
+        failed = table.batch_put([item for _, item in batch])
+        for _, item in batch:
+            invalidate((table.name, item[table.key]))
+        api.record_loaded(results, table, batch, failed)
+    return api.batch_load_body(results)
+
+
+@bp.route('/export', methods=['POST'])
+def export():
+    '''
+    Export a whole table to a snapshot file
+
+    The body is {"objtype": objtype}, optionally with "segments", the
+    number of parallel scan segments (default 4), and "file", the name
+    of the file to create in api.snapshot_dir.  The caller must
+    include an "Authorization" header accepted by api.load_auth().
+
+    The call returns when the export is complete, with the file name
+    and the statistics returned by snapshot.export_table().
+    '''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('export'))
+    try:
+        objtype, segments, path = api.export_request(
+            tables, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    counter = snapshot_items.labels(objtype, 'export')
+    result = snapshot.export_table(tables[objtype], path, segments=segments,
+                                   progress=counter.inc)
+    snapshot_rate.labels(objtype, 'export').set(result['items_per_sec'] or 0)
+    result['file'] = os.path.basename(path)
+    return result
+
+
+@bp.route('/import', methods=['POST'])
+def import_():
+    '''
+    Load a snapshot file written by `/export` into a table
+
+    The body is {"objtype": objtype, "file": name}, where name is a
+    file in api.snapshot_dir.  Items are written through the same
+    batch path as `/batch_load` and replace any items with the same
+    keys.  The caller must include an "Authorization" header accepted
+    by api.load_auth().
+    '''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('import'))
+    try:
+        objtype, path = api.import_request(tables, request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    counter = snapshot_items.labels(objtype, 'import')
+    result = snapshot.import_table(tables[objtype], path,
+                                   progress=counter.inc)
+    # Any cached item may have been replaced
+    cache.clear()
+    flights.clear()
+    snapshot_rate.labels(objtype, 'import').set(result['items_per_sec'] or 0)
+    return result
 
 
 @bp.route('/delete', methods=['DELETE'])
 def delete():
     headers = request.headers  # noqa: F841
     # check header here
-    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
-    objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
-    response = table.delete_item(Key={table_id: objkey})
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    response = table.delete(objkey)
+    invalidate((table.name, objkey))
     return response
 
 
@@ -224,5 +640,7 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    if serving.web_server == 'gunicorn':
+        serving.exec_gunicorn(p)
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
@@ -0,0 +1,604 @@
+"""
+SFU CMPT 756
+Sample application---database service, asyncio version.
+
+Serves the same `/api/v1/datastore/*` routes as app.py, with the same
+requests, responses and environment variables, but as an ASGI
+application (Quart, under uvicorn) that calls DynamoDB through the
+non-blocking client of aiobotocore (see aiostorage.py).  A request
+waiting on DynamoDB holds a coroutine instead of a thread, so one
+process serves thousands of concurrent requests in little memory.
+
+Additional environment variables:
+DB_POOL_SIZE: connections to DynamoDB (default 64).  Calls beyond this
+    wait for a free connection.
+DB_CONNECT_TIMEOUT_SEC, DB_READ_TIMEOUT_SEC: DynamoDB call timeouts
+    (default 5 and 30).
+
+`/export` and `/import` run in a worker thread with the synchronous
+driver of storage.py; they are bulk operations, not request traffic.
+
+The routes parse their requests and build their responses with
+api.py, as app.py does, so only the storage calls differ.  It has
+no WEB_SERVER or WEB_WORKERS: uvicorn runs a single process, which
+keeps the item cache on by default.
+"""
+
+# Standard library modules
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import time
+
+# Installed packages
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+
+import boto3
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import generate_latest
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+
+from quart import Blueprint
+from quart import g
+from quart import Quart
+from quart import request
+from quart import Response
+
+import simplejson as json
+
+import uvicorn
+
+# Local modules
+import aiostorage
+import api
+from cache import AsyncSingleFlight
+from cache import ItemCache
+import snapshot
+import storage
+import writebuffer
+
+# The application
+
+app = Quart(__name__)
+
+bp = Blueprint('app', __name__)
+
+# prometheus_flask_exporter does not support Quart.  The request
+# metrics keep its names, so the dashboards read either service.
+registry = REGISTRY
+Gauge('app_info', 'Database process', registry=registry).set(1)
+request_duration = Histogram(
+    'flask_http_request_duration_seconds',
+    'Flask HTTP request duration in seconds',
+    ['method', 'path', 'status'], registry=registry)
+request_total = Counter(
+    'flask_http_request_total', 'Total number of HTTP requests',
+    ['method', 'status'], registry=registry)
+requests_in_flight = Gauge(
+    'db_requests_in_flight', 'Requests being served',
+    registry=registry)
+
+# Endpoints left out of the request metrics
+UNTRACKED = ('app.health', 'app.readiness', 'metrics')
+
+# default to us-east-1 if no region is specified
+# (us-east-1 is the default/only supported region for a starter account)
+region = os.getenv('AWS_REGION', 'us-east-1')
+
+# these must be present; if they are missing, we should probably bail now
+access_key = os.getenv('AWS_ACCESS_KEY_ID')
+secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+
+snapshot_items = Counter(
+    'db_snapshot_items', 'Items exported to or imported from snapshots',
+    ['objtype', 'direction'], registry=registry)
+snapshot_rate = Gauge(
+    'db_snapshot_items_per_second',
+    'Throughput of the most recent snapshot export or import',
+    ['objtype', 'direction'], registry=registry)
+
+# Read-through item cache; a size of 0 disables it
+cache = ItemCache(
+    int(os.getenv('DB_CACHE_SIZE', '10000')),
+    float(os.getenv('DB_CACHE_TTL_SEC', '30')),
+    hits=Counter('db_cache_hits', 'Item cache hits',
+                 registry=registry),
+    misses=Counter('db_cache_misses', 'Item cache misses',
+                   registry=registry),
+    evictions=Counter('db_cache_evictions', 'Item cache evictions',
+                      ['reason'], registry=registry))
+
+# Concurrent `/read`s of one item that miss the cache share one fetch
+flights = AsyncSingleFlight(
+    collapsed=Counter('db_reads_collapsed',
+                      'Reads that shared the fetch of a concurrent read',
+                      registry=registry))
+
+# Opt-in coalescing of `/write` and `/load` into batch writes (see
+# writebuffer.py); a window of 0 writes every item on its own
+write_buffer = writebuffer.AsyncWriteBuffer(
+    float(os.getenv('DB_WRITE_BATCH_WINDOW_MS', '0')) / 1000,
+    max_queue=int(os.getenv('DB_WRITE_QUEUE_MAX', '1000')),
+    queue_timeout=float(os.getenv('DB_WRITE_QUEUE_TIMEOUT_SEC', '1')),
+    threads=int(os.getenv('DB_WRITE_BATCH_THREADS', '4')),
+    batch_items=Histogram('db_write_batch_items',
+                          'Items per coalesced batch write',
+                          buckets=(1, 2, 4, 8, 16, 25),
+                          registry=registry),
+    rejected=Counter('db_write_buffer_rejected',
+                     'Writes refused because the write buffer was full',
+                     registry=registry))
+Gauge('db_write_buffer_depth', 'Writes waiting in the write buffer',
+      registry=registry).set_function(write_buffer.depth)
+
+# Storage backend: 'dynamodb' or 'memory' (see storage.py)
+storage_driver = os.getenv('DB_DRIVER', 'dynamodb')
+
+# In some testing contexts, we pass in the DynamoDB URL
+dynamodb_url = os.getenv('DYNAMODB_URL', '')
+
+# Connection pool and timeouts of the DynamoDB client
+pool_size = int(os.getenv('DB_POOL_SIZE', '64'))
+connect_timeout = float(os.getenv('DB_CONNECT_TIMEOUT_SEC', '5'))
+read_timeout = float(os.getenv('DB_READ_TIMEOUT_SEC', '30'))
+
+# Concurrent item updates made by one `/set_add` or `/set_remove`
+SET_UPDATE_CONCURRENCY = 8
+
+# objtype -> aiostorage Table and objtype -> storage Table (for the
+# snapshot routes), opened by open_storage() before serving
+tables = {}
+sync_tables = {}
+
+# Holds the DynamoDB client open while serving
+resources = contextlib.AsyncExitStack()
+
+
+def table_args(objtype):
+    '''Return the (name, key, indexes) of the table for `objtype`'''
+    return (objtype.capitalize()+"-ZZ-REG-ID", objtype + "_id",
+            api.INDEXES.get(objtype))
+
+
+@app.before_serving
+async def open_storage():
+    if storage_driver == 'memory':
+        driver = aiostorage.MemoryDriver()
+        tables.update((objtype, driver.table(*table_args(objtype)))
+                      for objtype in api.OBJTYPES)
+        sync_tables.update((objtype, table.table)
+                           for objtype, table in tables.items())
+        return
+    endpoint = dynamodb_url or None
+    client = await resources.enter_async_context(
+        get_session().create_client(
+            'dynamodb',
+            endpoint_url=endpoint,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_access_key,
+            config=AioConfig(max_pool_connections=pool_size,
+                             connect_timeout=connect_timeout,
+                             read_timeout=read_timeout)))
+    driver = aiostorage.DynamoDBDriver(client)
+    sync_driver = storage.DynamoDBDriver(boto3.resource(
+        'dynamodb',
+        endpoint_url=endpoint,
+        region_name=region,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_access_key))
+    for objtype in api.OBJTYPES:
+        tables[objtype] = driver.table(*table_args(objtype))
+        sync_tables[objtype] = sync_driver.table(*table_args(objtype))
+
+
+@app.after_serving
+async def close_storage():
+    await resources.aclose()
+
+
+@app.before_request
+async def start_timer():
+    g.start = time.perf_counter()
+    requests_in_flight.inc()
+
+
+@app.after_request
+async def record_request(response):
+    if request.endpoint not in UNTRACKED:
+        status = str(response.status_code)
+        request_duration.labels(request.method, request.path, status).observe(
+            time.perf_counter() - g.start)
+        request_total.labels(request.method, status).inc()
+    return response
+
+
+@app.teardown_request
+async def end_request(exc):
+    requests_in_flight.dec()
+
+
+@app.route('/metrics')
+async def metrics():
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def invalidate(key):
+    '''Drop the (table, key) `key` from the item cache after a write,
+    and let later reads of it start a new fetch'''
+    cache.invalidate(key)
+    flights.forget(key)
+
+
+@bp.route('/update', methods=['PUT'])
+async def update():
+    headers = request.headers  # noqa: F841
+    # check header here
+    content = await request.get_json()
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        content = api.from_wire(content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    response = await table.update(objkey, content)
+    invalidate((table.name, objkey))
+    return json_response(response)
+
+
+async def update_list(operation):
+    '''
+    Apply a storage list operation to the item named in the request
+
+    See app.py.  `operation` is the name of an aiostorage.Table list
+    method.
+    '''
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        attr, values = api.list_update(table, await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    return await apply_conditional(
+        table, objtype, objkey,
+        getattr(table, operation)(objkey, attr, values))
+
+
+async def apply_conditional(table, objtype, objkey, operation):
+    '''
+    Await `operation`, a conditional update of item `objkey`, and
+    return its response, or a 404, 409 or 400 response if it raises
+    ItemNotFound, ConditionFailed or NotAList.
+    '''
+    try:
+        response = await operation
+    except storage.ItemNotFound:
+        return error_response(api.not_found_body(objtype, objkey))
+    except storage.ConditionFailed as e:
+        return error_response(api.conflict_body(e.values))
+    except storage.NotAList as e:
+        return bad_request(str(e))
+    finally:
+        invalidate((table.name, objkey))
+    return json_response(response)
+
+
+@bp.route('/append', methods=['PUT'])
+async def append():
+    '''Append values to a list attribute in one conditional update'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return await update_list('list_append')
+
+
+@bp.route('/remove', methods=['PUT'])
+async def remove():
+    '''Remove values from a list attribute in one conditional update'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return await update_list('list_remove')
+
+
+async def update_sets(operation):
+    '''
+    Apply a storage set operation to many items of one objtype
+
+    See app.py.  The items are updated SET_UPDATE_CONCURRENCY at a time.
+    '''
+    objtype = api.item_ref(request.args)[0]
+    try:
+        table = api.objtable(tables, objtype)
+        objkeys, attr, values = api.set_update(table,
+                                               await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+
+    slots = asyncio.Semaphore(SET_UPDATE_CONCURRENCY)
+
+    async def apply(objkey):
+        async with slots:
+            try:
+                await getattr(table, operation)(objkey, attr, values)
+            finally:
+                invalidate((table.name, objkey))
+
+    await asyncio.gather(*(apply(k) for k in objkeys))
+    return json_response({"Count": len(objkeys)})
+
+
+@bp.route('/set_add', methods=['PUT'])
+async def set_add():
+    '''Add strings to a set attribute of many items'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return await update_sets('set_add')
+
+
+@bp.route('/set_remove', methods=['PUT'])
+async def set_remove():
+    '''Remove strings from a set attribute of many items'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return await update_sets('set_remove')
+
+
+@bp.route('/replace', methods=['PUT'])
+async def replace():
+    '''Set an attribute if it still holds the value the caller last read'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+        attr, expected, value, others = api.replacement(
+            table, await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    return await apply_conditional(
+        table, objtype, objkey,
+        table.replace(objkey, attr, expected, value, others))
+
+
+@bp.route('/read', methods=['GET'])
+async def read():
+    '''Read the item with key `objkey` from the `objtype` table'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    fields, consistent = api.read_options(request.args)
+    if consistent:
+        return json_response(api.read_body(
+            table, await table.get(objkey, fields=fields, consistent=True)))
+    found, item, token = cache.lookup((table.name, objkey))
+    if not found:
+        item = await flights.do((table.name, objkey),
+                                lambda: table.get(objkey))
+        cache.fill((table.name, objkey), item, token)
+    return json_response(api.read_body(table, item, fields))
+
+
+def bad_request(reason):
+    '''Return a 400 response in the same format as the `/load` errors'''
+    return error_response(api.error_body(400, reason))
+
+
+def error_response(body, headers=None):
+    '''Return a response holding the api error body `body`'''
+    return json_response(body, body['http_status_code'], headers)
+
+
+def json_response(body, status=200, headers=None):
+    '''Return a JSON response holding `body`.  Encoded with simplejson,
+    as Flask does for app.py, so that numbers read from DynamoDB as
+    Decimal stay numbers.'''
+    return Response(json.dumps(body), status=status, headers=headers,
+                    mimetype='application/json')
+
+
+@bp.route('/batch_read', methods=['POST'])
+async def batch_read():
+    '''Read many items of a single objtype in one call'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        objtype, objkeys, fields = api.batch_read_request(
+            await request.get_json())
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, tokens = api.cached_items(cache, table, objkeys)
+    fetched, unprocessed = await table.batch_get(list(tokens))
+    api.fill_fetched(cache, table, items, tokens, fetched, unprocessed)
+    return json_response(
+        api.batch_read_body(table, items, unprocessed, fields))
+
+
+@bp.route('/scan', methods=['GET'])
+async def scan():
+    '''Read one page of the `objtype` table'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        table = api.objtable(tables, request.args.get('objtype', ''))
+        limit, start_key = api.page_request(request.args)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, last_key = await table.scan(limit=limit, start_key=start_key)
+    return json_response(api.page_body(table, items, last_key, request.args))
+
+
+@bp.route('/query', methods=['GET'])
+async def query():
+    '''Read one page of the items of the `objtype` table with a given
+    partition key in the secondary index `index`'''
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        table = api.objtable(tables, request.args.get('objtype', ''))
+        index, key, prefix, limit, start_key = api.query_request(
+            table, request.args)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    items, last_key = await table.query(index, key, prefix=prefix,
+                                        limit=limit, start_key=start_key)
+    return json_response(api.page_body(table, items, last_key, request.args))
+
+
+@bp.route('/write', methods=['POST'])
+async def write():
+    headers = request.headers  # noqa: F841
+    # check header here
+    content = await request.get_json()
+    try:
+        table = api.objtable(tables, content['objtype'])
+        payload = api.write_payload(table, content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    error = await put_item(table, payload)
+    if error is not None:
+        return error
+    return api.written_body(table, payload)
+
+
+async def put_item(table, item):
+    '''Create or replace `item` in `table` as app.py does: return None
+    once it is written, or the error response'''
+    try:
+        if write_buffer.enabled:
+            await write_buffer.put(table, item)
+        else:
+            await table.put(item)
+    except writebuffer.QueueFull:
+        return error_response(api.error_body(503, 'Write buffer full'),
+                              headers={'Retry-After': '1'})
+    except writebuffer.WriteFailed as e:
+        return error_response(api.error_body(500, e.reason))
+    finally:
+        invalidate((table.name, item[table.key]))
+    return None
+
+
+@bp.route('/load', methods=['POST'])
+async def load():
+    '''Load a value into the database; see app.py'''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('load'))
+    content = await request.get_json()
+    if 'uuid' not in content:
+        return json.dumps(api.error_body(400, 'Missing uuid'))
+    try:
+        table, payload = api.load_payload(tables, content)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    error = await put_item(table, payload)
+    if error is not None:
+        return error
+    return api.written_body(table, payload)
+
+
+@bp.route('/batch_load', methods=['POST'])
+async def batch_load():
+    '''Load many values into the database in one call; see app.py'''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('batch_load'))
+    try:
+        results, batches = api.load_batches(tables, await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    for table, batch in batches.values():
+        failed = await table.batch_put([item for _, item in batch])
+        for _, item in batch:
+            invalidate((table.name, item[table.key]))
+        api.record_loaded(results, table, batch, failed)
+    return json_response(api.batch_load_body(results))
+
+
+async def in_thread(f, *args, **kwargs):
+    '''Return the result of calling `f` in a worker thread'''
+    return await asyncio.get_running_loop().run_in_executor(
+        None, lambda: f(*args, **kwargs))
+
+
+@bp.route('/export', methods=['POST'])
+async def export():
+    '''Export a whole table to a snapshot file; see app.py'''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('export'))
+    try:
+        objtype, segments, path = api.export_request(
+            tables, await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    counter = snapshot_items.labels(objtype, 'export')
+    result = await in_thread(snapshot.export_table, sync_tables[objtype],
+                             path, segments=segments, progress=counter.inc)
+    snapshot_rate.labels(objtype, 'export').set(result['items_per_sec'] or 0)
+    result['file'] = os.path.basename(path)
+    return json_response(result)
+
+
+@bp.route('/import', methods=['POST'])
+async def import_():
+    '''Load a snapshot file written by `/export` into a table; see app.py'''
+    if not api.load_auth(request.headers):
+        return error_response(api.unauthorized_body('import'))
+    try:
+        objtype, path = api.import_request(tables, await request.get_json())
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    counter = snapshot_items.labels(objtype, 'import')
+    result = await in_thread(snapshot.import_table, sync_tables[objtype],
+                             path, progress=counter.inc)
+    # Any cached item may have been replaced
+    cache.clear()
+    flights.clear()
+    snapshot_rate.labels(objtype, 'import').set(result['items_per_sec'] or 0)
+    return json_response(result)
+
+
+@bp.route('/delete', methods=['DELETE'])
+async def delete():
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype, objkey = api.item_ref(request.args)
+    try:
+        table = api.objtable(tables, objtype)
+    except api.BadRequest as e:
+        return bad_request(str(e))
+    response = await table.delete(objkey)
+    invalidate((table.name, objkey))
+    return json_response(response)
+
+
+@bp.route('/health')
+async def health():
+    return Response("", status=200, mimetype="application/json")
+
+
+@bp.route('/readiness')
+async def readiness():
+    return Response("", status=200, mimetype="application/json")
+
+
+# All database calls will have this prefix.  Prometheus metric
+# calls will not---they will have route '/metrics'.
+app.register_blueprint(bp, url_prefix='/api/v1/datastore/')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        logging.error("missing port arg 1")
+        sys.exit(-1)
+
+    p = int(sys.argv[1])
+    uvicorn.run(app, host='0.0.0.0', port=p)
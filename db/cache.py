@@ -0,0 +1,222 @@
+"""
+Size-bounded LRU cache with a time-to-live on every entry.
+
+Used by the database service to serve repeated reads of the
+same item without a round trip to the storage backend, along with
+SingleFlight, which collapses concurrent fetches of one item, and
+its asyncio counterpart AsyncSingleFlight.  The playlist service
+uses ItemCache for its expanded playlists and known music ids.
+
+s3 holds a copy of this module.  Edit the one in db and copy it with
+`tools/check-copies.sh --fix`; CI fails if they differ.
+"""
+
+# Standard library modules
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class ItemCache():
+    """LRU + TTL cache of items keyed by (table, key).
+
+    Reads follow a lookup/fill protocol so that a fill racing with
+    an invalidation cannot reinstate a stale value:
+
+        found, value, token = cache.lookup(key)
+        if not found:
+            value = fetch(key)
+            cache.fill(key, value, token)
+
+    An invalidate() between the lookup() and the fill() discards the
+    token, and the fill() is then ignored.
+
+    Cached values are shared between callers and must not be mutated.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries.  Zero disables the cache.
+    ttl: float
+        Seconds an entry remains valid after it is filled.
+    hits, misses, evictions: prometheus_client.Counter (optional)
+        Counters incremented on each event.  `evictions` must have
+        a `reason` label, set to 'size' or 'ttl'.
+    clock: callable (optional)
+        Returns the current time in seconds.
+    """
+    def __init__(self, maxsize, ttl, hits=None, misses=None, evictions=None,
+                 clock=time.monotonic):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._hits = hits
+        self._misses = misses
+        self._evictions = evictions
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expiry time, value), least recently used first
+        self._entries = collections.OrderedDict()
+        # key -> token of the fill in progress
+        self._pending = {}
+
+    @property
+    def enabled(self):
+        """True if the cache can hold any entries."""
+        return self._maxsize > 0
+
+    def _count(self, counter, *labels):
+        if counter is not None:
+            if labels:
+                counter.labels(*labels).inc()
+            else:
+                counter.inc()
+
+    def lookup(self, key):
+        """Look up `key`.
+
+        Returns
+        -------
+        (found, value, token)
+            If found is True, value is the cached value.  Otherwise
+            token must be passed to fill() along with the fetched value.
+        """
+        if self._maxsize <= 0:
+            return False, None, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self._count(self._hits)
+                    return True, entry[1], None
+                del self._entries[key]
+                self._count(self._evictions, 'ttl')
+            self._count(self._misses)
+            if len(self._pending) >= self._maxsize:
+                # Abandoned fills (failed fetches); start afresh
+                self._pending.clear()
+            token = object()
+            self._pending[key] = token
+            return False, None, token
+
+    def fill(self, key, value, token):
+        """Cache `value` for `key` unless `key` was invalidated
+        since the lookup() that returned `token`."""
+        if token is None:
+            return
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return
+            del self._pending[key]
+            self._entries[key] = (self._clock() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self._count(self._evictions, 'size')
+
+    def clear(self):
+        """Drop every cached value and cancel fills in progress."""
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+
+    def invalidate(self, key):
+        """Drop any cached value for `key` and cancel fills in progress."""
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+
+
+class SingleFlight():
+    """Collapses concurrent fetches of the same key into one.
+
+        value = flights.do(key, fetch)
+
+    The first caller of do() for `key` runs fetch(), and callers
+    arriving while it runs wait for it and get the same value (or
+    exception) instead of fetching again.  Once the fetch completes,
+    the next caller starts a new one, so nothing is kept.
+
+    forget(key), called after a write of `key`, makes callers arriving
+    afterwards start a new fetch rather than join one that began
+    before the write.
+
+    The value is shared between callers and must not be mutated.
+
+    Parameters
+    ----------
+    collapsed: prometheus_client.Counter (optional)
+        Counter incremented for each caller that joins a fetch.
+    """
+    def __init__(self, collapsed=None):
+        self._collapsed = collapsed
+        self._lock = threading.Lock()
+        # key -> future of the fetch in progress
+        self._flights = {}
+
+    def do(self, key, fetch):
+        """Return the result of fetch(), shared with the concurrent
+        callers for `key`."""
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._flights[key] = future
+        if not leader:
+            if self._collapsed is not None:
+                self._collapsed.inc()
+            return future.result()
+        try:
+            value = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is future:
+                    del self._flights[key]
+        future.set_result(value)
+        return value
+
+    def forget(self, key):
+        """Let callers arriving from now on start a new fetch of `key`."""
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def clear(self):
+        """forget() every key."""
+        with self._lock:
+            self._flights.clear()
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight for coroutines of one event loop.
+
+        value = await flights.do(key, fetch)
+
+    fetch() returns an awaitable, run as a task of its own, so a
+    caller cancelled while waiting (such as by a client disconnecting)
+    leaves the fetch running for the other callers.
+    """
+    async def do(self, key, fetch):
+        """Return the result of awaiting fetch(), shared with the
+        concurrent callers for `key`."""
+        task = self._flights.get(key)
+        if task is not None:
+            if self._collapsed is not None:
+                self._collapsed.inc()
+        else:
+            task = asyncio.ensure_future(fetch())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._land(key, task))
+        return await asyncio.shield(task)
+
+    def _land(self, key, task):
+        """Drop the completed fetch `task` of `key`, unless forgotten."""
+        if self._flights.get(key) is task:
+            del self._flights[key]
@@ -0,0 +1,143 @@
+"""
+Export tables to snapshot files and import them back.
+
+A snapshot is a gzip-compressed file with one item per line in
+JSON (NDJSON).  Items appear in no particular order.  Numbers are
+written and read as decimals, so they round-trip exactly, and binary
+attributes are written as {"B": base64}.
+"""
+
+# Standard library modules
+import concurrent.futures
+import gzip
+import threading
+import time
+
+# Installed packages
+import simplejson as json
+
+# Local modules
+import storage
+
+
+def export_table(table, path, segments=4, page_size=1000, progress=None):
+    """Write every item of `table` to the snapshot file `path`.
+
+    The table is read by a parallel scan: it is divided into
+    `segments` disjoint segments, each scanned by its own thread.
+
+    Parameters
+    ----------
+    table: storage.Table
+        The table to export.
+    path: string
+        The snapshot file to create.  An existing file is replaced.
+    segments: int
+        Number of segments (and threads) in the parallel scan.
+    page_size: int
+        Maximum number of items fetched by each scan call.
+    progress: callable (optional)
+        Called with the number of items in each page once that
+        page has been written.  Called from the scanning threads.
+
+    Returns
+    -------
+    dict
+        "items": number of items written,
+        "bytes": size of the snapshot file,
+        "seconds": elapsed time,
+        "items_per_sec": throughput.
+    """
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def scan_segment(out, segment):
+        count = 0
+        start_key = None
+        while True:
+            items, start_key = table.scan(limit=page_size,
+                                          start_key=start_key,
+                                          segment=segment,
+                                          total_segments=segments)
+            # Serialize outside the lock; only the write is shared
+            lines = ''.join(json.dumps(storage.to_wire(item)) + '\n'
+                            for item in items)
+            with lock:
+                out.write(lines.encode())
+            count += len(items)
+            if progress is not None:
+                progress(len(items))
+            if start_key is None:
+                return count
+
+    with gzip.open(path, 'wb') as out:
+        with concurrent.futures.ThreadPoolExecutor(segments) as pool:
+            counts = pool.map(lambda s: scan_segment(out, s),
+                              range(segments))
+            items = sum(counts)
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+    return stats(items, start, bytes=size)
+
+
+def import_table(table, path, batch_size=1000, progress=None):
+    """Write every item in the snapshot file `path` into `table`.
+
+    The items are written with the table's batch_put, in
+    calls of `batch_size` items.
+
+    Parameters
+    ----------
+    table: storage.Table
+        The table to load.  Items with keys already present
+        replace the existing items.
+    path: string
+        The snapshot file to read.
+    batch_size: int
+        Number of items per batch_put call.
+    progress: callable (optional)
+        Called with the number of items in each batch once that
+        batch has been written.
+
+    Returns
+    -------
+    dict
+        "items": number of items written,
+        "failed": dict mapping the key of each item that could not
+        be written to the reason,
+        "seconds": elapsed time,
+        "items_per_sec": throughput.
+    """
+    start = time.monotonic()
+    items = 0
+    failed = {}
+
+    def flush(batch):
+        failed.update(table.batch_put(batch))
+        if progress is not None:
+            progress(len(batch))
+
+    with gzip.open(path, 'rt') as inp:
+        batch = []
+        for line in inp:
+            batch.append(storage.from_wire(
+                json.loads(line, use_decimal=True)))
+            if len(batch) == batch_size:
+                flush(batch)
+                items += len(batch)
+                batch = []
+        if batch:
+            flush(batch)
+            items += len(batch)
+    return stats(items - len(failed), start, failed=failed)
+
+
+def stats(items, start, **extra):
+    """Return the throughput statistics for `items` processed
+    since the time.monotonic() value `start`."""
+    seconds = time.monotonic() - start
+    result = {"items": items,
+              "seconds": round(seconds, 3),
+              "items_per_sec": round(items / seconds, 1) if seconds else None}
+    result.update(extra)
+    return result
@@ -0,0 +1,787 @@
+"""
+Storage drivers for the database service.
+
+A driver hands out Table objects, one per table in the backend.
+Every Table supports the same operations, so the service does not
+depend on which backend is in use:
+
+* DynamoDBDriver: Amazon DynamoDB (or a DynamoDB Local instance).
+* MemoryDriver: Python dicts in this process.  Contents are lost
+  when the process exits.  Intended for tests and for measuring
+  the overhead of the services independently of the backend.
+
+Top-level attributes may hold binary values and string sets.  Tables
+return them as bytes-like objects and sets; to_wire() and from_wire()
+convert them to and from {"B": base64 string} and {"SS": [string, ...]}
+for JSON.
+
+Every operation that writes an item also sets its VERSION_ATTR to a
+fresh random token, so callers can tell whether an item has changed
+since they read it.  The token is random rather than a counter
+because a put replaces the whole item, and a counter restarting at 1
+could repeat a version the caller already holds.
+"""
+
+# Standard library modules
+import base64
+import binascii
+import copy
+import functools
+import random
+import threading
+import time
+import uuid
+import zlib
+
+# Installed packages
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+
+from botocore.exceptions import ClientError
+
+# DynamoDB accepts at most 100 keys in one BatchGetItem call
+# and at most 25 puts in one BatchWriteItem call
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+# Retry schedule for keys DynamoDB returns as unprocessed
+BATCH_RETRIES = 8
+BATCH_BACKOFF_BASE_SEC = 0.05
+BATCH_BACKOFF_MAX_SEC = 2.0
+
+# Attempts at a list removal that races with other updates
+LIST_RETRIES = 5
+
+# Most values in one list_append() or list_remove().  Each value adds
+# a clause to the DynamoDB condition expression, which is limited to
+# 4 KB; 100 clauses stay well inside it.
+LIST_MAX_VALUES = 100
+
+# A successful response from a driver that has no response of its own
+OK_RESPONSE = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+# Attribute that every write to an item sets to a new version token
+VERSION_ATTR = 'Version'
+
+
+class ItemNotFound(Exception):
+    """The operation requires an item that does not exist."""
+
+
+class NotAList(Exception):
+    """The attribute of a list operation holds a value that is
+    not a list, such as a packed playlist."""
+
+
+class ConditionFailed(Exception):
+    """The item does not satisfy the operation's precondition.
+
+    Parameters
+    ----------
+    values: list
+        The values that violated the precondition.
+    """
+    def __init__(self, values):
+        super().__init__(values)
+        self.values = values
+
+
+def check_list(item, attr):
+    '''Raise NotAList unless attribute `attr` of `item` is a list'''
+    if not isinstance(item[attr], list):
+        raise NotAList('{} is not a list'.format(attr))
+
+
+def new_version():
+    '''Return a fresh token for VERSION_ATTR'''
+    return uuid.uuid4().hex
+
+
+def versioned(item):
+    '''Return a copy of the dict `item` with a fresh VERSION_ATTR'''
+    return dict(item, **{VERSION_ATTR: new_version()})
+
+
+def backoff(attempt):
+    '''Sleep before retry number `attempt` (exponential, full jitter)'''
+    delay = min(BATCH_BACKOFF_MAX_SEC,
+                BATCH_BACKOFF_BASE_SEC * (2 ** attempt))
+    time.sleep(random.uniform(0, delay))
+
+
+def update_expression(attrs):
+    '''
+    Return (UpdateExpression, ExpressionAttributeNames) for setting
+    the attribute names in the tuple `attrs`.  The value for attrs[i]
+    must be bound to ":v<i>".
+    '''
+    names = {'#a{}'.format(i): a for i, a in enumerate(attrs)}
+    expression = 'SET ' + ', '.join(
+        '#a{0} = :v{0}'.format(i) for i in range(len(attrs)))
+    return expression, names
+
+
+def projection_expression(attrs):
+    '''
+    Return (ProjectionExpression, ExpressionAttributeNames) selecting
+    the attribute names in the tuple `attrs`.
+    '''
+    names = {'#p{}'.format(i): a for i, a in enumerate(attrs)}
+    return ', '.join(names), names
+
+
+def project(item, fields):
+    '''Return the attributes of `item` named in `fields`'''
+    return {f: item[f] for f in fields if f in item}
+
+
+def to_wire(item):
+    '''Return `item` with its binary attributes as {"B": base64}
+    and its string sets as {"SS": sorted list}'''
+    special = [a for a, v in item.items()
+               if isinstance(v, (bytes, bytearray, Binary, set))]
+    if not special:
+        return item
+    item = dict(item)
+    for a in special:
+        value = item[a]
+        if isinstance(value, set):
+            item[a] = {"SS": sorted(value)}
+            continue
+        if isinstance(value, Binary):
+            value = value.value
+        item[a] = {"B": base64.b64encode(value).decode()}
+    return item
+
+
+def from_wire(values):
+    '''
+    Return the dict of attribute `values` with every {"B": base64}
+    attribute decoded to bytes and every {"SS": list} to a set.
+    Raises ValueError on bad base64 or an empty set.
+    '''
+    special = [a for a, v in values.items()
+               if isinstance(v, dict) and len(v) == 1 and
+               ('B' in v or 'SS' in v)]
+    if not special:
+        return values
+    values = dict(values)
+    for a in special:
+        if 'SS' in values[a]:
+            if not values[a]['SS']:
+                raise ValueError('Empty set for {}'.format(a))
+            values[a] = set(values[a]['SS'])
+            continue
+        try:
+            values[a] = base64.b64decode(values[a]['B'], validate=True)
+        except (TypeError, binascii.Error) as e:
+            raise ValueError('Bad binary value for {}'.format(a)) from e
+    return values
+
+
+def dedup_chunks(items, key, size):
+    """Split `items` into lists of at most `size` items, starting
+    a new list whenever a key repeats within the current one."""
+    chunk = []
+    keys = set()
+    for item in items:
+        if item[key] in keys or len(chunk) == size:
+            yield chunk
+            chunk = []
+            keys = set()
+        chunk.append(item)
+        keys.add(item[key])
+    if chunk:
+        yield chunk
+
+
+class Table():
+    """Interface to one table of a storage backend.
+
+    Items are dicts that include the key attribute.  Keys are
+    the values of the key attribute.  Every method that writes an
+    item sets its VERSION_ATTR, overriding any value the caller
+    gives.
+
+    Parameters
+    ----------
+    name: string
+        The name of the table in the backend.
+    key: string
+        The name of the key attribute.
+    indexes: dict (optional)
+        Secondary indexes, mapping each index name to the names of
+        its (partition key, sort key) attributes.  Items lacking
+        either attribute are not in the index.
+    """
+    def __init__(self, name, key, indexes=None):
+        self.name = name
+        self.key = key
+        self.indexes = dict(indexes or {})
+
+    def get(self, key, fields=None, consistent=False):
+        """Return the item with `key`, or None if there is none.
+
+        Parameters
+        ----------
+        key:
+            The key of the item.
+        fields: tuple of string (optional)
+            Return only these attributes (and always the key).
+        consistent: bool (optional)
+            If True, the read reflects every write that completed
+            before it.  Otherwise, the backend may return a slightly
+            stale item at lower cost.
+        """
+        raise NotImplementedError
+
+    def put(self, item):
+        """Create or replace `item`."""
+        raise NotImplementedError
+
+    def update(self, key, values):
+        """Set the attributes in the dict `values` on the item
+        with `key` and return the backend's response."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete the item with `key` and return the backend's
+        response.  Deleting a missing item is not an error."""
+        raise NotImplementedError
+
+    def list_append(self, key, attr, values):
+        """Atomically append the list of distinct `values` to the
+        list attribute `attr` of the item with `key`, and return the
+        backend's response.
+
+        Raises ItemNotFound if there is no item with `key` or it has
+        no attribute `attr`, NotAList if `attr` is not a list, and
+        ConditionFailed, listing the values already present, if the
+        list already holds any of `values`.  Nothing is appended
+        if any is raised.  At most LIST_MAX_VALUES values.
+        """
+        raise NotImplementedError
+
+    def list_remove(self, key, attr, values):
+        """Atomically remove the list of distinct `values` from the
+        list attribute `attr` of the item with `key`, and return the
+        backend's response.
+
+        Raises ItemNotFound if there is no item with `key` or it has
+        no attribute `attr`, NotAList if `attr` is not a list, and
+        ConditionFailed, listing the missing values, if the list
+        does not hold all of `values`.  Nothing is removed if any
+        is raised.  At most LIST_MAX_VALUES values.
+        """
+        raise NotImplementedError
+
+    def replace(self, key, attr, expected, value, others=None):
+        """Atomically set attribute `attr` of the item with `key`
+        to `value` if it currently equals `expected`, and return the
+        backend's response.  An `expected` of None means that the
+        attribute must be absent.  The attributes in the dict
+        `others` are set in the same update.
+
+        Raises ItemNotFound if there is no item with `key`, and
+        ConditionFailed (with no values) if `attr` does not hold
+        `expected`.
+        """
+        raise NotImplementedError
+
+    def set_add(self, key, attr, values):
+        """Atomically add the list of strings `values` to the string
+        set attribute `attr` of the item with `key`, creating the
+        item and the set as needed, and return the backend's
+        response."""
+        raise NotImplementedError
+
+    def set_remove(self, key, attr, values):
+        """Atomically remove the list of strings `values` from the
+        string set attribute `attr` of the item with `key`, and return
+        the backend's response.  Absent values are ignored and an
+        emptied set is removed, as DynamoDB cannot store one.  A
+        missing item is not created."""
+        raise NotImplementedError
+
+    def batch_get(self, keys):
+        """Fetch the items for a list of distinct keys.
+
+        Returns
+        -------
+        (items, unprocessed)
+            The items found, in no particular order, and the list
+            of keys that could not be read.
+        """
+        raise NotImplementedError
+
+    def batch_put(self, items):
+        """Create or replace a list of items.  If a key repeats,
+        the later item wins.
+
+        Returns
+        -------
+        dict
+            Maps the key of each item that could not be written
+            to a string giving the reason.
+        """
+        raise NotImplementedError
+
+    def scan(self, limit=None, start_key=None, segment=0, total_segments=1):
+        """Read one page of the table.
+
+        Parameters
+        ----------
+        limit: int (optional)
+            Maximum number of items to return.
+        start_key: (optional)
+            Continue after this key, as returned by a previous call.
+        segment, total_segments: int (optional)
+            Read only segment number `segment` of the table divided
+            into `total_segments` disjoint segments.
+
+        Returns
+        -------
+        (items, last_key)
+            last_key is None when there are no more items.
+        """
+        raise NotImplementedError
+
+    def query(self, index, value, prefix=None, limit=None, start_key=None):
+        """Read one page of the items in secondary index `index`
+        whose partition key is `value`, in sort key order.
+
+        Parameters
+        ----------
+        index: string
+            The name of the index, one of `indexes`.
+        value:
+            The partition key value to match.
+        prefix: string (optional)
+            Match only items whose sort key starts with `prefix`.
+        limit, start_key: (optional)
+            As for scan().  Here a key is a dict of attribute values.
+
+        Returns
+        -------
+        (items, last_key)
+            last_key is None when there are no more items.
+        """
+        raise NotImplementedError
+
+
+class DynamoDBTable(Table):
+    """Table stored in DynamoDB.
+
+    Parameters
+    ----------
+    dynamodb: boto3 DynamoDB ServiceResource
+    name, key, indexes: see Table.
+    """
+    def __init__(self, dynamodb, name, key, indexes=None):
+        super().__init__(name, key, indexes)
+        self._dynamodb = dynamodb
+        self._table = dynamodb.Table(name)
+        # Callers tend to update the same few attribute sets
+        self._update_expression = functools.lru_cache(maxsize=256)(
+            update_expression)
+        self._projection_expression = functools.lru_cache(maxsize=256)(
+            projection_expression)
+
+    def get(self, key, fields=None, consistent=False):
+        kwargs = {'Key': {self.key: key}, 'ConsistentRead': consistent}
+        if fields is not None:
+            if self.key not in fields:
+                fields = (self.key,) + tuple(fields)
+            expression, names = self._projection_expression(fields)
+            kwargs['ProjectionExpression'] = expression
+            kwargs['ExpressionAttributeNames'] = names
+        return self._table.get_item(**kwargs).get('Item')
+
+    def put(self, item):
+        self._table.put_item(Item=versioned(item))
+
+    def update(self, key, values):
+        values = versioned(values)
+        attrs = tuple(sorted(values))
+        expression, names = self._update_expression(attrs)
+        attrvals = {':v{}'.format(i): values[a] for i, a in enumerate(attrs)}
+        return self._table.update_item(Key={self.key: key},
+                                       UpdateExpression=expression,
+                                       ExpressionAttributeNames=names,
+                                       ExpressionAttributeValues=attrvals)
+
+    def delete(self, key):
+        return self._table.delete_item(Key={self.key: key})
+
+    def list_append(self, key, attr, values):
+        names = {'#a': attr, '#ver': VERSION_ATTR}
+        attrvals = {':new': list(values), ':ver': new_version()}
+        conditions = ['attribute_exists(#a)']
+        for i, v in enumerate(values):
+            attrvals[':v{}'.format(i)] = v
+            conditions.append('NOT contains(#a, :v{})'.format(i))
+        try:
+            return self._table.update_item(
+                Key={self.key: key},
+                UpdateExpression=(
+                    'SET #a = list_append(#a, :new), #ver = :ver'),
+                ConditionExpression=' AND '.join(conditions),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=attrvals)
+        except ClientError as e:
+            # An attribute of another type fails validation
+            error = e
+            if e.response['Error']['Code'] not in (
+                    'ConditionalCheckFailedException',
+                    'ValidationException'):
+                raise
+        # Find out which condition failed
+        item = self.get(key, fields=(attr,), consistent=True)
+        if item is None or attr not in item:
+            raise ItemNotFound(key)
+        check_list(item, attr)
+        if error.response['Error']['Code'] == 'ValidationException':
+            raise error
+        present = set(item[attr])
+        raise ConditionFailed([v for v in values if v in present])
+
+    def list_remove(self, key, attr, values):
+        # DynamoDB can only REMOVE list elements by index, so find
+        # the indexes and make the removal conditional on them still
+        # holding the values.  Retry if another update moved them.
+        for attempt in range(LIST_RETRIES):
+            item = self.get(key, fields=(attr,), consistent=True)
+            if item is None or attr not in item:
+                raise ItemNotFound(key)
+            check_list(item, attr)
+            positions = {}
+            for i, v in enumerate(item[attr]):
+                positions.setdefault(v, i)
+            missing = [v for v in values if v not in positions]
+            if missing:
+                raise ConditionFailed(missing)
+            indexes = [positions[v] for v in values]
+            attrvals = {':v{}'.format(n): v for n, v in enumerate(values)}
+            attrvals[':ver'] = new_version()
+            try:
+                return self._table.update_item(
+                    Key={self.key: key},
+                    UpdateExpression='REMOVE ' + ', '.join(
+                        '#a[{}]'.format(i) for i in indexes) + (
+                        ' SET #ver = :ver'),
+                    ConditionExpression=' AND '.join(
+                        '#a[{}] = :v{}'.format(i, n)
+                        for n, i in enumerate(indexes)),
+                    ExpressionAttributeNames={'#a': attr,
+                                              '#ver': VERSION_ATTR},
+                    ExpressionAttributeValues=attrvals)
+            except ClientError as e:
+                if e.response['Error']['Code'] != (
+                        'ConditionalCheckFailedException'):
+                    raise
+            backoff(attempt)
+        raise ConditionFailed([])
+
+    def replace(self, key, attr, expected, value, others=None):
+        names = {'#k': self.key, '#a': attr}
+        attrvals = {':new': value}
+        update = 'SET #a = :new'
+        for i, (a, v) in enumerate(sorted(versioned(others or {}).items())):
+            names['#o{}'.format(i)] = a
+            attrvals[':o{}'.format(i)] = v
+            update += ', #o{0} = :o{0}'.format(i)
+        if expected is None:
+            condition = 'attribute_exists(#k) AND attribute_not_exists(#a)'
+        else:
+            condition = 'attribute_exists(#k) AND #a = :old'
+            attrvals[':old'] = expected
+        try:
+            return self._table.update_item(
+                Key={self.key: key},
+                UpdateExpression=update,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=attrvals)
+        except ClientError as e:
+            if e.response['Error']['Code'] != (
+                    'ConditionalCheckFailedException'):
+                raise
+        if self.get(key, fields=(self.key,), consistent=True) is None:
+            raise ItemNotFound(key)
+        raise ConditionFailed([])
+
+    def set_add(self, key, attr, values):
+        return self._table.update_item(
+            Key={self.key: key},
+            UpdateExpression='ADD #a :v SET #ver = :ver',
+            ExpressionAttributeNames={'#a': attr, '#ver': VERSION_ATTR},
+            ExpressionAttributeValues={':v': set(values),
+                                       ':ver': new_version()})
+
+    def set_remove(self, key, attr, values):
+        try:
+            return self._table.update_item(
+                Key={self.key: key},
+                UpdateExpression='DELETE #a :v SET #ver = :ver',
+                ConditionExpression='attribute_exists(#k)',
+                ExpressionAttributeNames={'#k': self.key, '#a': attr,
+                                          '#ver': VERSION_ATTR},
+                ExpressionAttributeValues={':v': set(values),
+                                           ':ver': new_version()})
+        except ClientError as e:
+            if e.response['Error']['Code'] != (
+                    'ConditionalCheckFailedException'):
+                raise
+        return OK_RESPONSE
+
+    def batch_get(self, keys):
+        items = []
+        unprocessed = []
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            pending = [{self.key: k} for k in keys[i:i+BATCH_GET_SIZE]]
+            attempt = 0
+            while pending:
+                response = self._dynamodb.batch_get_item(
+                    RequestItems={self.name: {'Keys': pending}})
+                items.extend(response['Responses'].get(self.name, []))
+                pending = (response.get('UnprocessedKeys', {})
+                           .get(self.name, {})
+                           .get('Keys', []))
+                if not pending:
+                    break
+                if attempt >= BATCH_RETRIES:
+                    unprocessed.extend(k[self.key] for k in pending)
+                    break
+                backoff(attempt)
+                attempt += 1
+        return items, unprocessed
+
+    def batch_put(self, items):
+        failed = {}
+        # BatchWriteItem rejects a request that names the same key twice
+        for chunk in dedup_chunks(items, self.key, BATCH_WRITE_SIZE):
+            pending = [{'PutRequest': {'Item': versioned(item)}}
+                       for item in chunk]
+            try:
+                attempt = 0
+                while pending:
+                    response = self._dynamodb.batch_write_item(
+                        RequestItems={self.name: pending})
+                    pending = (response.get('UnprocessedItems', {})
+                               .get(self.name, []))
+                    if not pending or attempt >= BATCH_RETRIES:
+                        break
+                    backoff(attempt)
+                    attempt += 1
+            except ClientError as e:
+                reason = e.response['Error']['Message']
+                failed.update((item[self.key], reason) for item in chunk)
+                continue
+            for put in pending:
+                failed[put['PutRequest']['Item'][self.key]] = (
+                    'Unprocessed after retries')
+        return failed
+
+    def scan(self, limit=None, start_key=None, segment=0, total_segments=1):
+        kwargs = {}
+        if limit is not None:
+            kwargs['Limit'] = limit
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = {self.key: start_key}
+        if total_segments > 1:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = total_segments
+        response = self._table.scan(**kwargs)
+        last = response.get('LastEvaluatedKey')
+        return response['Items'], None if last is None else last[self.key]
+
+    def query(self, index, value, prefix=None, limit=None, start_key=None):
+        partition, sort = self.indexes[index]
+        condition = Key(partition).eq(value)
+        if prefix is not None:
+            condition = condition & Key(sort).begins_with(prefix)
+        kwargs = {'IndexName': index, 'KeyConditionExpression': condition}
+        if limit is not None:
+            kwargs['Limit'] = limit
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = start_key
+        response = self._table.query(**kwargs)
+        return response['Items'], response.get('LastEvaluatedKey')
+
+
+class DynamoDBDriver():
+    """Driver for DynamoDB.
+
+    Parameters
+    ----------
+    dynamodb: boto3 DynamoDB ServiceResource
+    """
+    def __init__(self, dynamodb):
+        self._dynamodb = dynamodb
+
+    def table(self, name, key, indexes=None):
+        """Return the Table `name` with key attribute `key` and
+        secondary `indexes`, which must exist in DynamoDB."""
+        return DynamoDBTable(self._dynamodb, name, key, indexes)
+
+
+class MemoryTable(Table):
+    """Table stored in a dict in this process.
+
+    Items are copied in and out, so callers cannot modify the
+    stored values.  A query examines every item.
+    """
+    def __init__(self, name, key, indexes=None):
+        super().__init__(name, key, indexes)
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, key, fields=None, consistent=False):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and fields is not None:
+                item = project(item, (self.key,) + tuple(fields))
+            return copy.deepcopy(item)
+
+    def put(self, item):
+        item = versioned(copy.deepcopy(item))
+        with self._lock:
+            self._items[item[self.key]] = item
+
+    def update(self, key, values):
+        values = versioned(copy.deepcopy(values))
+        with self._lock:
+            self._items.setdefault(key, {self.key: key}).update(values)
+        return OK_RESPONSE
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+        return OK_RESPONSE
+
+    def list_append(self, key, attr, values):
+        values = copy.deepcopy(values)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or attr not in item:
+                raise ItemNotFound(key)
+            check_list(item, attr)
+            current = item[attr]
+            present = [v for v in values if v in current]
+            if present:
+                raise ConditionFailed(present)
+            current.extend(values)
+            item[VERSION_ATTR] = new_version()
+        return OK_RESPONSE
+
+    def list_remove(self, key, attr, values):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or attr not in item:
+                raise ItemNotFound(key)
+            check_list(item, attr)
+            current = item[attr]
+            missing = [v for v in values if v not in current]
+            if missing:
+                raise ConditionFailed(missing)
+            for v in values:
+                current.remove(v)
+            item[VERSION_ATTR] = new_version()
+        return OK_RESPONSE
+
+    def replace(self, key, attr, expected, value, others=None):
+        values = versioned(copy.deepcopy(others or {}))
+        values[attr] = copy.deepcopy(value)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                raise ItemNotFound(key)
+            if item.get(attr) != expected:
+                raise ConditionFailed([])
+            item.update(values)
+        return OK_RESPONSE
+
+    def set_add(self, key, attr, values):
+        with self._lock:
+            item = self._items.setdefault(key, {self.key: key})
+            item.setdefault(attr, set()).update(values)
+            item[VERSION_ATTR] = new_version()
+        return OK_RESPONSE
+
+    def set_remove(self, key, attr, values):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if attr in item:
+                    item[attr].difference_update(values)
+                    if not item[attr]:
+                        del item[attr]
+                item[VERSION_ATTR] = new_version()
+        return OK_RESPONSE
+
+    def batch_get(self, keys):
+        with self._lock:
+            items = [self._items[k] for k in keys if k in self._items]
+        return copy.deepcopy(items), []
+
+    def batch_put(self, items):
+        items = [versioned(item) for item in copy.deepcopy(items)]
+        with self._lock:
+            for item in items:
+                self._items[item[self.key]] = item
+        return {}
+
+    def scan(self, limit=None, start_key=None, segment=0, total_segments=1):
+        # Walk the keys in sorted order so that a start_key
+        # continues a scan regardless of intervening writes
+        with self._lock:
+            keys = sorted(self._items)
+            items = []
+            last_key = None
+            for k in keys:
+                if start_key is not None and k <= start_key:
+                    continue
+                if (total_segments > 1 and
+                        zlib.crc32(k.encode()) % total_segments != segment):
+                    continue
+                if limit is not None and len(items) == limit:
+                    last_key = items[-1][self.key]
+                    break
+                items.append(self._items[k])
+        return copy.deepcopy(items), last_key
+
+    def query(self, index, value, prefix=None, limit=None, start_key=None):
+        partition, sort = self.indexes[index]
+
+        def position(item):
+            return (item[sort], item[self.key])
+
+        with self._lock:
+            matches = sorted(
+                (item for item in self._items.values()
+                 if item.get(partition) == value and sort in item and
+                 (prefix is None or item[sort].startswith(prefix)) and
+                 (start_key is None or
+                  position(item) > position(start_key))),
+                key=position)
+            last_key = None
+            if limit is not None and len(matches) > limit:
+                matches = matches[:limit]
+                last_key = {a: matches[-1][a]
+                            for a in (self.key, partition, sort)}
+            return copy.deepcopy(matches), last_key
+
+
+class MemoryDriver():
+    """Driver for tables held in this process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def table(self, name, key, indexes=None):
+        """Return the Table `name` with key attribute `key` and
+        secondary `indexes`, creating an empty table on first use."""
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = MemoryTable(name, key, indexes)
+            return self._tables[name]
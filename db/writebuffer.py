@@ -0,0 +1,239 @@
+"""
+Coalescing of single-item writes into batch writes.
+
+The database service writes the item of each `/write` and `/load`
+through a WriteBuffer when DB_WRITE_BATCH_WINDOW_MS is above 0.  Items
+for one table arriving within the window are written together by
+the table's batch_put, which for DynamoDB is a BatchWriteItem of at
+most 25 items, and each caller waits for the outcome of its own item.
+AsyncWriteBuffer does the same for the asyncio version of the service
+and the tables of aiostorage.py.
+"""
+
+# Standard library modules
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+# Local modules
+import storage
+
+
+class QueueFull(Exception):
+    """The buffer held its maximum of unacknowledged items for the
+    whole queue timeout."""
+
+
+class WriteFailed(Exception):
+    """The batch write left the item unwritten.  `reason` says why."""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class WriteBuffer():
+    """Gathers the items put() within `window` seconds of each other
+    into batch writes.
+
+    put() blocks until its item is written, so a caller sees the same
+    acknowledgement as from Table.put().  At most `max_queue` items
+    wait at once; a put() that finds the buffer full waits up to
+    `queue_timeout` seconds for room and then raises QueueFull, which
+    pushes back on the callers while the backend is slow.
+
+    Parameters
+    ----------
+    window: float
+        Seconds the first item of a batch waits for others.  Zero
+        disables the buffer: `enabled` is False.
+    max_items: int
+        A batch reaching this many items is written without waiting.
+    max_queue: int
+        Maximum number of items waiting for their write.
+    queue_timeout: float
+        Seconds a put() waits for room in a full buffer.
+    threads: int
+        Batches written at once.
+    batch_items: prometheus_client.Histogram (optional)
+        Observes the number of items in each batch.
+    rejected: prometheus_client.Counter (optional)
+        Counter incremented for each QueueFull.
+    """
+    def __init__(self, window, max_items=storage.BATCH_WRITE_SIZE,
+                 max_queue=1000, queue_timeout=1.0, threads=4,
+                 batch_items=None, rejected=None):
+        self._window = window
+        self._max_items = max_items
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._threads = threads
+        self._batch_items = batch_items
+        self._rejected = rejected
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._waiting = 0
+        self._cond = threading.Condition()
+        # table name -> (table, [(item, future), ...])
+        self._pending = {}
+        self._deadline = None
+        # Started by the first put(), in the process that uses them
+        self._pool = None
+
+    @property
+    def enabled(self):
+        """True if put() coalesces writes."""
+        return self._window > 0
+
+    def depth(self):
+        """Return the number of items waiting for their write."""
+        return self._waiting
+
+    def put(self, table, item):
+        """Create or replace `item` in `table` as part of a batch and
+        return once it is written.
+
+        Raises QueueFull if there was no room in the buffer,
+        WriteFailed if the batch write did not write the item, and
+        whatever batch_put() raised if the batch failed as a whole.
+        """
+        if not self._slots.acquire(timeout=self._queue_timeout):
+            if self._rejected is not None:
+                self._rejected.inc()
+            raise QueueFull()
+        try:
+            future = concurrent.futures.Future()
+            full = None
+            with self._cond:
+                self._waiting += 1
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        self._threads, thread_name_prefix='writebuffer')
+                    threading.Thread(target=self._run, daemon=True).start()
+                batch = self._pending.setdefault(table.name, (table, []))[1]
+                batch.append((item, future))
+                if len(batch) >= self._max_items:
+                    full = self._pending.pop(table.name)
+                elif self._deadline is None:
+                    self._deadline = time.monotonic() + self._window
+                    self._cond.notify()
+            if full is not None:
+                self._pool.submit(self._write, *full)
+            future.result()
+        finally:
+            with self._cond:
+                self._waiting -= 1
+            self._slots.release()
+
+    def _run(self):
+        """Write the pending batches once their window has passed."""
+        while True:
+            with self._cond:
+                while self._deadline is None:
+                    self._cond.wait()
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                pending, self._pending = self._pending, {}
+                self._deadline = None
+            for table, batch in pending.values():
+                self._pool.submit(self._write, table, batch)
+
+    def _write(self, table, batch):
+        """Write the (item, future) pairs of `batch` to `table` and
+        resolve every one of their futures."""
+        if self._batch_items is not None:
+            self._batch_items.observe(len(batch))
+        try:
+            failed = table.batch_put([item for item, _ in batch])
+            for item, future in batch:
+                reason = failed.get(item[table.key])
+                if reason is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(WriteFailed(reason))
+        except Exception as e:
+            # Leave no caller waiting, whatever went wrong
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class AsyncWriteBuffer(WriteBuffer):
+    """WriteBuffer for coroutines of one event loop, writing through
+    the tables of aiostorage.py.
+
+        await buffer.put(table, item)
+
+    The parameters are those of WriteBuffer, with `threads` the number
+    of batches written at once.  A caller cancelled while waiting for
+    its write leaves the item in its batch.
+    """
+    def __init__(self, window, **kwargs):
+        super().__init__(window, **kwargs)
+        # Created by the first put(), in the event loop that uses them
+        self._room = None
+        self._writers = None
+        self._timer = None
+        # Batch writes in progress, held until they complete
+        self._tasks = set()
+
+    async def put(self, table, item):
+        """Create or replace `item` in `table` as part of a batch and
+        return once it is written.  Raises as WriteBuffer.put()."""
+        if self._room is None:
+            self._room = asyncio.Semaphore(self._max_queue)
+            self._writers = asyncio.Semaphore(self._threads)
+        try:
+            await asyncio.wait_for(self._room.acquire(), self._queue_timeout)
+        except asyncio.TimeoutError:
+            if self._rejected is not None:
+                self._rejected.inc()
+            raise QueueFull()
+        self._waiting += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            batch = self._pending.setdefault(table.name, (table, []))[1]
+            batch.append((item, future))
+            if len(batch) >= self._max_items:
+                self._start(*self._pending.pop(table.name))
+            elif self._timer is None:
+                self._timer = loop.call_later(self._window, self._flush)
+            await asyncio.shield(future)
+        finally:
+            self._waiting -= 1
+            self._room.release()
+
+    def _flush(self):
+        """Write the pending batches once their window has passed."""
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        for table, batch in pending.values():
+            self._start(table, batch)
+
+    def _start(self, table, batch):
+        """Start the task writing `batch` to `table`."""
+        task = asyncio.ensure_future(self._write(table, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, table, batch):
+        """Write the (item, future) pairs of `batch` to `table` and
+        resolve every one of their futures."""
+        async with self._writers:
+            if self._batch_items is not None:
+                self._batch_items.observe(len(batch))
+            try:
+                failed = await table.batch_put([item for item, _ in batch])
+                for item, future in batch:
+                    reason = failed.get(item[table.key])
+                    if reason is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(WriteFailed(reason))
+            except Exception as e:
+                # Leave no caller waiting, whatever went wrong
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -33,6 +33,9 @@ IC=istioctl
 APP_VER_TAG=v1
 S2_VER=v1
 LOADER_VER=v1
+# Dockerfile-asgi builds the asyncio version of the db service.
+# It runs as one process, without gunicorn (see db/asgi-tpl.py)
+DB_DOCKERFILE=Dockerfile
 
 # Kubernetes parameters that most of the time will be unchanged
 # but which you might override as projects become sophisticated
@@ -341,9 +344,9 @@ $(LOG_DIR)/s3.repo.log: s3/Dockerfile s3/app.py s3/requirements.txt
 	$(DK) push $(CREG)/$(REGID)/cmpt756s3:$(APP_VER_TAG) | tee $(LOG_DIR)/s3.repo.log
 
 # Build the db service
-$(LOG_DIR)/db.repo.log: db/Dockerfile db/app.py db/requirements.txt
+$(LOG_DIR)/db.repo.log: db/$(DB_DOCKERFILE) db/api.py db/app.py db/asgi.py db/aiostorage.py db/requirements.txt db/requirements-asgi.txt
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG) db | tee $(LOG_DIR)/db.img.log
+	$(DK) build $(ARCH) -f db/$(DB_DOCKERFILE) -t $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG) db | tee $(LOG_DIR)/db.img.log
 	$(DK) push $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG) | tee $(LOG_DIR)/db.repo.log
 
 # Build the loader
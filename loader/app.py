@@ -15,6 +15,9 @@ import requests
 
 loader_token = os.getenv('SVC_LOADER_TOKEN')
 
+# Number of records sent in each `/batch_load` request
+BATCH_SIZE = int(os.getenv('LOADER_BATCH_SIZE', '1000'))
+
 # Enough time for Envoy proxy to initialize
 # This is only needed if the loader is run with
 # Istio injection.  `cluster/loader-tpl.yaml`
@@ -25,63 +28,64 @@ db = {
     "name": "http://cmpt756db:30002/api/v1/datastore",
 }
 
+# The playlist service keeps an index of music ids.  Songs loaded
+# here bypass the music service, so the playlist service is told of
+# them directly.
+PLAYLIST_URL = os.getenv('PLAYLIST_URL',
+                         'http://cmpt756s3:30003/api/v1/playlist')
+
 
 def build_auth():
     """Return a loader Authorization header in Basic format"""
-    global loader_token
     return requests.auth.HTTPBasicAuth('svc-loader', loader_token)
 
 
-def create_user(lname, fname, email, uuid):
+def user_record(lname, fname, email, uuid):
     """
-    Create a user.
+    Return the record for a user.
     If a record already exists with the same fname, lname, and email,
     the old UUID is replaced with this one.
     """
-    url = db['name'] + '/load'
-    response = requests.post(
-        url,
-        auth=build_auth(),
-        json={"objtype": "user",
-              "lname": lname,
-              "email": email,
-              "fname": fname,
-              "uuid": uuid})
-    return (response.json())
-
-
-def create_song(artist, title, uuid):
+    return {"objtype": "user",
+            "lname": lname,
+            "email": email,
+            "fname": fname,
+            "uuid": uuid}
+
+
+def song_record(artist, title, uuid):
     """
-    Create a song.
+    Return the record for a song.
     If a record already exists with the same artist and title,
     the old UUID is replaced with this one.
     """
-    url = db['name'] + '/load'
-    response = requests.post(
-        url,
-        auth=build_auth(),
-        json={"objtype": "music",
-              "Artist": artist,
-              "SongTitle": title,
-              "uuid": uuid})
-    return (response.json())
-
-#update of create playlist
-def create_playlist(name, playlist, uuid):
+    return {"objtype": "music",
+            "Artist": artist,
+            "SongTitle": title,
+            "uuid": uuid}
+
+
+def playlist_record(name, playlist, uuid):
     """
-    Create a playlist.
+    Return the record for a playlist.
     """
-    url = db['name'] + '/load'
-    response = requests.post(
-        url,
-        auth=build_auth(),
-        json={"objtype": "playlist",
-              "Name": name,
-              "Playlist": playlist,
-              "uuid": uuid})
-    return (response.json())
+    return {"objtype": "playlist",
+            "Name": name,
+            "Playlist": playlist,
+            "uuid": uuid}
 
-#end of update of create playlist
+
+def load_batch(records):
+    """
+    Load a list of records in one `/batch_load` call.
+    Return one result per record, in the same order.
+    """
+    url = db['name'] + '/batch_load'
+    response = requests.post(url, auth=build_auth(), json=records)
+    resp = response.json()
+    if 'Results' not in resp:
+        return [resp] * len(records)
+    return resp['Results']
 
 
 def check_resp(resp, key):
@@ -91,53 +95,65 @@ def check_resp(resp, key):
         return resp[key]
 
 
+def load_csv(path, make_record, key):
+    """
+    Load every row of the CSV file `path` through `/batch_load`.
+
+    `make_record` converts the stripped fields of a row into a
+    record.  Rows whose record was not stored under its own UUID
+    are reported.
+    """
+    with open(path, 'r') as inp:
+        rdr = csv.reader(inp)
+        next(rdr)  # Skip header
+        batch = []
+        for row in rdr:
+            batch.append(make_record(*[f.strip() for f in row]))
+            if len(batch) == BATCH_SIZE:
+                report(batch, load_batch(batch), key)
+                batch = []
+        if batch:
+            report(batch, load_batch(batch), key)
+
+
+def report(records, results, key):
+    loaded = []
+    for record, resp in zip(records, results):
+        if check_resp(resp, key) != record['uuid']:
+            print('Error creating {} {}: {}'.format(record['objtype'],
+                                                    record['uuid'],
+                                                    resp))
+        else:
+            loaded.append(record['uuid'])
+    if key == 'music_id' and loaded:
+        notify_playlist(loaded)
+
+
+def notify_playlist(music_ids):
+    """
+    Tell the playlist service about loaded songs.
+    Best effort: it also rebuilds its index periodically.
+    """
+    try:
+        requests.post(PLAYLIST_URL + '/music_ids', auth=build_auth(),
+                      json={"added": music_ids}, timeout=5)
+    except requests.RequestException as e:
+        print('Could not notify playlist service: {}'.format(e))
+
+
 if __name__ == '__main__':
     # Give Istio proxy time to initialize
     time.sleep(INITIAL_WAIT_SEC)
 
     resource_dir = '/data'
 
-    with open('{}/users/users.csv'.format(resource_dir), 'r') as inp:
-        rdr = csv.reader(inp)
-        next(rdr)  # Skip header
-        for fn, ln, email, uuid in rdr:
-            resp = create_user(fn.strip(),
-                               ln.strip(),
-                               email.strip(),
-                               uuid.strip())
-            resp = check_resp(resp, 'user_id')
-            if resp is None or resp != uuid:
-                print('Error creating user {} {} ({}), {}'.format(fn,
-                                                                  ln,
-                                                                  email,
-                                                                  uuid))
-
-    with open('{}/music/music.csv'.format(resource_dir), 'r') as inp:
-        rdr = csv.reader(inp)
-        next(rdr)  # Skip header
-        for artist, title, uuid in rdr:
-            resp = create_song(artist.strip(),
-                               title.strip(),
-                               uuid.strip())
-            resp = check_resp(resp, 'music_id')
-            if resp is None or resp != uuid:
-                print('Error creating song {} {}, {}'.format(artist,
-                                                             title,
-                                                             uuid))
-#update of create playlist
-    with open('{}/playlist/playlist.csv'.format(resource_dir), 'r') as inp:
-        rdr = csv.reader(inp)
-        next(rdr)  # Skip header
-        for name, playlist, uuid in rdr:
-            resp = create_playlist(name.strip(),
-                               playlist.strip().split(","),
-                               uuid.strip())
-            resp = check_resp(resp, 'playlist_id')
-            if resp is None or resp != uuid:
-                print('Error creating playlist {} {}, {}'.format(name,
-                                                             playlist,
-                                                             uuid))
-    
-
-
-#end of update of create playlist
\ No newline at end of file
+    load_csv('{}/users/users.csv'.format(resource_dir),
+             user_record,
+             'user_id')
+    load_csv('{}/music/music.csv'.format(resource_dir),
+             song_record,
+             'music_id')
+    load_csv('{}/playlist/playlist.csv'.format(resource_dir),
+             lambda name, playlist, uuid: playlist_record(
+                 name, playlist.split(","), uuid),
+             'playlist_id')
@@ -5,6 +5,7 @@ Simple command-line interface to music service
 # Standard library modules
 import argparse
 import cmd
+import json
 import re
 
 # Installed packages
@@ -92,15 +93,17 @@ Enter 'help' for command list.
         read 6ecfafd0-8a35-4af6-a9e2-cbd79b3abeea
             Return "The Last Great American Dynasty".
         read
-            Return all songs (if the server supports this).
+            Return all songs.
 
         Notes
         -----
-        Some versions of the server do not support listing
-        all songs and will instead return an empty list if
-        no parameter is provided.
+        The full list is streamed by the server one song per
+        line and printed as it arrives.
         """
         url = get_music_url(self.music_name, self.music_port)
+        if arg.strip() == '':
+            self.list_songs(url)
+            return
         r = requests.get(
             url+arg.strip(),
             headers={'Authorization': DEFAULT_AUTH}
@@ -118,6 +121,33 @@ Enter 'help' for command list.
                 i['Artist'],
                 i['SongTitle']))
 
+    def list_songs(self, url):
+        """
+        Print every song from the streamed list at `url`.
+        """
+        r = requests.get(
+            url,
+            headers={'Authorization': DEFAULT_AUTH},
+            stream=True
+            )
+        if r.status_code != 200:
+            print("Non-successful status code:", r.status_code)
+            return
+        count = 0
+        for line in r.iter_lines():
+            if not line:
+                continue
+            i = json.loads(line)
+            if 'error' in i:
+                print("Listing failed:", i)
+                break
+            print("{}  {:20.20s} {}".format(
+                i['music_id'],
+                i['Artist'],
+                i['SongTitle']))
+            count += 1
+        print("{} items returned".format(count))
+
 
     def do_create(self, arg):
         """
@@ -247,6 +277,7 @@ Enter 'help' for command list.
         url = get_playlist_url(self.playlist_name, self.playlist_port)
         r = requests.get(
             url+arg.strip(),
+            params={'expand': 'music'},
             headers={'Authorization': DEFAULT_AUTH}
             )
         if r.status_code != 200:
@@ -257,10 +288,14 @@ Enter 'help' for command list.
             return
         print("{} items returned".format(items['Count']))
         for i in items['Items']:
-            print("{}  {:20.20s} {}".format(
+            print("{}  {}".format(
                 i['playlist_id'],
-                i['Name'],
-                i['Playlist']))
+                i['Name']))
+            for s in i['Songs']:
+                print("  {}  {:20.20s} {}".format(
+                    s['music_id'],
+                    s.get('Artist', '(deleted)'),
+                    s.get('SongTitle', '')))
 
 
     def do_deletePlaylist(self, arg):
@@ -16,17 +16,17 @@ from flask import Response
 
 import jwt
 
-from prometheus_flask_exporter import PrometheusMetrics
-
-import requests
-
 import simplejson as json
 
+# Local modules
+import dbclient
+import serving
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = serving.flask_metrics(app)
 metrics.info('app_info', 'User process')
 
 bp = Blueprint('app', __name__)
@@ -41,6 +41,12 @@ db = {
     ]
 }
 
+session = dbclient.pooled_session(metrics.registry)
+
+# Item reads are batched with the reads of concurrent requests
+# (see dbclient.py)
+loader = dbclient.ReadLoader(session, db['name'], metrics.registry)
+
 
 @bp.route('/', methods=['GET'])
 @metrics.do_not_track()
@@ -77,7 +83,7 @@ def update_user(user_id):
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
+    response = session.put(
         url,
         params={"objtype": "user", "objkey": user_id},
         json={"email": email, "fname": fname, "lname": lname})
@@ -99,7 +105,7 @@ def create_user():
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
+    response = session.post(
         url,
         json={"objtype": "user",
               "lname": lname,
@@ -118,8 +124,8 @@ def delete_user(user_id):
                         mimetype='application/json')
     url = db['name'] + '/' + db['endpoint'][2]
 
-    response = requests.delete(url,
-                               params={"objtype": "user", "objkey": user_id})
+    response = session.delete(url,
+                              params={"objtype": "user", "objkey": user_id})
     return (response.json())
 
 
@@ -132,10 +138,11 @@ def get_user(user_id):
             json.dumps({"error": "missing auth"}),
             status=401,
             mimetype='application/json')
-    payload = {"objtype": "user", "objkey": user_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params=payload)
-    return (response.json())
+    result = loader.load("user", user_id).result().json()
+    unchanged = dbclient.not_modified(dbclient.item_version(result))
+    if unchanged is not None:
+        return unchanged
+    return dbclient.with_etag(result)
 
 
 @bp.route('/login', methods=['PUT'])
@@ -145,8 +152,7 @@ def login():
         uid = content['uid']
     except Exception:
         return json.dumps({"message": "error reading parameters"})
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params={"objtype": "user", "objkey": uid})
+    response = loader.load("user", uid).result()
     data = response.json()
     if len(data['Items']) > 0:
         encoded = jwt.encode({'user_id': uid, 'time': time.time()},
@@ -176,5 +182,7 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    if serving.web_server == 'gunicorn':
+        serving.exec_gunicorn(p)
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
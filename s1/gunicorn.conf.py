@@ -0,0 +1,60 @@
+"""
+Gunicorn settings for the production serving mode (see serving.py).
+
+Environment variables:
+WEB_WORKERS: worker processes (default: the number of cores).
+WEB_THREADS: threads per worker (default 8).
+WEB_TIMEOUT_SEC: a worker silent for this long is restarted
+    (default 30).
+WEB_GRACEFUL_TIMEOUT_SEC: time a worker being stopped or reloaded
+    has to finish its requests (default 30).
+PROMETHEUS_MULTIPROC_DIR: directory for the workers' metric files
+    (default a fresh directory under /tmp).
+
+Send SIGHUP to the master for a graceful reload: it starts new
+workers, with freshly loaded code and settings, then lets the old
+ones finish their requests.  Each worker imports the service itself,
+after the fork, so the service's background threads run in every
+worker; app.start_background() starts them.
+"""
+
+# Standard library modules
+import glob
+import multiprocessing
+import os
+import sys
+import tempfile
+
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count())))
+threads = int(os.getenv('WEB_THREADS', '8'))
+worker_class = 'gthread'
+timeout = int(os.getenv('WEB_TIMEOUT_SEC', '30'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT_SEC', '30'))
+# Threads started before the fork would not exist in the workers
+preload_app = False
+
+# Must be set before the workers import prometheus_client
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(
+        prefix='prometheus-')
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def on_starting(server):
+    # Drop the files of a previous run; a reload keeps them
+    for path in glob.glob(os.path.join(
+            os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(path)
+
+
+def post_worker_init(worker):
+    start = getattr(sys.modules.get('app'), 'start_background', None)
+    if start is not None:
+        start()
+
+
+def child_exit(server, worker):
+    from prometheus_flask_exporter.multiprocess import (
+        GunicornInternalPrometheusMetrics)
+    GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(
+        worker.pid)
@@ -0,0 +1,91 @@
+"""
+Serving modes and Prometheus metrics that work in both.
+
+* Development: `app.run()`, one process with threads.
+* Production (WEB_SERVER=gunicorn): `python app.py <port>` replaces
+  itself by a gunicorn master (see gunicorn.conf.py) that pre-forks
+  WEB_WORKERS worker processes, each with WEB_THREADS threads, so a
+  service uses more than one core.
+
+Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set and every worker
+writes its metric values to files there, which `/metrics` aggregates
+whichever worker serves it.  Gauges computed by a callback have no
+value in those files, so callback_gauge() instead sets them from the
+callback every GAUGE_REFRESH_SEC in each worker.
+"""
+
+# Standard library modules
+import multiprocessing
+import os
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Gauge
+
+from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import (
+    GunicornInternalPrometheusMetrics)
+
+# 'gunicorn' for the production server, else the development server
+web_server = os.getenv('WEB_SERVER', 'flask')
+
+# True in a gunicorn worker
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+# Worker processes under gunicorn (see gunicorn.conf.py)
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count())))
+
+GAUGE_REFRESH_SEC = float(os.getenv('GAUGE_REFRESH_SEC', '5'))
+
+# (gauge, callback) pairs refreshed by _refresh_gauges()
+_callbacks = []
+_lock = threading.Lock()
+
+
+def flask_metrics(app):
+    """Return the PrometheusMetrics for `app` in this serving mode."""
+    if MULTIPROCESS:
+        return GunicornInternalPrometheusMetrics(app)
+    return PrometheusMetrics(app)
+
+
+def callback_gauge(name, documentation, f, registry, mode='livesum'):
+    """
+    Return a Gauge whose value is the result of calling `f`.
+
+    Under gunicorn each worker reports its own value and `mode`
+    combines them: 'livesum' for quantities that add up across the
+    workers, 'livemax' for ones every worker holds alike.
+    """
+    gauge = Gauge(name, documentation, registry=registry,
+                  multiprocess_mode=mode)
+    if not MULTIPROCESS:
+        gauge.set_function(f)
+        return gauge
+    with _lock:
+        _callbacks.append((gauge, f))
+        if len(_callbacks) == 1:
+            threading.Thread(target=_refresh_gauges, daemon=True).start()
+    return gauge
+
+
+def _refresh_gauges():
+    while True:
+        with _lock:
+            callbacks = list(_callbacks)
+        for gauge, f in callbacks:
+            try:
+                gauge.set(f())
+            except Exception:
+                pass
+        time.sleep(GAUGE_REFRESH_SEC)
+
+
+def exec_gunicorn(port):
+    """Replace this process by a gunicorn master serving `app:app`
+    on `port` with the settings of gunicorn.conf.py."""
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'gunicorn.conf.py')
+    os.execvp('gunicorn', ['gunicorn', '--config', config,
+                           '--bind', '0.0.0.0:{}'.format(port), 'app:app'])
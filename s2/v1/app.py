@@ -7,6 +7,8 @@ Sample application---music service.
 import logging
 import os
 import sys
+import threading
+import time
 
 # Installed packages
 from flask import Blueprint
@@ -14,13 +16,16 @@ from flask import Flask
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Gauge
 
 import requests
 
 import simplejson as json
 
 # Local modules
+import dbclient
+from search import SearchIndex
+import serving
 import unique_code
 
 # The unique exercise code
@@ -31,7 +36,7 @@ ucode = unique_code.exercise_hash(os.getenv('EXER'))
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = serving.flask_metrics(app)
 metrics.info('app_info', 'Music process')
 
 db = {
@@ -39,12 +44,79 @@ db = {
     "endpoint": [
         "read",
         "write",
-        "delete"
+        "delete",
+        "scan",
+        "query"
     ]
 }
+
+# The playlist service is told of created and deleted songs so that
+# its index of music ids stays current (see s3/music_filter.py)
+PLAYLIST_URL = os.getenv('PLAYLIST_URL',
+                         'http://cmpt756s3:30003/api/v1/playlist')
+PLAYLIST_NOTIFY_TIMEOUT_SEC = 1
+
+# Number of items fetched per datastore `/scan` when listing
+LIST_PAGE_SIZE = 100
+
+# Datastore index of the songs by Artist, in SongTitle order
+ARTIST_INDEX = 'Artist-index'
+
+# Search index over Artist and SongTitle (see search.py).  It is
+# built from a table scan at startup and rebuilt every
+# SEARCH_REBUILD_SEC to pick up songs created or deleted other than
+# through this process, such as by the loader or another replica.
+search_enabled = os.getenv('SEARCH_INDEX', 'on') == 'on'
+search_rebuild_sec = float(os.getenv('SEARCH_REBUILD_SEC', '600'))
+search_index = SearchIndex()
+
+# Default and largest page size of `/search` and `/suggest`
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+session = dbclient.pooled_session(metrics.registry)
+
+# Item reads are batched with the reads of concurrent requests
+# (see dbclient.py)
+loader = dbclient.ReadLoader(session, db['name'], metrics.registry)
+
+search_build_seconds = Gauge(
+    'music_search_build_seconds', 'Duration of the last search index build',
+    registry=metrics.registry)
+serving.callback_gauge('music_search_bytes',
+                       'Size of the search index at its last build',
+                       search_index.size_bytes, metrics.registry)
+serving.callback_gauge('music_search_songs', 'Songs in the search index',
+                       search_index.song_count, metrics.registry, 'livemax')
+serving.callback_gauge('music_search_words',
+                       'Distinct words in the search index',
+                       search_index.word_count, metrics.registry, 'livemax')
+serving.callback_gauge('music_search_trie_nodes',
+                       'Nodes of the search prefix trie',
+                       search_index.trie_nodes, metrics.registry, 'livemax')
+
 bp = Blueprint('app', __name__)
 
 
+def notify_playlist(auth, added=(), removed=()):
+    """
+    Tell the playlist service which music ids were created and deleted.
+    Best effort: a failure is logged, as the playlist service
+    also rebuilds its index periodically.
+    """
+    try:
+        response = session.post(
+            PLAYLIST_URL + '/music_ids',
+            json={"added": list(added), "removed": list(removed)},
+            headers={'Authorization': auth},
+            timeout=PLAYLIST_NOTIFY_TIMEOUT_SEC)
+        if response.status_code != 200:
+            app.logger.warning("Playlist notify failed: status %s",
+                               response.status_code)
+    except requests.RequestException as e:
+        app.logger.warning("Playlist notify failed: %s", e)
+
+
 @bp.route('/health')
 @metrics.do_not_track()
 def health():
@@ -57,6 +129,87 @@ def readiness():
     return Response("", status=200, mimetype="application/json")
 
 
+def scan_items(objtype, auth, fields=None):
+    """
+    Yield every item of `objtype`, reading the table a page at a time
+    through the datastore `/scan`.  Raises RuntimeError, with the
+    status code as its second argument, if a page cannot be read.
+    """
+    params = {"objtype": objtype, "limit": LIST_PAGE_SIZE}
+    if fields is not None:
+        params['fields'] = fields
+    return page_items(db['endpoint'][3], params, auth)
+
+
+def artist_items(artist, auth):
+    """
+    Yield every song by `artist`, in title order, a page at a time
+    through the datastore `/query` on the Artist index.  Raises
+    RuntimeError as scan_items() does.
+    """
+    params = {"objtype": "music", "index": ARTIST_INDEX, "key": artist,
+              "limit": LIST_PAGE_SIZE}
+    return page_items(db['endpoint'][4], params, auth)
+
+
+def page_items(endpoint, params, auth):
+    """Yield the items of every page of the datastore `endpoint`
+    (`/scan` or `/query`) called with `params`, following the
+    cursors."""
+    url = db['name'] + '/' + endpoint
+    params = dict(params)
+    while True:
+        response = session.get(
+            url,
+            params=params,
+            headers={'Authorization': auth})
+        if response.status_code != 200:
+            raise RuntimeError(endpoint + " failed", response.status_code)
+        page = response.json()
+        yield from page['Items']
+        if page['Cursor'] is None:
+            return
+        params['cursor'] = page['Cursor']
+
+
+def scan_all(items):
+    """
+    Yield every item of the iterable `items` (see scan_items()) as one
+    line of JSON.  If the scan fails, the last line is an
+    {"error": ...} object.
+    """
+    try:
+        for item in items:
+            yield json.dumps(item) + '\n'
+    except RuntimeError as e:
+        yield json.dumps({"error": e.args[0],
+                          "http_status_code": e.args[1]}) + '\n'
+
+
+def maintain_search_index():
+    """
+    Build the search index from a scan of the music table, then
+    rebuild it every search_rebuild_sec.  Failed builds are retried
+    with backoff.  Runs in a daemon thread.
+    """
+    delay = 1
+    while True:
+        try:
+            start = time.monotonic()
+            search_index.rebuild(
+                (item['music_id'], item.get('Artist', ''),
+                 item.get('SongTitle', ''))
+                for item in scan_items("music", None,
+                                       fields="Artist,SongTitle"))
+            search_build_seconds.set(time.monotonic() - start)
+            delay = 1
+            time.sleep(search_rebuild_sec)
+        except Exception as e:
+            app.logger.warning("Search index build failed: %s", e)
+            time.sleep(delay)
+            delay = min(2 * delay, 60)
+
+
 @bp.route('/', methods=['GET'])
 def list_all():
     headers = request.headers
@@ -65,8 +218,97 @@ def list_all():
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    # list all songs here
-    return {}
+    # One song per line (NDJSON), streamed as the pages arrive.
+    # Only the songs by `artist`, if given, read through the index.
+    if 'artist' in request.args:
+        items = artist_items(request.args['artist'],
+                             headers['Authorization'])
+    else:
+        items = scan_items("music", headers['Authorization'])
+    return Response(scan_all(items),
+                    mimetype='application/x-ndjson')
+
+
+def page_args(default_limit):
+    """Return (offset, limit) from the request's query, or None if
+    either is not a valid number."""
+    try:
+        offset = int(request.args.get('offset', '0'))
+        limit = int(request.args.get('limit', str(default_limit)))
+    except ValueError:
+        return None
+    if offset < 0 or limit < 1 or limit > SEARCH_MAX_PAGE_SIZE:
+        return None
+    return offset, limit
+
+
+def search_unavailable():
+    """Return the 503 response for a search made before the index is
+    built, or None if it is ready."""
+    if search_index.ready:
+        return None
+    return Response(json.dumps({"error": "search index is not ready"}),
+                    status=503,
+                    mimetype='application/json')
+
+
+@bp.route('/search', methods=['GET'])
+def search():
+    """
+    Find the songs whose Artist or SongTitle holds every word of the
+    query `q`, best matches first.  The last word also matches the
+    words it starts, unless `prefix=false`.  Paged by `offset` and
+    `limit`; "Total" counts every match.
+    """
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    page = page_args(SEARCH_PAGE_SIZE)
+    if 'q' not in request.args or page is None:
+        return Response(json.dumps({"error": "missing q or invalid "
+                                             "offset or limit"}),
+                        status=400,
+                        mimetype='application/json')
+    unavailable = search_unavailable()
+    if unavailable is not None:
+        return unavailable
+    offset, limit = page
+    total, songs = search_index.search(
+        request.args['q'], offset, limit,
+        prefix=request.args.get('prefix', 'true').lower() != 'false')
+    items = [{"music_id": m, "Artist": a, "SongTitle": t}
+             for m, a, t in songs]
+    return {"Items": items, "Count": len(items), "Offset": offset,
+            "Total": total}
+
+
+@bp.route('/suggest', methods=['GET'])
+def suggest():
+    """
+    Complete `prefix` to the indexed Artist and SongTitle words that
+    start with it, the words in the most songs first, at most `limit`.
+    """
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    page = page_args(SEARCH_PAGE_SIZE)
+    prefix = request.args.get('prefix', '')
+    if not prefix or page is None or page[0] != 0:
+        return Response(json.dumps({"error": "missing prefix or invalid "
+                                             "limit"}),
+                        status=400,
+                        mimetype='application/json')
+    unavailable = search_unavailable()
+    if unavailable is not None:
+        return unavailable
+    return {"Suggestions": [{"word": w, "songs": n} for w, n in
+                            search_index.suggest(prefix, page[1])]}
 
 
 @bp.route('/<music_id>', methods=['GET'])
@@ -77,13 +319,12 @@ def get_song(music_id):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    payload = {"objtype": "music", "objkey": music_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url,
-        params=payload,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    result = loader.load("music", music_id,
+                         headers['Authorization']).result().json()
+    unchanged = dbclient.not_modified(dbclient.item_version(result))
+    if unchanged is not None:
+        return unchanged
+    return dbclient.with_etag(result)
 
 
 @bp.route('/', methods=['POST'])
@@ -101,11 +342,15 @@ def create_song():
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
+    response = session.post(
         url,
         json={"objtype": "music", "Artist": Artist, "SongTitle": SongTitle},
         headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    resp = response.json()
+    if 'music_id' in resp:
+        search_index.add(resp['music_id'], Artist, SongTitle)
+        notify_playlist(headers['Authorization'], added=[resp['music_id']])
+    return (resp)
 
 
 @bp.route('/<music_id>', methods=['DELETE'])
@@ -117,10 +362,13 @@ def delete_song(music_id):
                         status=401,
                         mimetype='application/json')
     url = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
+    response = session.delete(
         url,
         params={"objtype": "music", "objkey": music_id},
         headers={'Authorization': headers['Authorization']})
+    if response.status_code == 200:
+        search_index.remove(music_id)
+        notify_playlist(headers['Authorization'], removed=[music_id])
     return (response.json())
 
 
@@ -133,6 +381,13 @@ def test():
     return {}
 
 
+def start_background():
+    """Start the background threads.  Under gunicorn every worker
+    runs its own, after the fork."""
+    if search_enabled:
+        threading.Thread(target=maintain_search_index, daemon=True).start()
+
+
 # All database calls will have this prefix.  Prometheus metric
 # calls will not---they will have route '/metrics'.  This is
 # the conventional organization.
@@ -145,5 +400,8 @@ if __name__ == '__main__':
 
     app.logger.error("Unique code: {}".format(ucode))
     p = int(sys.argv[1])
+    if serving.web_server == 'gunicorn':
+        serving.exec_gunicorn(p)
+    start_background()
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
@@ -0,0 +1,324 @@
+"""
+Client side of the datastore (DB service) calls.
+
+pooled_session() returns the requests Session every datastore call
+goes through: one pool of keep-alive connections, default timeouts
+and metrics on the pool.
+
+ReadLoader coalesces item reads.  load() returns a future of the
+read.  A read asked for while no other is queued or in flight is
+sent at once, by the caller.  Otherwise the key is queued, and the
+reads queued within DB_BATCH_WINDOW_MS of the first one, by the same
+request or by concurrent ones, are sent together.  The reads of one
+objtype with the same fields and Authorization become one
+`/batch_read`, and a key queued again before the batch is sent
+shares the first future.  A lone key is read with `/read`.  The
+future resolves to a ReadResult, which answers the status_code,
+content and json() of the `/read` response it stands for.
+
+item_version(), not_modified() and with_etag() answer conditional
+reads, with the datastore `Version` of an item as its ETag.
+
+s1, s2/v1 and s3 each hold a copy of this module, as each is built
+from its own directory.  Edit the one in s1 and copy it to the
+others with `tools/check-copies.sh --fix`; CI fails if they differ.
+"""
+
+# Standard library modules
+import concurrent.futures
+import os
+import threading
+import time
+
+# Installed packages
+from flask import make_response
+from flask import request
+from flask import Response
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import simplejson as json
+
+# Local modules
+import serving
+
+# Datastore calls share one pool of keep-alive connections.
+# A request that finds every pooled connection busy waits for one.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '32'))
+DB_CONNECT_TIMEOUT_SEC = float(os.getenv('DB_CONNECT_TIMEOUT_SEC', '1'))
+DB_READ_TIMEOUT_SEC = float(os.getenv('DB_READ_TIMEOUT_SEC', '10'))
+
+# Time a queued read waits for others to join its batch; 0 sends
+# every read on its own.  Reads are queued only while others are
+# queued or in flight, so a lone read never waits.
+DB_BATCH_WINDOW_MS = float(os.getenv('DB_BATCH_WINDOW_MS', '2'))
+
+# A batch reaching this many keys is sent without waiting
+DB_BATCH_MAX_KEYS = int(os.getenv('DB_BATCH_MAX_KEYS', '100'))
+
+BATCH_KEYS_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that applies the default datastore timeouts
+    and counts the requests in flight on the gauge `in_flight`."""
+    def __init__(self, in_flight, **kwargs):
+        self.in_flight = in_flight
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (DB_CONNECT_TIMEOUT_SEC, DB_READ_TIMEOUT_SEC)
+        with self.in_flight.track_inprogress():
+            return super().send(request, **kwargs)
+
+    def pool_stats(self):
+        """Return (connections opened, requests sent) over all pools.
+        Requests sent minus connections opened is the number of
+        requests that reused a connection."""
+        opened = sent = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, sent
+
+
+def pooled_session(registry):
+    """Return a Session over one pool of DB_POOL_SIZE connections,
+    with its metrics in `registry`."""
+    in_flight = Gauge('db_client_requests_in_flight',
+                      'Datastore requests awaiting a response',
+                      registry=registry, multiprocess_mode='livesum')
+    adapter = PooledAdapter(in_flight,
+                            pool_connections=4,
+                            pool_maxsize=DB_POOL_SIZE,
+                            pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    serving.callback_gauge('db_client_connections_opened',
+                           'Connections opened to the datastore',
+                           lambda: adapter.pool_stats()[0], registry)
+    serving.callback_gauge('db_client_requests_sent',
+                           'Requests sent to the datastore',
+                           lambda: adapter.pool_stats()[1], registry)
+    return session
+
+
+class ReadResult:
+    """The response of a `/read`, possibly cut out of a `/batch_read`.
+    json() parses it afresh, so callers sharing it may modify what
+    they get."""
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def read_content(items):
+    """Return the body of a `/read` answering `items`."""
+    return json.dumps({"Items": items, "Count": len(items),
+                       "ScannedCount": len(items)}).encode()
+
+
+class ReadLoader:
+    """
+    Batches and deduplicates the item reads of the datastore at
+    `url` (its ".../datastore" prefix) made through `session`.
+
+    Metrics in `registry`: db_client_loads and
+    db_client_loads_deduplicated count the reads asked for and the
+    ones that shared a queued read, by objtype; their ratio is the
+    deduplication ratio.  db_client_batch_keys is the distribution
+    of the keys per datastore call.
+    """
+    def __init__(self, session, url, registry,
+                 window_ms=DB_BATCH_WINDOW_MS, max_keys=DB_BATCH_MAX_KEYS):
+        self.session = session
+        self.url = url
+        self.window_sec = window_ms / 1000
+        self.max_keys = max_keys
+        self.loads = Counter('db_client_loads',
+                             'Item reads asked of the read loader',
+                             ['objtype'], registry=registry)
+        self.deduplicated = Counter(
+            'db_client_loads_deduplicated',
+            'Item reads that shared a read already queued',
+            ['objtype'], registry=registry)
+        self.batch_keys = Histogram('db_client_batch_keys',
+                                    'Keys per datastore read call',
+                                    buckets=BATCH_KEYS_BUCKETS,
+                                    registry=registry)
+        self._cond = threading.Condition()
+        # (objtype, fields, auth) -> {objkey: future}
+        self._pending = {}
+        self._deadline = None
+        # Reads sent and not yet answered
+        self._in_flight = 0
+        # Started by the first queued load, so that they exist in the
+        # process that uses them (see gunicorn.conf.py)
+        self._pool = None
+
+    def load(self, objtype, objkey, auth=None, fields=None):
+        """
+        Return a concurrent.futures.Future of the ReadResult of
+        reading the item `objkey` from the `objtype` table, with only
+        the attributes in the sequence `fields` (and the key) if it is
+        not None.  The future raises what the session raised if the
+        datastore could not be reached.
+
+        A read asked for while the loader is idle is sent before
+        load() returns, so a caller holding several futures gets its
+        reads batched only under concurrent load; use batch_read()
+        to read known keys together.
+        """
+        if fields is not None:
+            fields = tuple(fields)
+        self.loads.labels(objtype).inc()
+        group = (objtype, fields, auth)
+        full = None
+        with self._cond:
+            keys = self._pending.get(group, {})
+            future = keys.get(objkey)
+            if future is not None:
+                self.deduplicated.labels(objtype).inc()
+                return future
+            future = concurrent.futures.Future()
+            now = (self.window_sec <= 0
+                   or (not self._pending and self._in_flight == 0))
+            if now:
+                self._in_flight += 1
+            else:
+                keys = self._pending.setdefault(group, keys)
+                keys[objkey] = future
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        DB_POOL_SIZE, thread_name_prefix='dbclient')
+                    threading.Thread(target=self._run, daemon=True).start()
+                if len(keys) >= self.max_keys:
+                    full = self._pending.pop(group)
+                    self._in_flight += 1
+                elif self._deadline is None:
+                    self._deadline = time.monotonic() + self.window_sec
+                    self._cond.notify()
+        if now:
+            self._dispatch(group, {objkey: future})
+        elif full is not None:
+            self._pool.submit(self._dispatch, group, full)
+        return future
+
+    def _run(self):
+        """Send the queued reads once their window has passed."""
+        while True:
+            with self._cond:
+                while self._deadline is None:
+                    self._cond.wait()
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                pending, self._pending = self._pending, {}
+                self._deadline = None
+                self._in_flight += len(pending)
+            for group, keys in pending.items():
+                self._pool.submit(self._dispatch, group, keys)
+
+    def _dispatch(self, group, keys):
+        """Read the keys of the dict `keys`, resolving their futures."""
+        objtype, fields, auth = group
+        self.batch_keys.observe(len(keys))
+        try:
+            if len(keys) == 1:
+                results = {objkey: self.read(objtype, objkey, auth, fields)
+                           for objkey in keys}
+            else:
+                results = self.batch_read(objtype, list(keys), auth, fields)
+            for objkey, future in keys.items():
+                future.set_result(results[objkey])
+        except Exception as e:
+            for future in keys.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+
+    def read(self, objtype, objkey, auth, fields):
+        """Return the ReadResult of one `/read`."""
+        params = {"objtype": objtype, "objkey": objkey}
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        response = self.session.get(
+            self.url + '/read',
+            params=params,
+            headers={} if auth is None else {'Authorization': auth})
+        return ReadResult(response.status_code, response.content)
+
+    def batch_read(self, objtype, objkeys, auth, fields):
+        """
+        Return a dict mapping each of `objkeys` to the ReadResult of
+        its `/read`, from one `/batch_read`.  Keys the datastore left
+        unprocessed are read one by one.  A failed call is the
+        result of every key.
+        """
+        body = {"objtype": objtype, "objkeys": objkeys}
+        if fields is not None:
+            body['fields'] = list(fields)
+        response = self.session.post(
+            self.url + '/batch_read',
+            json=body,
+            headers={} if auth is None else {'Authorization': auth})
+        if response.status_code != 200:
+            failed = ReadResult(response.status_code, response.content)
+            return {objkey: failed for objkey in objkeys}
+        result = response.json()
+        key = objtype + '_id'
+        found = {item[key]: item for item in result['Items']}
+        unprocessed = set(result.get('UnprocessedKeys', []))
+        results = {}
+        for objkey in objkeys:
+            if objkey in unprocessed:
+                results[objkey] = self.read(objtype, objkey, auth, fields)
+            else:
+                item = found.get(objkey)
+                results[objkey] = ReadResult(
+                    200, read_content([] if item is None else [item]))
+        return results
+
+
+def item_version(result):
+    """Return the "Version" of the item in the datastore read
+    `result`, or None if there is no item or it is unversioned."""
+    items = result.get('Items') or []
+    return items[0].get('Version') if items else None
+
+
+def not_modified(version, weak=False):
+    """Return a 304 response if the request's If-None-Match holds
+    the ETag of `version`, else None."""
+    if version is None or not request.if_none_match.contains_weak(version):
+        return None
+    response = Response(status=304)
+    response.set_etag(version, weak=weak)
+    return response
+
+
+def with_etag(result, weak=False):
+    """Return the datastore read `result` as a response whose ETag
+    is the version of its item."""
+    response = make_response(result)
+    version = item_version(result)
+    if version is not None:
+        response.set_etag(version, weak=weak)
+    return response
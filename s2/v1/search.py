@@ -0,0 +1,339 @@
+"""
+In-process search index over the Artist and SongTitle of every song.
+
+* An inverted index maps each word to the songs whose Artist or
+  SongTitle holds it, noting which of the two fields does.
+* A prefix trie over the indexed words finds every word that starts
+  with a prefix, so the last word of a query can be incomplete
+  (search-as-you-type) and prefixes can be completed.
+
+The index holds the Artist and SongTitle of every song, so a search
+is answered without datastore calls.
+"""
+
+# Standard library modules
+import bisect
+import heapq
+import re
+import sys
+import threading
+
+# Fields of a song, as bits of a posting's field mask
+ARTIST = 1
+TITLE = 2
+
+# Score of a query word found in each field.  A word matched only
+# as a prefix of an indexed word scores half as much.
+FIELD_WEIGHTS = {ARTIST: 2, TITLE: 3}
+
+_WORD = re.compile(r'\w+')
+
+# Key of a trie node marking the end of a word; never a character
+_END = ''
+
+
+def words(text):
+    """Return the distinct lowercase words of `text`, in order."""
+    return list(dict.fromkeys(_WORD.findall(text.casefold())))
+
+
+def deep_size(root):
+    """Return the bytes held by `root` and every dict, list, tuple,
+    set and string it contains, counting shared objects once."""
+    seen = set()
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return total
+
+
+class Trie():
+    """Burst trie over words.
+
+    A character trie whose subtrees of at most BURST_SIZE words are
+    held as sorted lists of the words ("containers"), searched by
+    bisection.  A container that outgrows BURST_SIZE is split into a
+    node.  This needs a small fraction of the memory of one dict per
+    character.
+
+    A node is a dict from a character to a child node or container;
+    a node where a stored word ends also has the key _END.
+    """
+    BURST_SIZE = 32
+
+    def __init__(self):
+        self.root = {}
+        self.nodes = 1
+
+    def add(self, word):
+        node = self.root
+        for depth, ch in enumerate(word):
+            child = node.get(ch)
+            if child is None:
+                node[ch] = [word]
+                self.nodes += 1
+                return
+            if isinstance(child, dict):
+                node = child
+                continue
+            i = bisect.bisect_left(child, word)
+            if i == len(child) or child[i] != word:
+                child.insert(i, word)
+                if len(child) > self.BURST_SIZE:
+                    node[ch] = self._burst(child, depth + 1)
+            return
+        node[_END] = True
+
+    def _burst(self, words, depth):
+        """Return a node holding the sorted `words`, which share
+        their first `depth` characters."""
+        node = {}
+        for word in words:
+            if len(word) == depth:
+                node[_END] = True
+            else:
+                node.setdefault(word[depth], []).append(word)
+        # The container becomes a node; each new container adds one
+        self.nodes += len(node) - (_END in node)
+        for ch, child in node.items():
+            if ch != _END and len(child) > self.BURST_SIZE:
+                node[ch] = self._burst(child, depth + 1)
+        return node
+
+    def remove(self, word):
+        """Remove `word`, pruning the nodes and containers left empty."""
+        path = [self.root]
+        for ch in word:
+            child = path[-1].get(ch)
+            if child is None:
+                return
+            path.append(child)
+            if isinstance(child, list):
+                i = bisect.bisect_left(child, word)
+                if i < len(child) and child[i] == word:
+                    del child[i]
+                break
+        else:
+            path[-1].pop(_END, None)
+        for i in range(len(path) - 1, 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][word[i - 1]]
+            self.nodes -= 1
+
+    def completions(self, prefix):
+        """Yield every stored word that starts with `prefix`."""
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return
+            if isinstance(node, list):
+                for i in range(bisect.bisect_left(node, prefix), len(node)):
+                    if not node[i].startswith(prefix):
+                        return
+                    yield node[i]
+                return
+        stack = [(prefix, node)]
+        while stack:
+            word, node = stack.pop()
+            if isinstance(node, list):
+                yield from node
+                continue
+            for ch, child in node.items():
+                if ch == _END:
+                    yield word
+                else:
+                    stack.append((word + ch, child))
+
+
+class Catalog():
+    """Inverted index and trie over a set of songs.  Not thread-safe;
+    see SearchIndex."""
+    def __init__(self):
+        # music_id -> (Artist, SongTitle)
+        self.songs = {}
+        # word -> {music_id: field mask}
+        self.postings = {}
+        self.trie = Trie()
+
+    def add(self, music_id, artist, title):
+        if music_id in self.songs:
+            self.remove(music_id)
+        artist, title = str(artist), str(title)
+        self.songs[music_id] = (artist, title)
+        for field, text in ((ARTIST, artist), (TITLE, title)):
+            for word in words(text):
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = {}
+                    self.trie.add(word)
+                posting[music_id] = posting.get(music_id, 0) | field
+
+    def remove(self, music_id):
+        song = self.songs.pop(music_id, None)
+        if song is None:
+            return
+        for word in words(' '.join(song)):
+            posting = self.postings.get(word)
+            if posting is None:
+                continue
+            posting.pop(music_id, None)
+            if not posting:
+                del self.postings[word]
+                self.trie.remove(word)
+
+    def _scores(self, word, prefix):
+        """Return {music_id: score} for the songs matching the query
+        `word`, or every indexed word it starts if `prefix`."""
+        matched = self.trie.completions(word) if prefix else [word]
+        scores = {}
+        for indexed in matched:
+            factor = 2 if indexed == word else 1
+            for music_id, mask in self.postings.get(indexed, {}).items():
+                score = factor * sum(w for f, w in FIELD_WEIGHTS.items()
+                                     if mask & f)
+                if score > scores.get(music_id, 0):
+                    scores[music_id] = score
+        return scores
+
+    def search(self, query, count, prefix=True):
+        """
+        Return (total, music_ids): the number of songs holding every
+        word of `query` in their Artist or SongTitle, and the ids of
+        the best `count` of them, best first.  If `prefix`, the last
+        word of the query also matches the words it starts.
+
+        A song's score sums, over the query words, the weights of the
+        fields holding the word (FIELD_WEIGHTS), halved for a prefix
+        match.  Ties are ordered by title and then by id.
+        """
+        terms = words(query)
+        if not terms:
+            return 0, []
+        totals = None
+        # Intersect the most selective terms first
+        per_term = sorted(
+            (self._scores(t, prefix and i == len(terms) - 1)
+             for i, t in enumerate(terms)),
+            key=len)
+        for scores in per_term:
+            if totals is None:
+                totals = dict(scores)
+            else:
+                totals = {m: s + scores[m] for m, s in totals.items()
+                          if m in scores}
+            if not totals:
+                return 0, []
+        best = heapq.nsmallest(
+            count, totals,
+            key=lambda m: (-totals[m], self.songs[m][1].casefold(), m))
+        return len(totals), best
+
+    def suggest(self, prefix, count):
+        """Return up to `count` (word, songs) pairs for the indexed
+        words starting with the lowercase `prefix`, the words held by
+        the most songs first."""
+        return heapq.nsmallest(
+            count,
+            ((w, len(self.postings[w]))
+             for w in self.trie.completions(prefix)),
+            key=lambda ws: (-ws[1], ws[0]))
+
+
+class SearchIndex():
+    """Thread-safe Catalog that can be rebuilt while in use.
+
+    Until the first rebuild() completes, `ready` is False.  Songs
+    added or removed while a rebuild is reading the table are applied
+    to the new catalog too.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._catalog = None
+        # Changes made while a rebuild is scanning, or None if none is
+        self._changes = None
+        self._bytes = 0
+
+    @property
+    def ready(self):
+        return self._catalog is not None
+
+    def add(self, music_id, artist, title):
+        with self._lock:
+            if self._catalog is not None:
+                self._catalog.add(music_id, artist, title)
+            if self._changes is not None:
+                self._changes.append((music_id, (artist, title)))
+
+    def remove(self, music_id):
+        with self._lock:
+            if self._catalog is not None:
+                self._catalog.remove(music_id)
+            if self._changes is not None:
+                self._changes.append((music_id, None))
+
+    def rebuild(self, songs):
+        """Replace the catalog with one holding the (music_id, Artist,
+        SongTitle) tuples from the iterable `songs`, plus the changes
+        made while it is being consumed."""
+        with self._lock:
+            self._changes = []
+        try:
+            new = Catalog()
+            for music_id, artist, title in songs:
+                new.add(music_id, artist, title)
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            for music_id, song in self._changes:
+                if song is None:
+                    new.remove(music_id)
+                else:
+                    new.add(music_id, *song)
+            self._changes = None
+            self._catalog = new
+        # Measured once per build; walking the index on every
+        # metrics scrape would be too slow
+        self._bytes = deep_size((new.songs, new.postings, new.trie.root))
+
+    def search(self, query, offset, limit, prefix=True):
+        """Return (total, songs) where songs lists (music_id, Artist,
+        SongTitle) for at most `limit` of the ranked matches of `query`
+        (see Catalog.search), skipping the first `offset`."""
+        with self._lock:
+            total, best = self._catalog.search(query, offset + limit, prefix)
+            return total, [(m,) + self._catalog.songs[m]
+                           for m in best[offset:]]
+
+    def suggest(self, prefix, count):
+        with self._lock:
+            return self._catalog.suggest(prefix.casefold(), count)
+
+    def song_count(self):
+        c = self._catalog
+        return 0 if c is None else len(c.songs)
+
+    def word_count(self):
+        c = self._catalog
+        return 0 if c is None else len(c.postings)
+
+    def trie_nodes(self):
+        c = self._catalog
+        return 0 if c is None else c.trie.nodes
+
+    def size_bytes(self):
+        """Bytes held by the catalog when it was last rebuilt."""
+        return self._bytes
@@ -4,8 +4,14 @@ Sample application---playlist service.
 """
 
 # Standard library modules
+import hashlib
 import logging
+import os
+import queue
 import sys
+import threading
+import time
+import uuid
 
 # Installed packages
 from flask import Blueprint
@@ -13,17 +19,25 @@ from flask import Flask
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Counter
+from prometheus_client import Gauge
 
 import requests
 
 import simplejson as json
 
+# Local modules
+from cache import ItemCache
+import dbclient
+from music_filter import MusicIndex
+import serving
+import songlist
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = serving.flask_metrics(app)
 metrics.info('app_info', 'Playlist process')
 
 bp = Blueprint('app', __name__)
@@ -34,10 +48,152 @@ db = {
         "read",
         "write",
         "delete",
-        "update"
+        "update",
+        "scan",
+        "append",
+        "remove",
+        "batch_read",
+        "replace",
+        "set_add",
+        "set_remove"
     ]
 }
 
+# "packed" stores new and edited playlists as packed binary UUIDs
+# (see songlist.py); "list" stores them as lists of strings.
+# Playlists in either form can always be read.  Before switching
+# back to "list", run `migrate_playlists.py --to list`.
+packed_playlists = os.getenv('PLAYLIST_ENCODING', 'list') == 'packed'
+
+# With a segment size above 0, new playlists are chunked: a header
+# item holds the name and the ordered keys of segment items, each
+# holding at most this many songs.  Chunked playlists are not
+# limited by the datastore's item size and an addition rewrites only
+# the last segment.  Existing playlists keep their layout.
+playlist_segment_size = int(os.getenv('PLAYLIST_SEGMENT_SIZE', '0'))
+
+# Attempts at a playlist edit that races with other edits
+EDIT_RETRIES = 5
+
+# The song index maps each music id to the playlists holding it.
+# It is updated after every playlist change; most keys in one
+# datastore `/set_add` or `/set_remove`:
+INDEX_BATCH_SIZE = 1000
+
+# Songs the music service reports deleted are removed from every
+# playlist holding them by a background worker
+playlist_cleanup_enabled = os.getenv('PLAYLIST_CLEANUP', 'on') == 'on'
+cleanup_queue = queue.Queue()
+
+# Index of existing music ids (see music_filter.py).  With
+# MUSIC_FILTER=off every existence check goes to the datastore.
+# The music service must notify `/music_ids` of every created song;
+# deleted songs leave the Bloom filter only when it is rebuilt.
+# Under gunicorn a notification reaches only one worker, so the
+# other workers' filters cannot rule an id out.
+music_filter_enabled = os.getenv('MUSIC_FILTER', 'on') == 'on'
+music_filter_rebuild_sec = float(
+    os.getenv('MUSIC_FILTER_REBUILD_SEC', '600'))
+
+# With MUSIC_FILTER_TRUST_ABSENT=on an id the filter has not seen is
+# taken to be absent without asking the datastore.  This is sound
+# only while this process receives every notification: one replica,
+# one worker, and every song created through the music service.
+music_filter_trust_absent = (
+    music_filter_enabled
+    and os.getenv('MUSIC_FILTER_TRUST_ABSENT', 'off') == 'on')
+if (music_filter_trust_absent and serving.MULTIPROCESS
+        and serving.workers > 1):
+    sys.exit('MUSIC_FILTER_TRUST_ABSENT requires WEB_WORKERS=1')
+
+music_index = MusicIndex(
+    int(os.getenv('MUSIC_FILTER_CAPACITY', '100000')),
+    float(os.getenv('MUSIC_FILTER_FP_RATE', '0.01')),
+    int(os.getenv('MUSIC_CACHE_SIZE', '10000')),
+    float(os.getenv('MUSIC_CACHE_TTL_SEC', '60')),
+    counters=dict(
+        hits=Counter('music_cache_hits', 'Known music id cache hits',
+                     registry=metrics.registry),
+        misses=Counter('music_cache_misses',
+                       'Known music id cache misses',
+                       registry=metrics.registry),
+        evictions=Counter('music_cache_evictions',
+                          'Known music id cache evictions',
+                          ['reason'], registry=metrics.registry)))
+
+# How each music id existence check was answered: by the LRU of
+# known ids, by the filter (only if trusted) or by the datastore
+music_checks = Counter('music_checks', 'Music id existence checks',
+                       ['answered_by'], registry=metrics.registry)
+music_filter_false_positives = Counter(
+    'music_filter_false_positives',
+    'Ids the Bloom filter passed that the datastore did not hold',
+    registry=metrics.registry)
+music_filter_false_negatives = Counter(
+    'music_filter_false_negatives',
+    'Ids the Bloom filter had not seen that the datastore held',
+    registry=metrics.registry)
+music_index_build_seconds = Gauge(
+    'music_filter_build_seconds', 'Duration of the last filter build',
+    registry=metrics.registry)
+serving.callback_gauge('music_filter_fp_rate',
+                       'Expected false-positive rate of the Bloom filter',
+                       music_index.fp_rate, metrics.registry, 'livemax')
+serving.callback_gauge('music_filter_bytes', 'Size of the Bloom filter',
+                       music_index.size_bytes, metrics.registry)
+
+songindex_failures = Counter(
+    'playlist_songindex_failures', 'Failed song index updates',
+    registry=metrics.registry)
+cleanup_edits = Counter(
+    'playlist_cleanup_edits',
+    'Playlists from which a deleted song was removed',
+    registry=metrics.registry)
+cleanup_failures = Counter(
+    'playlist_cleanup_failures', 'Deleted songs whose cleanup failed',
+    registry=metrics.registry)
+serving.callback_gauge('playlist_cleanup_queue',
+                       'Deleted songs awaiting cleanup',
+                       cleanup_queue.qsize, metrics.registry)
+
+# Number of music ids checked by each datastore `/batch_read`
+# when validating a new playlist
+VALIDATE_BATCH_SIZE = 100
+
+# Most music ids the datastore accepts in one `/batch_read`
+EXPAND_BATCH_SIZE = 1000
+
+# Most music ids accepted by one `/add` or `/delete`, which the
+# datastore's `/append` and `/remove` also accept in one call
+EDIT_MAX_IDS = 100
+
+# Cache of expanded playlists (`?expand=music`); a size of 0 disables it.
+# Edits through this service invalidate the playlist; other changes,
+# such as a song being deleted, are seen after at most the TTL.  Under
+# gunicorn an edit invalidates only the worker that made it, so the
+# cache is off unless sized explicitly.
+expanded_cache = ItemCache(
+    int(os.getenv('PLAYLIST_CACHE_SIZE',
+                  '0' if serving.MULTIPROCESS else '1000')),
+    float(os.getenv('PLAYLIST_CACHE_TTL_SEC', '30')),
+    hits=Counter('playlist_cache_hits', 'Expanded playlist cache hits',
+                 registry=metrics.registry),
+    misses=Counter('playlist_cache_misses',
+                   'Expanded playlist cache misses',
+                   registry=metrics.registry),
+    evictions=Counter('playlist_cache_evictions',
+                      'Expanded playlist cache evictions',
+                      ['reason'], registry=metrics.registry))
+
+# Number of items fetched per datastore `/scan` when listing
+LIST_PAGE_SIZE = 100
+
+session = dbclient.pooled_session(metrics.registry)
+
+# Item reads are batched with the reads of concurrent requests
+# (see dbclient.py)
+loader = dbclient.ReadLoader(session, db['name'], metrics.registry)
+
 """
 @bp.route('/', methods=['GET'])
 @metrics.do_not_track()
@@ -60,6 +216,360 @@ def readiness():
     return Response("", status=200, mimetype="application/json")
 
 
+def scan_items(objtype, auth, fields=None):
+    """
+    Yield every item of `objtype`, reading the table a page at a time
+    through the datastore `/scan`.  Raises RuntimeError if a page
+    cannot be read.
+    """
+    url = db['name'] + '/' + db['endpoint'][4]
+    params = {"objtype": objtype, "limit": LIST_PAGE_SIZE}
+    if fields is not None:
+        params['fields'] = fields
+    while True:
+        response = session.get(
+            url,
+            params=params,
+            headers={'Authorization': auth})
+        if response.status_code != 200:
+            raise RuntimeError("scan failed with status {}".format(
+                response.status_code))
+        page = response.json()
+        yield from page['Items']
+        if page['Cursor'] is None:
+            return
+        params['cursor'] = page['Cursor']
+
+
+def scan_all(objtype, auth, transform=None):
+    """
+    Yield every item of `objtype` as one line of JSON, passing it
+    through `transform` if that is given; items it maps to None are
+    skipped.  If the scan fails, the last line is an {"error": reason}
+    object.
+    """
+    try:
+        for item in scan_items(objtype, auth):
+            if transform is not None:
+                item = transform(item)
+                if item is None:
+                    continue
+            yield json.dumps(item) + '\n'
+    except RuntimeError as e:
+        yield json.dumps({"error": str(e)}) + '\n'
+
+
+def maintain_music_index():
+    """
+    Build the music index from a scan of the music table, then rebuild
+    it every music_filter_rebuild_sec to drop deleted ids.  Failed
+    builds are retried with backoff.  Runs in a daemon thread.
+    """
+    delay = 1
+    while True:
+        try:
+            start = time.monotonic()
+            music_index.rebuild(
+                item['music_id']
+                for item in scan_items("music", None, fields="music_id"))
+            music_index_build_seconds.set(time.monotonic() - start)
+            delay = 1
+            time.sleep(music_filter_rebuild_sec)
+        except Exception as e:
+            app.logger.warning("Music index build failed: %s", e)
+            time.sleep(delay)
+            delay = min(2 * delay, 60)
+
+
+def check_song(music_id):
+    """
+    Return (state, token) from music_index.check() for `music_id`,
+    counting what answers the check.  A state of False is final if
+    the filter is trusted; otherwise only True is.
+    """
+    state, token = music_index.check(music_id)
+    if state is True:
+        answered_by = 'cache'
+    elif state is False and music_filter_trust_absent:
+        answered_by = 'filter'
+    else:
+        answered_by = 'datastore'
+    music_checks.labels(answered_by).inc()
+    return state, token
+
+
+def song_exists(music_id, auth):
+    """Return True if the music table holds `music_id`."""
+    state, token = check_song(music_id)
+    if state is True:
+        return True
+    if state is False and music_filter_trust_absent:
+        return False
+    get_song = loader.load("music", music_id, auth,
+                           fields=["music_id"]).result()
+    exists = get_song.json()['Count'] != 0
+    record_song_check(music_id, exists, token, state)
+    return exists
+
+
+def record_song_check(music_id, exists, token, state):
+    """Pass a datastore existence check to the music index.  `state`
+    is what the index answered for `music_id`."""
+    music_index.record(music_id, exists, token)
+    if state is False and exists:
+        # The filter missed a song, such as one created through
+        # another replica since the filter was built
+        music_filter_false_negatives.inc()
+    elif state is None and not exists and music_index.ready:
+        # The filter said "maybe", the datastore said "no"
+        music_filter_false_positives.inc()
+
+
+def first_missing_song(song_list, auth):
+    """
+    Return the first music id in `song_list` that is not in the
+    music table, or None if all of them are.
+
+    Ids the music index knows to exist are not sent to the datastore.
+    The rest are looked up in order, VALIDATE_BATCH_SIZE per
+    datastore call, stopping at the first batch with a missing id.
+    Ids after the first one the filter has not seen are looked up
+    only if that one exists: if the datastore holds it or, with a
+    trusted filter, never.  Raises RuntimeError if the datastore
+    could not read every id.
+    """
+    start = 0
+    while start < len(song_list):
+        # music id -> (token, state) of the ids to look up
+        unknown = {}
+        suspect = None
+        for pos in range(start, len(song_list)):
+            ms_id = song_list[pos]
+            state, token = check_song(ms_id)
+            if state is False:
+                suspect = pos
+            if state is None or (state is False and
+                                 not music_filter_trust_absent):
+                unknown.setdefault(ms_id, (token, state))
+            if suspect is not None:
+                break
+        missing = lookup_songs(list(unknown), unknown, auth,
+                               VALIDATE_BATCH_SIZE, first=True)
+        if missing:
+            return missing[0]
+        if suspect is None:
+            return None
+        if music_filter_trust_absent:
+            return song_list[suspect]
+        start = suspect + 1
+    return None
+
+
+def missing_songs(music_ids, auth):
+    """
+    Return the set of the music ids in `music_ids` that are not in the
+    music table.  Ids the music index does not know to exist, and
+    a trusted filter does not rule out, are looked up in one datastore
+    `/batch_read` (per EXPAND_BATCH_SIZE ids).  Raises RuntimeError
+    if the datastore could not read every id.
+    """
+    absent = set()
+    # music id -> (token, state) of the ids to look up
+    unknown = {}
+    for ms_id in music_ids:
+        state, token = check_song(ms_id)
+        if state is False and music_filter_trust_absent:
+            absent.add(ms_id)
+        elif state is not True:
+            unknown.setdefault(ms_id, (token, state))
+    return absent | set(lookup_songs(list(unknown), unknown, auth,
+                                     EXPAND_BATCH_SIZE))
+
+
+def lookup_songs(ids, checks, auth, batch_size, first=False):
+    """
+    Look up the music ids in the list `ids` with `/batch_read`,
+    `batch_size` per call, passing each answer to the music index
+    with the (token, state) of the id in the dict `checks`.  Returns
+    the list of the ids the music table does not hold, in order; if
+    `first`, stops after the first batch with a missing id.  Raises
+    RuntimeError if the datastore could not read every id.
+    """
+    url = db['name'] + '/' + db['endpoint'][7]
+    absent = []
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i+batch_size]
+        response = session.post(
+            url,
+            json={"objtype": "music", "objkeys": batch,
+                  "fields": ["music_id"]},
+            headers={'Authorization': auth})
+        result = response.json()
+        if response.status_code != 200 or result['UnprocessedKeys']:
+            raise RuntimeError("failed to read music ids")
+        found = {item['music_id'] for item in result['Items']}
+        for ms_id in batch:
+            record_song_check(ms_id, ms_id in found, *checks[ms_id])
+            if ms_id not in found:
+                absent.append(ms_id)
+        if first and absent:
+            break
+    return absent
+
+
+@bp.route('/music_ids', methods=['POST'])
+def update_music_ids():
+    """
+    Tell the music index about created and deleted songs, and
+    queue the removal of deleted songs from playlists.
+
+    The body is {"added": [music_id, ...], "removed": [music_id, ...]};
+    either list may be omitted.  Called by the music service.
+    """
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    content = request.get_json()
+    for music_id in content.get('added', []):
+        music_index.add(music_id)
+    for music_id in content.get('removed', []):
+        music_index.remove(music_id)
+        if playlist_cleanup_enabled:
+            cleanup_queue.put((music_id, headers['Authorization']))
+    return {}
+
+
+@bp.route('/music/<music_id>', methods=['GET'])
+def playlists_for_song(music_id):
+    """List the ids of the playlists holding `music_id`."""
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    try:
+        playlist_ids = playlists_with_song(music_id, headers['Authorization'])
+    except RuntimeError as e:
+        return Response(json.dumps({"error": str(e)}),
+                        status=503,
+                        mimetype='application/json')
+    return {"music_id": music_id, "Playlists": playlist_ids}
+
+
+@bp.route('/cleanup', methods=['POST'])
+def cleanup():
+    """
+    Remove deleted songs from every playlist holding them.
+
+    The body is {"music_ids": [music_id, ...]}.  The response maps
+    each id to the number of playlists changed.  The music service's
+    notifications queue the same work in the background; this route
+    lets a job retry songs whose cleanup failed.
+    """
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    try:
+        music_ids = request.get_json()['music_ids']
+    except Exception:
+        return json.dumps({"message": "error reading arguments"})
+    cleaned = {}
+    try:
+        for music_id in music_ids:
+            cleaned[music_id] = cleanup_song(music_id,
+                                             headers['Authorization'])
+    except RuntimeError as e:
+        return Response(json.dumps({"error": str(e), "Cleaned": cleaned}),
+                        status=503,
+                        mimetype='application/json')
+    return {"Cleaned": cleaned}
+
+
+def index_songs(playlist_id, music_ids, add, auth):
+    """
+    Add `playlist_id` to (if `add`) or remove it from the song index
+    entries of `music_ids`.  Best effort: a failure is logged and
+    counted.  It leaves an entry listing a playlist that no longer
+    holds the song, which cleanup tolerates, or missing one that
+    does, whose copy of a later deleted song then remains.
+    """
+    music_ids = list(dict.fromkeys(m for m in music_ids if m))
+    url = db['name'] + '/' + db['endpoint'][9 if add else 10]
+    for i in range(0, len(music_ids), INDEX_BATCH_SIZE):
+        try:
+            response = session.put(
+                url,
+                params={"objtype": "songindex"},
+                json={"objkeys": music_ids[i:i+INDEX_BATCH_SIZE],
+                      "attr": "Playlists",
+                      "values": [playlist_id]},
+                headers={'Authorization': auth})
+            failed = response.status_code != 200
+        except requests.RequestException:
+            failed = True
+        if failed:
+            songindex_failures.inc()
+            app.logger.warning("Song index update failed for playlist %s",
+                               playlist_id)
+
+
+def playlists_with_song(music_id, auth):
+    """Return the ids of the playlists the song index lists for
+    `music_id`.  Raises RuntimeError if the index cannot be read."""
+    response = loader.load("songindex", music_id, auth).result()
+    if response.status_code != 200:
+        raise RuntimeError("failed to read the song index")
+    result = response.json()
+    if result['Count'] == 0:
+        return []
+    return result['Items'][0].get('Playlists', {"SS": []})['SS']
+
+
+def cleanup_song(music_id, auth):
+    """
+    Remove the deleted song `music_id` from every playlist the song
+    index lists for it, then drop its index entry.  Returns the
+    number of playlists changed.  Raises RuntimeError, keeping the
+    entry, if the index cannot be read or a playlist edit fails.
+    """
+    changed = 0
+    for playlist_id in playlists_with_song(music_id, auth):
+        status, body, rejected = edit_playlist(
+            playlist_id, [music_id], False, auth)
+        expanded_cache.invalidate(playlist_id)
+        if status == 200 and not rejected:
+            changed += 1
+        elif status not in (200, 404):
+            raise RuntimeError("failed to edit playlist {}: {}".format(
+                playlist_id, body))
+    session.delete(
+        db['name'] + '/' + db['endpoint'][2],
+        params={"objtype": "songindex", "objkey": music_id},
+        headers={'Authorization': auth})
+    cleanup_edits.inc(changed)
+    return changed
+
+
+def run_cleanup():
+    """Clean up the deleted songs queued by `/music_ids`.
+    Runs in a daemon thread."""
+    while True:
+        music_id, auth = cleanup_queue.get()
+        try:
+            cleanup_song(music_id, auth)
+        except Exception as e:
+            cleanup_failures.inc()
+            app.logger.warning("Cleanup of music_id %s failed: %s",
+                               music_id, e)
+
+
 @bp.route('/', methods=['GET'])
 def list_all():
     headers = request.headers
@@ -68,11 +578,433 @@ def list_all():
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    url_read = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url_read,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    auth = headers['Authorization']
+
+    def whole_playlist(item):
+        # Segments are listed as part of their playlist
+        if 'Parent' in item:
+            return None
+        return assemble(item, auth)
+
+    # One playlist per line (NDJSON), streamed as the pages arrive
+    return Response(scan_all("playlist", auth, whole_playlist),
+                    mimetype='application/x-ndjson')
+
+
+def read_playlist(playlist_id, auth, fields=None, consistent=False):
+    """
+    Read the item `playlist_id` (a playlist or one of its segments),
+    with only the comma-separated `fields` if given.  Returns the
+    datastore response.  Eventually consistent reads go through
+    the loader.
+    """
+    if not consistent:
+        return loader.load("playlist", playlist_id, auth,
+                           None if fields is None
+                           else fields.split(',')).result()
+    params = {"objtype": "playlist", "objkey": playlist_id,
+              "consistent": 'true'}
+    if fields is not None:
+        params['fields'] = fields
+    return session.get(
+        db['name'] + '/' + db['endpoint'][0],
+        params=params,
+        headers={'Authorization': auth})
+
+
+def read_segments(keys, auth, fields):
+    """
+    Return a dict mapping each segment key in `keys` to its item,
+    reading only the attributes in the list `fields`.  Raises
+    RuntimeError if the datastore could not read every segment.
+    """
+    segments = {}
+    url = db['name'] + '/' + db['endpoint'][7]
+    for i in range(0, len(keys), EXPAND_BATCH_SIZE):
+        response = session.post(
+            url,
+            json={"objtype": "playlist",
+                  "objkeys": keys[i:i+EXPAND_BATCH_SIZE],
+                  "fields": fields},
+            headers={'Authorization': auth})
+        result = response.json()
+        if response.status_code != 200 or result['UnprocessedKeys']:
+            raise RuntimeError("failed to read playlist segments")
+        for item in result['Items']:
+            segments[item['playlist_id']] = item
+    return segments
+
+
+def chunked_version(version, keys, segments):
+    """
+    Return the version of a chunked playlist whose header has
+    "Version" `version` and segment `keys`, given `segments` (as
+    from read_segments(), including "Version").  An edit may write
+    only a segment, so the version is a digest of the header's and
+    every segment's.  None if any of them is unversioned.
+    """
+    versions = [version] + [segments.get(key, {}).get('Version')
+                            for key in keys]
+    if None in versions:
+        return None
+    return hashlib.blake2b(','.join(versions).encode(),
+                           digest_size=16).hexdigest()
+
+
+def set_version(item, keys, segments):
+    """Replace the "Version" of the chunked playlist header `item`
+    by the version of the whole playlist (see chunked_version())."""
+    version = chunked_version(item.pop('Version', None), keys, segments)
+    if version is not None:
+        item['Version'] = version
+
+
+def current_version(playlist_id, auth):
+    """
+    Return the version of playlist `playlist_id`, reading only
+    versions, or None if it is missing, unversioned or unreadable.
+    """
+    response = read_playlist(playlist_id, auth, fields="Version,Segments")
+    result = response.json()
+    if response.status_code != 200 or result['Count'] == 0:
+        return None
+    item = result['Items'][0]
+    if 'Segments' not in item:
+        return item.get('Version')
+    try:
+        segments = read_segments(item['Segments'], auth, ["Version"])
+    except RuntimeError:
+        return None
+    return chunked_version(item.get('Version'), item['Segments'], segments)
+
+
+def assemble(item, auth):
+    """
+    Return the playlist `item` with its "Playlist" as a list,
+    reading its segments if it is chunked.  Raises RuntimeError
+    if a segment cannot be read.
+    """
+    if 'Segments' in item:
+        keys = item.pop('Segments')
+        item.pop('SegmentSize', None)
+        segments = read_segments(keys, auth, ["Playlist", "Version"])
+        set_version(item, keys, segments)
+        songs = []
+        for key in keys:
+            songs.extend(songlist.decode(
+                segments.get(key, {}).get('Playlist')))
+        item['Playlist'] = songs
+    elif 'Playlist' in item:
+        item['Playlist'] = songlist.decode(item['Playlist'])
+    return item
+
+
+def playlist_page(item, offset, limit, auth):
+    """
+    Return the playlist `item` with "Playlist" holding at most
+    `limit` of its songs, starting at position `offset`, and
+    "Length" the length of the whole playlist.  Of a chunked
+    playlist only the song counts of the segments and the
+    segments that overlap the page are read.
+    """
+    if 'Segments' in item:
+        keys = item.pop('Segments')
+        item.pop('SegmentSize', None)
+        counts = read_segments(keys, auth, ["Count", "Version"])
+        set_version(item, keys, counts)
+        wanted = []
+        start = length = 0
+        for key in keys:
+            count = int(counts.get(key, {}).get('Count', 0))
+            if length + count > offset and length < offset + limit:
+                if not wanted:
+                    start = length
+                wanted.append(key)
+            length += count
+        segments = read_segments(wanted, auth, ["Playlist"])
+        songs = []
+        for key in wanted:
+            songs.extend(songlist.decode(
+                segments.get(key, {}).get('Playlist')))
+        songs = songs[offset - start:offset - start + limit]
+    else:
+        songs = songlist.decode(item.get('Playlist'))
+        length = len(songs)
+        songs = songs[offset:offset + limit]
+    item['Playlist'] = songs
+    item['Offset'] = offset
+    item['Length'] = length
+    return item
+
+
+def create_chunked(playlist_name, song_list, auth):
+    """
+    Create a chunked playlist: a header item holding the name and
+    the ordered keys of its segments, and one segment item for each
+    playlist_segment_size songs.  Returns (status, body), the body of
+    the header's `/write` on success.  If a write fails, the items
+    already written are deleted and the datastore's status returned.
+    """
+    response = session.post(
+        db['name'] + '/' + db['endpoint'][1],
+        json={"objtype": "playlist",
+              "Name": playlist_name,
+              "Segments": [],
+              "SegmentSize": playlist_segment_size},
+        headers={'Authorization': auth})
+    result = json_body(response)
+    if response.status_code != 200 or 'playlist_id' not in result:
+        return response.status_code, result
+    playlist_id = result['playlist_id']
+    keys, failed = write_segments(playlist_id, song_list,
+                                  playlist_segment_size, auth)
+    if failed is None:
+        # No one else knows the playlist yet, so no condition is needed
+        failed = session.put(
+            db['name'] + '/' + db['endpoint'][3],
+            params={"objtype": "playlist", "objkey": playlist_id},
+            json={"Segments": keys},
+            headers={'Authorization': auth})
+        if failed.status_code == 200:
+            return 200, result
+        for key in keys:
+            delete_item(key, auth)
+    delete_item(playlist_id, auth)
+    return failed.status_code, json_body(failed)
+
+
+def write_segments(playlist_id, songs, size, auth):
+    """
+    Write the list of music ids `songs` as new segments of
+    `playlist_id` holding `size` songs each.  Returns (keys, None),
+    the keys of the segments in order, or, if a write failed,
+    (None, its response) after deleting the segments written.
+    """
+    keys = []
+    for i in range(0, len(songs), size):
+        key = '{}#{}'.format(playlist_id, uuid.uuid4().hex[:12])
+        response = session.put(
+            db['name'] + '/' + db['endpoint'][3],
+            params={"objtype": "playlist", "objkey": key},
+            json={"Parent": playlist_id,
+                  "Playlist": songlist.encode(songs[i:i+size],
+                                              packed_playlists),
+                  "Count": len(songs[i:i+size])},
+            headers={'Authorization': auth})
+        if response.status_code != 200:
+            for key in keys:
+                delete_item(key, auth)
+            return None, response
+        keys.append(key)
+    return keys, None
+
+
+def edit_playlist(playlist_id, music_ids, add, auth):
+    """
+    Add the list of distinct `music_ids` to (if `add`) or remove them
+    from the playlist, as one atomic update where the layout allows.
+
+    A playlist stored as a list is edited with one `/append` or
+    `/remove`, unless PLAYLIST_ENCODING is "packed", in which case it
+    is packed by the edit.  Other edits are a read followed by a
+    `/replace` conditional on the playlist (or, for a chunked
+    playlist, the segment) being unchanged, retried if another edit
+    intervened.  An addition to a chunked playlist writes only its
+    last segment, or new segments and the header if the last
+    segment would overflow.  A removal from a chunked playlist is
+    atomic only within each segment.
+
+    Returns (status, body, rejected).  rejected lists the ids
+    already present (add) or absent (remove), which are left out of
+    the update.  status is 200 on success (even if every id was
+    rejected), 404 if there is no such playlist, 400 if a packed
+    playlist would hold an id that is not a UUID, and 503 if the
+    retries are exhausted or a segment cannot be read.
+    """
+    rejected = []
+    pending = list(music_ids)
+    if not packed_playlists:
+        # One conditional update: fails if the playlist is missing
+        # (or chunked), or for any id already present (add) or absent
+        # (remove).  The 409 lists those ids; retry without them.
+        # A playlist stored packed, as after a partial migration, is
+        # not a list (400) and is edited below in its packed form.
+        url = db['name'] + '/' + db['endpoint'][5 if add else 6]
+        for attempt in range(EDIT_RETRIES):
+            if not pending:
+                return 200, {}, rejected
+            response = session.put(
+                url,
+                params={"objtype": "playlist", "objkey": playlist_id},
+                json={"attr": "Playlist", "values": pending},
+                headers={'Authorization': auth})
+            if response.status_code != 409:
+                break
+            conflicts = set(json_body(response).get('values', []))
+            rejected.extend(m for m in pending if m in conflicts)
+            pending = [m for m in pending if m not in conflicts]
+        if response.status_code not in (400, 404, 409):
+            return response.status_code, json_body(response), rejected
+    for attempt in range(EDIT_RETRIES):
+        response = read_playlist(playlist_id, auth,
+                                 fields="Playlist,Segments,SegmentSize",
+                                 consistent=True)
+        result = json_body(response)
+        if response.status_code != 200 or result['Count'] == 0:
+            return 404, result, rejected
+        item = result['Items'][0]
+        try:
+            if 'Segments' in item:
+                status, body, skipped = edit_chunked(
+                    item, pending, add, auth)
+            else:
+                status, body, skipped = replace_songs(
+                    playlist_id, item.get('Playlist'), pending, add, auth)
+        except RuntimeError as e:
+            return 503, {"error": str(e)}, rejected
+        if status is not None:
+            return status, body, rejected + skipped
+    return 503, {"error": "playlist is being edited concurrently"}, rejected
+
+
+def edit_chunked(header, music_ids, add, auth):
+    """
+    Make one attempt at an edit_playlist() of the chunked playlist
+    with item `header`.  Returns (status, body, rejected), with status
+    None if the playlist changed before anything was written.
+    """
+    keys = header['Segments']
+    segments = read_segments(keys, auth, ["Playlist", "Count"])
+    holders = {}
+    for key in keys:
+        for music_id in music_ids:
+            if music_id not in holders and songlist.contains(
+                    segments.get(key, {}).get('Playlist'), music_id):
+                holders[music_id] = key
+    if not add:
+        rejected = [m for m in music_ids if m not in holders]
+        by_segment = {}
+        for music_id, key in holders.items():
+            by_segment.setdefault(key, []).append(music_id)
+        status, body = 200, {}
+        for key, ids in by_segment.items():
+            status, body, skipped = edit_segment(key, ids, auth)
+            rejected.extend(skipped)
+            if status != 200:
+                break
+        return status, body, rejected
+    rejected = [m for m in music_ids if m in holders]
+    new = [m for m in music_ids if m not in holders]
+    if not new:
+        return 200, {}, rejected
+    size = int(header['SegmentSize'])
+    if keys and int(segments.get(keys[-1], {}).get('Count', 0)) + len(
+            new) <= size:
+        status, body, skipped = replace_songs(
+            keys[-1], segments[keys[-1]].get('Playlist'), new, True, auth,
+            count=True)
+        return status, body, rejected + skipped
+    # The last segment would overflow: add segments, which become
+    # part of the playlist only when the header lists them
+    added, failed = write_segments(header['playlist_id'], new, size, auth)
+    if failed is not None:
+        return failed.status_code, json_body(failed), rejected
+    response = session.put(
+        db['name'] + '/' + db['endpoint'][8],
+        params={"objtype": "playlist", "objkey": header['playlist_id']},
+        json={"attr": "Segments", "expected": keys, "value": keys + added},
+        headers={'Authorization': auth})
+    if response.status_code != 200:
+        for key in added:
+            delete_item(key, auth)
+    if response.status_code == 409:
+        return None, None, []
+    return response.status_code, json_body(response), rejected
+
+
+def edit_segment(key, music_ids, auth):
+    """Remove `music_ids` from segment `key`, retrying if the segment
+    changes meanwhile.  Returns (status, body, rejected)."""
+    for attempt in range(EDIT_RETRIES):
+        response = read_playlist(key, auth, fields="Playlist",
+                                 consistent=True)
+        result = json_body(response)
+        if response.status_code != 200 or result['Count'] == 0:
+            return 200, {}, list(music_ids)
+        status, body, rejected = replace_songs(
+            key, result['Items'][0].get('Playlist'), music_ids, False,
+            auth, count=True)
+        if status is not None:
+            return status, body, rejected
+    return 503, {"error": "playlist is being edited concurrently"}, []
+
+
+def replace_songs(objkey, current, music_ids, add, auth, count=False):
+    """
+    Make one attempt at adding `music_ids` to (if `add`) or removing
+    them from the "Playlist" of item `objkey`, which was read as
+    `current`.  A packed "Playlist" is edited in its packed form, as
+    is a list if PLAYLIST_ENCODING is "packed".  If `count`, the
+    item's "Count" is set to the new number of songs.
+
+    Returns (status, body, rejected), with status None if the item
+    changed since it was read.
+    """
+    rejected = []
+    if packed_playlists or songlist.is_packed(current):
+        data = songlist.to_bytes(current)
+        if data is None or songlist.pack(music_ids) is None:
+            return 400, {"error": "music ids must be UUIDs"}, []
+        for music_id in music_ids:
+            offset = songlist.find(data, music_id)
+            if (offset != -1) == add:
+                rejected.append(music_id)
+            elif add:
+                data += songlist.pack([music_id])
+            else:
+                data = data[:offset] + data[offset + songlist.UUID_SIZE:]
+        value = songlist.wire(data)
+        songs = len(data) // songlist.UUID_SIZE
+    else:
+        value = list(current or [])
+        for music_id in music_ids:
+            if (music_id in value) == add:
+                rejected.append(music_id)
+            elif add:
+                value.append(music_id)
+            else:
+                value.remove(music_id)
+        songs = len(value)
+    if len(rejected) == len(music_ids):
+        return 200, {}, rejected
+    body = {"attr": "Playlist", "expected": current, "value": value}
+    if count:
+        body['others'] = {"Count": songs}
+    response = session.put(
+        db['name'] + '/' + db['endpoint'][8],
+        params={"objtype": "playlist", "objkey": objkey},
+        json=body,
+        headers={'Authorization': auth})
+    if response.status_code == 409:
+        return None, None, []
+    return response.status_code, json_body(response), rejected
+
+
+def json_body(response):
+    """Return the JSON body of the datastore `response`, or an
+    "error" object if it has none, such as the page of a 500."""
+    try:
+        return response.json()
+    except ValueError:
+        return {"error": "datastore status {}".format(response.status_code)}
+
+
+def delete_item(objkey, auth):
+    """Delete the playlist table item `objkey`; return the response."""
+    return session.delete(
+        db['name'] + '/' + db['endpoint'][2],
+        params={"objtype": "playlist", "objkey": objkey},
+        headers={'Authorization': auth})
 
 
 @bp.route('/', methods=['POST'])
@@ -91,28 +1023,38 @@ def create_playlist():
         return json.dumps({"message": "error reading arguments"})
 
     if len(song_list) != 0:
-        url_read = db['name'] + '/' + db['endpoint'][0]
-        for ms_id in song_list:
-            payload_music = {"objtype": "music", "objkey": ms_id}
-            get_song = requests.get(
-                url_read,
-                params=payload_music,
-                headers={'Authorization': headers['Authorization']}
-            )
-            if get_song.json()['Count'] == 0:
-                return Response(json.dumps({"error":
-                                f"failed to get the music_id {ms_id}"}),
-                                status=600,
-                                mimetype='application/json')
-
-    url_write = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
-        url_write,
-        json={"objtype": "playlist",
-              "Name": playlist_name,
-              "Playlist": song_list},
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+        try:
+            ms_id = first_missing_song(song_list, headers['Authorization'])
+        except RuntimeError as e:
+            return Response(json.dumps({"error": str(e)}),
+                            status=503,
+                            mimetype='application/json')
+        if ms_id is not None:
+            return Response(json.dumps({"error":
+                            f"failed to get the music_id {ms_id}"}),
+                            status=600,
+                            mimetype='application/json')
+
+    if playlist_segment_size > 0:
+        status, result = create_chunked(playlist_name, song_list,
+                                        headers['Authorization'])
+        if status != 200:
+            return Response(json.dumps(result),
+                            status=status,
+                            mimetype='application/json')
+    else:
+        url_write = db['name'] + '/' + db['endpoint'][1]
+        response = session.post(
+            url_write,
+            json={"objtype": "playlist",
+                  "Name": playlist_name,
+                  "Playlist": songlist.encode(song_list, packed_playlists)},
+            headers={'Authorization': headers['Authorization']})
+        result = response.json()
+    if 'playlist_id' in result:
+        index_songs(result['playlist_id'], song_list, True,
+                    headers['Authorization'])
+    return (result)
 
 
 @bp.route('/<playlist_id>/add', methods=['POST'])
@@ -125,53 +1067,45 @@ def write_song_pl(playlist_id):
                         mimetype='application/json')
     try:
         content = request.get_json()
-        song_to_write_id = content['music_id']
     except Exception:
         return json.dumps({"message": "error reading arguments"})
+    if not isinstance(content, dict):
+        return Response(json.dumps({"error": "the body must be a JSON "
+                                    "object"}),
+                        status=400,
+                        mimetype='application/json')
+    music_ids = content.get('music_ids')
+    song_to_write_id = content.get('music_id')
+    if music_ids is not None:
+        return edit_songs(playlist_id, music_ids, True,
+                          headers['Authorization'])
+    if song_to_write_id is None:
+        return json.dumps({"message": "error reading arguments"})
 
-    payload_pl = {"objtype": "playlist", "objkey": playlist_id}
-    url_read = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url_read,
-        params=payload_pl,
-        headers={'Authorization': headers['Authorization']})
-
-    try:
-        songlist_to_write = response.json()['Items'][0]['Playlist']
-    except Exception:
-        return json.dumps({"message": "Failed to get the playlist_id"})
-
-    payload_ms = {"objtype": "music", "objkey": song_to_write_id}
-    get_song = requests.get(
-        url_read,
-        params=payload_ms,
-        headers={'Authorization': headers['Authorization']}
-    )
-
-    if get_song.json()['Count'] == 0:
+    if not song_exists(song_to_write_id, headers['Authorization']):
         return Response(json.dumps({"error":
                         f"failed to get the music_id {song_to_write_id}"}),
                         status=600,
                         mimetype='application/json')
 
-    if song_to_write_id in songlist_to_write:
+    status, body, rejected = edit_playlist(
+        playlist_id, [song_to_write_id], True, headers['Authorization'])
+    expanded_cache.invalidate(playlist_id)
+    if status == 200 and not rejected:
+        index_songs(playlist_id, [song_to_write_id], True,
+                    headers['Authorization'])
+    if status == 404:
+        return json.dumps({"message": "Failed to get the playlist_id"})
+    if rejected:
         return Response(json.dumps({"error":
                         f"the music_id {song_to_write_id} already exists"}),
                         status=600,
                         mimetype='application/json')
-
-    try:
-        songlist_to_write.append(song_to_write_id)
-    except Exception:
-        return json.dumps({"message": "Failed to write the music_id"})
-
-    url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
-        url,
-        params=payload_pl,
-        json={"Playlist": songlist_to_write},
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    if status != 200:
+        return Response(json.dumps(body),
+                        status=status,
+                        mimetype='application/json')
+    return (body)
 
 
 @bp.route('/<playlist_id>/delete', methods=['POST'])
@@ -184,53 +1118,100 @@ def delete_song_pl(playlist_id):
                         mimetype='application/json')
     try:
         content = request.get_json()
-        song_to_delete_id = content['music_id']
     except Exception:
         return json.dumps({"message": "error reading arguments"})
+    if not isinstance(content, dict):
+        return Response(json.dumps({"error": "the body must be a JSON "
+                                    "object"}),
+                        status=400,
+                        mimetype='application/json')
+    music_ids = content.get('music_ids')
+    song_to_delete_id = content.get('music_id')
+    if music_ids is not None:
+        return edit_songs(playlist_id, music_ids, False,
+                          headers['Authorization'])
+    if song_to_delete_id is None:
+        return json.dumps({"message": "error reading arguments"})
 
-    payload_pl = {"objtype": "playlist", "objkey": playlist_id}
-    url_read = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url_read,
-        params=payload_pl,
-        headers={'Authorization': headers['Authorization']})
-
-    try:
-        songlist_to_delete = response.json()['Items'][0]['Playlist']
-    except Exception:
-        return json.dumps({"message": "Failed to get the playlist_id"})
-
-    payload_ms = {"objtype": "music", "objkey": song_to_delete_id}
-    get_song = requests.get(
-        url_read,
-        params=payload_ms,
-        headers={'Authorization': headers['Authorization']}
-    )
-
-    if get_song.json()['Count'] == 0:
+    if not song_exists(song_to_delete_id, headers['Authorization']):
         return Response(json.dumps({"error":
                         f"failed to get the music_id {song_to_delete_id}"}),
                         status=600,
                         mimetype='application/json')
 
-    if song_to_delete_id not in songlist_to_delete:
+    status, body, rejected = edit_playlist(
+        playlist_id, [song_to_delete_id], False, headers['Authorization'])
+    expanded_cache.invalidate(playlist_id)
+    if status == 200 and not rejected:
+        index_songs(playlist_id, [song_to_delete_id], False,
+                    headers['Authorization'])
+    if status == 404:
+        return json.dumps({"message": "Failed to get the playlist_id"})
+    if rejected:
         return Response(json.dumps({"error":
                         f"the music_id {song_to_delete_id} does not exist"}),
                         status=600,
                         mimetype='application/json')
+    if status != 200:
+        return Response(json.dumps(body),
+                        status=status,
+                        mimetype='application/json')
+    return (body)
+
 
+def edit_songs(playlist_id, music_ids, add, auth):
+    """
+    Add the list `music_ids` to (if `add`) or remove it from the
+    playlist in one edit_playlist(), after checking every id exists
+    with one batched lookup.  The response lists the result for each
+    id in order: "added" or "removed"; "duplicate" if already present
+    (add) or repeated in the request; "absent" if not in the playlist
+    (remove); "unknown" if there is no such song.
+    """
+    if (not isinstance(music_ids, list) or
+            not all(isinstance(m, str) for m in music_ids)):
+        return Response(json.dumps({"error": "music_ids must be a list "
+                                    "of strings"}),
+                        status=400,
+                        mimetype='application/json')
+    if len(music_ids) > EDIT_MAX_IDS:
+        return Response(json.dumps({"error": "at most {} music_ids".format(
+                                    EDIT_MAX_IDS)}),
+                        status=400,
+                        mimetype='application/json')
+    distinct = list(dict.fromkeys(music_ids))
     try:
-        songlist_to_delete.remove(song_to_delete_id)
-    except Exception:
-        return json.dumps({"message": "Failed to remove the music_id"})
-
-    url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
-        url,
-        params=payload_pl,
-        json={"Playlist": songlist_to_delete},
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+        unknown = missing_songs(distinct, auth)
+    except RuntimeError as e:
+        return Response(json.dumps({"error": str(e)}),
+                        status=503,
+                        mimetype='application/json')
+    pending = [m for m in distinct if m not in unknown]
+    status, body, rejected = edit_playlist(playlist_id, pending, add, auth)
+    expanded_cache.invalidate(playlist_id)
+    if status == 404:
+        return json.dumps({"message": "Failed to get the playlist_id"})
+    if status != 200:
+        return Response(json.dumps(body),
+                        status=status,
+                        mimetype='application/json')
+    rejected = set(rejected)
+    applied = [m for m in pending if m not in rejected]
+    index_songs(playlist_id, applied, add, auth)
+    results = []
+    seen = set()
+    for music_id in music_ids:
+        if music_id in unknown:
+            result = "unknown"
+        elif music_id in seen:
+            result = "duplicate"
+        elif music_id in rejected:
+            result = "duplicate" if add else "absent"
+        else:
+            result = "added" if add else "removed"
+        seen.add(music_id)
+        results.append({"music_id": music_id, "result": result})
+    return {"Results": results}
 
 
 @bp.route('/<playlist_id>', methods=['GET'])
@@ -242,13 +1223,96 @@ def get_playlist(playlist_id):
                         status=401,
                         mimetype='application/json')
 
-    payload = {"objtype": "playlist", "objkey": playlist_id}
-    url_read = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url_read,
-        params=payload,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    paged = 'offset' in request.args or 'limit' in request.args
+    if paged:
+        try:
+            offset = int(request.args.get('offset', '0'))
+            limit = int(request.args.get('limit', str(sys.maxsize)))
+        except ValueError:
+            offset = limit = -1
+        if offset < 0 or limit < 0:
+            return Response(json.dumps({"error": "invalid offset or limit"}),
+                            status=400,
+                            mimetype='application/json')
+
+    # Song details in an expanded playlist can change without the
+    # playlist changing, so its ETag is weak
+    expand = request.args.get('expand') == 'music'
+    if expand and paged:
+        return Response(
+            json.dumps({"error": "expand cannot be combined with "
+                                 "offset or limit"}),
+            status=400,
+            mimetype='application/json')
+    if request.if_none_match:
+        unchanged = dbclient.not_modified(
+            current_version(playlist_id, headers['Authorization']),
+            weak=expand)
+        if unchanged is not None:
+            return unchanged
+    if expand:
+        result = expanded_playlist(playlist_id, headers['Authorization'])
+        if isinstance(result, Response):
+            return result
+        return dbclient.with_etag(result, weak=True)
+
+    response = read_playlist(playlist_id, headers['Authorization'])
+    result = response.json()
+    if response.status_code == 200 and result['Count'] > 0:
+        item = result['Items'][0]
+        try:
+            if paged:
+                playlist_page(item, offset, limit, headers['Authorization'])
+            else:
+                assemble(item, headers['Authorization'])
+        except RuntimeError as e:
+            return Response(json.dumps({"error": str(e)}),
+                            status=503,
+                            mimetype='application/json')
+    return dbclient.with_etag(result)
+
+
+def expanded_playlist(playlist_id, auth):
+    """
+    Return the playlist in the format of a datastore `/read`, with
+    a "Songs" list alongside "Playlist".  "Songs" holds, in playlist
+    order, the music_id, Artist and SongTitle of each song; a song
+    no longer in the music table has only its music_id.
+    """
+    found, result, token = expanded_cache.lookup(playlist_id)
+    if found:
+        return result
+    response = read_playlist(playlist_id, auth)
+    result = response.json()
+    if response.status_code != 200 or result['Count'] == 0:
+        return result
+
+    try:
+        playlist = assemble(result['Items'][0], auth)
+    except RuntimeError as e:
+        return Response(json.dumps({"error": str(e)}),
+                        status=503,
+                        mimetype='application/json')
+    music_ids = list(dict.fromkeys(playlist.get('Playlist', [])))
+    songs = {}
+    url = db['name'] + '/' + db['endpoint'][7]
+    for i in range(0, len(music_ids), EXPAND_BATCH_SIZE):
+        response = session.post(
+            url,
+            json={"objtype": "music",
+                  "objkeys": music_ids[i:i+EXPAND_BATCH_SIZE],
+                  "fields": ["Artist", "SongTitle"]},
+            headers={'Authorization': auth})
+        if response.status_code != 200:
+            return Response(response.content,
+                            status=response.status_code,
+                            mimetype='application/json')
+        for item in response.json()['Items']:
+            songs[item['music_id']] = item
+    playlist['Songs'] = [songs.get(ms_id, {"music_id": ms_id})
+                         for ms_id in playlist.get('Playlist', [])]
+    expanded_cache.fill(playlist_id, result, token)
+    return result
 
 
 @bp.route('/<playlist_id>', methods=['DELETE'])
@@ -259,14 +1323,37 @@ def delete_playlist(playlist_id):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    url_delete = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
-        url_delete,
-        params={"objtype": "playlist", "objkey": playlist_id},
-        headers={'Authorization': headers['Authorization']})
+    # Delete the header last, so that a failure part way
+    # leaves a playlist that can be deleted again
+    auth = headers['Authorization']
+    songs = []
+    response = read_playlist(playlist_id, auth)
+    result = response.json()
+    if response.status_code == 200 and result['Count'] > 0:
+        item = result['Items'][0]
+        segments = item.get('Segments', [])
+        try:
+            songs = assemble(item, auth)['Playlist']
+        except RuntimeError:
+            # Leave the song index entries to the cleanup
+            pass
+        for key in segments:
+            delete_item(key, auth)
+    response = delete_item(playlist_id, auth)
+    expanded_cache.invalidate(playlist_id)
+    index_songs(playlist_id, songs, False, auth)
     return (response.json())
 
 
+def start_background():
+    """Start the background threads.  Under gunicorn every worker
+    runs its own, after the fork."""
+    if music_filter_enabled:
+        threading.Thread(target=maintain_music_index, daemon=True).start()
+    if playlist_cleanup_enabled:
+        threading.Thread(target=run_cleanup, daemon=True).start()
+
+
 # All database calls will have this prefix.  Prometheus metric
 # calls will not---they will have route '/metrics'.  This is
 # the conventional organization.
@@ -279,5 +1366,8 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    if serving.web_server == 'gunicorn':
+        serving.exec_gunicorn(p)
+    start_background()
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
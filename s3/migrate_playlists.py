@@ -0,0 +1,96 @@
+"""
+SFU CMPT 756
+Convert stored playlists between the list and packed encodings.
+
+Run it where the datastore is reachable, for example in the playlist
+service's container:
+
+    python migrate_playlists.py --to packed
+
+Each playlist is rewritten with a datastore `/replace` conditional
+on it being unchanged, so the migration can run while the service
+is live; a playlist edited concurrently is reported and can be
+migrated by running the tool again.  Playlists holding music ids
+that are not UUIDs stay as lists.
+"""
+
+# Standard library modules
+import argparse
+import sys
+
+# Installed packages
+import requests
+
+# Local modules
+import songlist
+
+DB_URL = 'http://cmpt756db:30002/api/v1/datastore'
+PAGE_SIZE = 100
+
+
+def playlists(url):
+    """Yield every playlist item, a page at a time."""
+    params = {"objtype": "playlist", "limit": PAGE_SIZE,
+              "fields": "Playlist"}
+    while True:
+        response = requests.get(url + '/scan', params=params)
+        response.raise_for_status()
+        page = response.json()
+        yield from page['Items']
+        if page['Cursor'] is None:
+            return
+        params['cursor'] = page['Cursor']
+
+
+def migrate(url, packed):
+    """
+    Rewrite every playlist not already in the target encoding.
+
+    Returns a dict counting the playlists "migrated", "unchanged",
+    "unpackable" (non-UUID ids) and "conflicts" (edited meanwhile).
+    """
+    counts = dict.fromkeys(
+        ('migrated', 'unchanged', 'unpackable', 'conflicts'), 0)
+    for item in playlists(url):
+        current = item.get('Playlist')
+        if current is None or songlist.is_packed(current) == packed:
+            counts['unchanged'] += 1
+            continue
+        value = songlist.encode(songlist.decode(current), packed)
+        if songlist.is_packed(value) != packed:
+            counts['unpackable'] += 1
+            continue
+        response = requests.put(
+            url + '/replace',
+            params={"objtype": "playlist", "objkey": item['playlist_id']},
+            json={"attr": "Playlist", "expected": current, "value": value})
+        if response.status_code == 200:
+            counts['migrated'] += 1
+        elif response.status_code in (404, 409):
+            counts['conflicts'] += 1
+        else:
+            response.raise_for_status()
+    return counts
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'migrate_playlists',
+        description='Convert stored playlists between encodings')
+    argp.add_argument(
+        '--to',
+        choices=('packed', 'list'),
+        default='packed',
+        help='Target encoding (default packed)')
+    argp.add_argument(
+        '--db',
+        default=DB_URL,
+        help='Datastore base URL (default {})'.format(DB_URL))
+    return argp.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    counts = migrate(args.db, args.to == 'packed')
+    print(' '.join('{}={}'.format(k, v) for k, v in counts.items()))
+    sys.exit(1 if counts['conflicts'] else 0)
@@ -0,0 +1,169 @@
+"""
+In-process index of the music ids known to exist.
+
+The playlist service uses it to answer "does this song exist?"
+without a datastore call where it can:
+
+* An LRU of ids recently confirmed by the datastore answers "present".
+* A Bloom filter of every music id answers "probably not present".
+  The filter learns of new songs from notifications that can be lost
+  or reach another replica, so its answer is confirmed with the
+  datastore unless the deployment trusts it (see
+  MUSIC_FILTER_TRUST_ABSENT in app.py).
+
+Anything else must be asked of the datastore.
+"""
+
+# Standard library modules
+import hashlib
+import math
+import threading
+
+# Local modules
+from cache import ItemCache
+
+
+class BloomFilter():
+    """Bloom filter over strings.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of items the filter is sized for.
+    fp_rate: float
+        False-positive rate expected when `capacity` items are held.
+    """
+    def __init__(self, capacity, fp_rate):
+        capacity = max(1, capacity)
+        self.bits = max(8, int(-capacity * math.log(fp_rate) /
+                               (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: position i is h1 + i * h2
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for p in self._positions(value):
+            self._array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self._array[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(value))
+
+    def fp_rate(self):
+        """Return the expected false-positive rate at the current count."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** (
+            self.hashes)
+
+    def size_bytes(self):
+        return len(self._array)
+
+
+class MusicIndex():
+    """Bloom filter plus positive LRU of existing music ids.
+
+    Until the first rebuild() completes, check() never answers
+    "probably absent".  Ids should be added when songs are created,
+    and ids the datastore confirms are added too; deletions
+    cannot be removed from a Bloom filter, so deleted ids only drop
+    out at the next rebuild().
+
+    Parameters
+    ----------
+    capacity, fp_rate:
+        Initial sizing of the Bloom filter.  A rebuild sizes the new
+        filter for at least twice the number of ids scanned.
+    positive_size, positive_ttl:
+        Size and time-to-live of the LRU of confirmed ids.
+    counters: dict of prometheus_client.Counter (optional)
+        'hits', 'misses', 'evictions' for the LRU (see ItemCache).
+    """
+    def __init__(self, capacity, fp_rate, positive_size, positive_ttl,
+                 counters=None):
+        self._capacity = capacity
+        self._fp_rate = fp_rate
+        self._lock = threading.Lock()
+        self._filter = None
+        # Ids added while a rebuild is scanning, or None if none is
+        self._added_during_rebuild = None
+        self._positive = ItemCache(positive_size, positive_ttl,
+                                   **(counters or {}))
+
+    @property
+    def ready(self):
+        return self._filter is not None
+
+    def check(self, music_id):
+        """Return (state, token).
+
+        state is True if `music_id` is known to exist, False if the
+        filter has not seen it, so it probably does not, and None if
+        nothing is known.  Pass token to record() with the answer of
+        the datastore, if it is asked.
+        """
+        found, _, token = self._positive.lookup(music_id)
+        if found:
+            return True, None
+        with self._lock:
+            if self._filter is not None and music_id not in self._filter:
+                return False, token
+        return None, token
+
+    def record(self, music_id, exists, token):
+        """Record the datastore's answer for an id check() did not
+        answer True for."""
+        if exists:
+            self._positive.fill(music_id, True, token)
+            self.add(music_id)
+
+    def add(self, music_id):
+        """Record that `music_id` now exists."""
+        with self._lock:
+            if self._filter is not None and music_id not in self._filter:
+                self._filter.add(music_id)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(music_id)
+
+    def remove(self, music_id):
+        """Record that `music_id` no longer exists."""
+        self._positive.invalidate(music_id)
+
+    def rebuild(self, music_ids):
+        """Replace the filter with one holding the ids in the iterable
+        `music_ids`, plus any added while it is being consumed.
+
+        Returns the new filter.
+        """
+        with self._lock:
+            self._added_during_rebuild = []
+        try:
+            ids = list(music_ids)
+        except Exception:
+            with self._lock:
+                self._added_during_rebuild = None
+            raise
+        new = BloomFilter(max(self._capacity, 2 * len(ids)), self._fp_rate)
+        for music_id in ids:
+            new.add(music_id)
+        with self._lock:
+            for music_id in self._added_during_rebuild:
+                new.add(music_id)
+            self._added_during_rebuild = None
+            self._filter = new
+        return new
+
+    def fp_rate(self):
+        """Expected false-positive rate of the current filter."""
+        f = self._filter
+        return 0.0 if f is None else f.fp_rate()
+
+    def size_bytes(self):
+        f = self._filter
+        return 0 if f is None else f.size_bytes()
@@ -0,0 +1,33 @@
+#!/usr/bin/env bash
+# Check that the copies of the shared service modules match
+# Each service is built from its own directory, so modules used by
+# several services are copied into each.  Each module has one copy
+# to edit, listed first on its line below; with `--fix`, copy it
+# over the others instead of checking.
+set -o nounset
+if [[ $# -gt 1 || ( $# -eq 1 && "${1}" != '--fix' ) ]]; then
+  echo "Usage: ${0} [--fix]"
+  echo "Check that the copies of the shared modules match their source"
+  echo
+  echo "  --fix  copy each source over its copies"
+  exit 1
+fi
+
+top=$(dirname "${0}")/..
+rc=0
+while read -r orig copies; do
+  for copy in ${copies}; do
+    if [[ $# -eq 1 ]]; then
+      cp "${top}/${orig}" "${top}/${copy}"
+    elif ! cmp -s "${top}/${orig}" "${top}/${copy}"; then
+      echo "${copy} differs from ${orig}"
+      rc=1
+    fi
+  done
+done <<END
+s1/serving.py db/serving.py s2/v1/serving.py s3/serving.py
+s1/gunicorn.conf.py db/gunicorn.conf.py s2/v1/gunicorn.conf.py s3/gunicorn.conf.py
+s1/dbclient.py s2/v1/dbclient.py s3/dbclient.py
+db/cache.py s3/cache.py
+END
+exit ${rc}
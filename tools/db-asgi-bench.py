@@ -0,0 +1,187 @@
+"""
+Side-by-side benchmark of the threaded (app.py) and asyncio (asgi.py)
+database services against a slow DynamoDB.
+
+Usage: python tools/db-asgi-bench.py DB_DIR [DELAY_MS [CONCURRENCY ...]]
+
+DB_DIR is the db directory with its templates instantiated, so that
+it holds app.py and asgi.py.  The benchmark starts a stand-in for
+DynamoDB that answers every GetItem after DELAY_MS (default 100),
+like the delay cluster/db-vs-delay.yaml injects, then for each
+service and each CONCURRENCY (default 10 100 1000) keeps that many
+`/read` requests in flight for DURATION_SEC and prints the requests
+per second, the latency percentiles, the errors and the peak memory
+(RSS) and thread count of the service process.
+
+The item cache is disabled, so every read reaches the stand-in.
+Run it with an interpreter that has the packages of both
+requirements.txt and requirements-asgi.txt.  Linux only (reads /proc).
+"""
+
+# Standard library modules
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+# Installed packages
+import aiohttp
+from aiohttp import web
+
+import simplejson as json
+
+DURATION_SEC = 15
+WARMUP_SEC = 2
+SERVICE_PORT = 30092
+DYNAMODB_PORT = 30098
+
+SERVICES = (('threaded', 'app.py'), ('asyncio', 'asgi.py'))
+
+
+async def start_dynamodb(delay):
+    """Start the DynamoDB stand-in and return its runner."""
+    async def handle(request):
+        target = request.headers.get('X-Amz-Target', '')
+        body = json.loads(await request.text())
+        await asyncio.sleep(delay)
+        if target.endswith('.GetItem'):
+            item = dict(body['Key'], Artist={'S': 'Artist'},
+                        SongTitle={'S': 'Title'})
+            result = {'Item': item}
+        else:
+            result = {}
+        return web.Response(
+            text=json.dumps(result),
+            content_type='application/x-amz-json-1.0',
+            headers={'x-amzn-RequestId': uuid.uuid4().hex})
+
+    runner = web.AppRunner(web.Application(handler_args={'access_log': None}))
+    runner.app.router.add_post('/', handle)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', DYNAMODB_PORT,
+                      backlog=4096).start()
+    return runner
+
+
+def proc_status(pid):
+    """Return (RSS in MB, threads) of process `pid`."""
+    rss = threads = 0
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+async def wait_ready(url):
+    async with aiohttp.ClientSession() as session:
+        for i in range(100):
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('Service did not start')
+
+
+async def load(url, concurrency, pid):
+    """Keep `concurrency` reads of `url` in flight and return
+    (requests/s, latencies, errors, peak RSS, peak threads)."""
+    start = time.time() + WARMUP_SEC
+    deadline = start + DURATION_SEC
+    latencies = []
+    errors = [0]
+    peak = [0, 0]
+
+    async def client(session):
+        while True:
+            t0 = time.time()
+            if t0 >= deadline:
+                return
+            try:
+                key = uuid.uuid4()
+                async with session.get(url.format(key)) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            if t0 >= start:
+                if ok:
+                    latencies.append(time.time() - t0)
+                else:
+                    errors[0] += 1
+
+    async def sample():
+        while time.time() < deadline:
+            rss, threads = proc_status(pid)
+            peak[0] = max(peak[0], rss)
+            peak[1] = max(peak[1], threads)
+            await asyncio.sleep(0.2)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        await asyncio.gather(sample(),
+                             *(client(session) for i in range(concurrency)))
+    latencies.sort()
+    return len(latencies) / DURATION_SEC, latencies, errors[0], peak
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return float('nan')
+    return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+async def main(db_dir, delay, concurrencies):
+    dynamodb = await start_dynamodb(delay)
+    env = dict(os.environ,
+               DB_DRIVER='dynamodb',
+               DYNAMODB_URL='http://127.0.0.1:{}'.format(DYNAMODB_PORT),
+               DB_CACHE_SIZE='0',
+               AWS_ACCESS_KEY_ID='bench',
+               AWS_SECRET_ACCESS_KEY='bench',
+               AWS_REGION='us-east-1')
+    base = 'http://127.0.0.1:{}/api/v1/datastore/'.format(SERVICE_PORT)
+    print('{:9} {:>6} {:>9} {:>8} {:>8} {:>7} {:>8} {:>8}'.format(
+        'service', 'conc', 'req/s', 'p50 ms', 'p99 ms', 'errors',
+        'RSS MB', 'threads'))
+    try:
+        for name, script in SERVICES:
+            service = subprocess.Popen(
+                [sys.executable, script, str(SERVICE_PORT)], cwd=db_dir,
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                await wait_ready(base + 'health')
+                for concurrency in concurrencies:
+                    rps, latencies, errors, peak = await load(
+                        base + 'read?objtype=music&objkey={}',
+                        concurrency, service.pid)
+                    print('{:9} {:>6} {:>9.1f} {:>8.1f} {:>8.1f} {:>7} '
+                          '{:>8.1f} {:>8}'.format(
+                              name, concurrency, rps,
+                              percentile(latencies, 0.5),
+                              percentile(latencies, 0.99), errors,
+                              peak[0], peak[1]))
+            finally:
+                service.terminate()
+                service.wait()
+    finally:
+        await dynamodb.cleanup()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python db-asgi-bench.py DB_DIR "
+              "[DELAY_MS [CONCURRENCY ...]]")
+        sys.exit(1)
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1
+    concurrencies = [int(c) for c in sys.argv[3:]] or [10, 100, 1000]
+    asyncio.run(main(sys.argv[1], delay, concurrencies))
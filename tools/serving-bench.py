@@ -0,0 +1,116 @@
+"""
+Closed-loop throughput benchmark for one service endpoint.
+
+Usage: python tools/serving-bench.py URL [CLIENTS] [SECONDS]
+
+CLIENTS concurrent clients (default 32) repeatedly GET URL for SECONDS
+(default 20), after a 2 s warm-up, and the requests per second and the
+latency percentiles are printed.  The clients are spread over several
+processes so that the load generator itself is not limited to one core.
+
+To measure how a service scales with cores, start it once per worker
+count and run the benchmark against each, on a host with at least as
+many free cores as workers, e.g. for the music service:
+
+    WEB_SERVER=gunicorn WEB_WORKERS=1 python app.py 30001
+    python tools/serving-bench.py \\
+        'http://127.0.0.1:30001/api/v1/music/search?q=the'
+
+then again with WEB_WORKERS=2, 4, ...  Endpoints answered without the
+datastore, such as the music service's `/search`, show the scaling of
+the service alone.
+"""
+
+# Standard library modules
+import multiprocessing
+import sys
+import threading
+import time
+
+# Installed packages
+import requests
+
+WARMUP_SEC = 2
+
+# Clients per load generator process
+CLIENTS_PER_PROCESS = 8
+
+
+def run_clients(url, clients, deadline, start, results):
+    """Run `clients` client threads until `deadline`, putting the
+    latencies of the requests completed after `start` on `results`."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        mine = []
+        failed = 0
+        while True:
+            t0 = time.time()
+            if t0 >= deadline:
+                break
+            try:
+                ok = session.get(url, timeout=30).status_code < 500
+            except requests.RequestException:
+                ok = False
+            t1 = time.time()
+            if t0 >= start:
+                if ok:
+                    mine.append(t1 - t0)
+                else:
+                    failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((latencies, errors[0]))
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def bench(url, clients, seconds):
+    """Return (requests per second, errors, sorted latencies)."""
+    start = time.time() + WARMUP_SEC
+    deadline = start + seconds
+    results = multiprocessing.Queue()
+    procs = []
+    while clients > 0:
+        n = min(clients, CLIENTS_PER_PROCESS)
+        clients -= n
+        procs.append(multiprocessing.Process(
+            target=run_clients, args=(url, n, deadline, start, results)))
+    for p in procs:
+        p.start()
+    latencies = []
+    errors = 0
+    for p in procs:
+        lat, err = results.get()
+        latencies.extend(lat)
+        errors += err
+    for p in procs:
+        p.join()
+    latencies.sort()
+    return len(latencies) / seconds, errors, latencies
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python serving-bench.py URL [CLIENTS] [SECONDS]")
+        sys.exit(1)
+    url = sys.argv[1]
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    rps, errors, latencies = bench(url, clients, seconds)
+    print("{:.1f} requests/s, {} errors".format(rps, errors))
+    if latencies:
+        print("latency ms: p50 {:.1f}  p90 {:.1f}  p99 {:.1f}".format(
+            *(1000 * percentile(latencies, p) for p in (0.5, 0.9, 0.99))))